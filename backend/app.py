@@ -1,13 +1,33 @@
 import os
+import time
 import uuid
-import logging
+import secrets
 from functools import wraps
-from flask import Flask, request, jsonify
+import click
+from pymongo import MongoClient, ReturnDocument
+from flask import Flask, request, jsonify, g
 from flask import Flask
 from flask_pymongo import PyMongo
-from flask_cors import CORS, cross_origin
 from flask_restx import Api, Resource, fields, Namespace
-from bson import ObjectId
+from pagination import DEFAULT_PAGE_SIZE, list_params, list_response, parse_page_args
+from indexes import ensure_indexes, create_indexes, check_indexes, drop_retired_indexes
+from cache import MISSING, ReadCache, TTLCache
+from bulk import row_validator, bulk_insert, bulk_update, bulk_delete
+from ordering import place_order, place_orders
+from serializers import output_json, serialize_with, serializer
+from reports import apply_orders, rebuild_rollups, date_range
+from catalog import Catalog
+from metrics import Registry, MetricsStore, MongoTimer, SIZE_BUCKETS, render, route_labels
+from logs import configure_logging, restart_listener
+from middleware import EdgeMiddleware
+from passwords import PasswordHasher, HasherBusy
+from events import EventBroker, BrokerBusy, order_event, event_filter
+from search import SEARCH_FILE, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, SearchIndex
+from archive import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_PAUSE, ARCHIVE_STATUSES, \
+    archive_cutoff, archive_orders, archived_flag, find_order, order_collections
+from ratelimit import RateLimiter, key_limits, limit_headers, parse_key_limits, client_limits, client_bucket
+from export import EXPORT_FORMATS, export_params, parse_export_args, export_cursors, export_chunks
+from history import SUMMARY_FIELD, EMPTY_SUMMARY, apply_summaries, rebuild_summaries, decode_cursor, find_history
 
 app = Flask(__name__, static_folder='../frontend/dist', static_url_path='')
 app.config['DEBUG'] = True
@@ -18,28 +38,81 @@ MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD')
 MONGO_HOST = os.environ.get('MONGO_HOST')
 MONGO_DBNAME = os.environ.get('MONGO_DBNAME')
 
-# Construct the MongoDB URI
-app.config["MONGO_URI"] = f"mongodb+srv://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}/{MONGO_DBNAME}?retryWrites=true&w=majority"
+# How long (seconds) a cached API key validation may be served before Mongo is asked again
+API_KEY_CACHE_TTL = float(os.environ.get('ORDA_API_KEY_CACHE_TTL', 30))
+API_KEY_CACHE_SIZE = int(os.environ.get('ORDA_API_KEY_CACHE_SIZE', 4096))
+# How long (seconds) orders and customers read by id are kept per worker; 0
+# only collapses concurrent reads of the same document into one query
+READ_CACHE_TTL = float(os.environ.get('ORDA_READ_CACHE_TTL', 0))
+READ_CACHE_SIZE = int(os.environ.get('ORDA_READ_CACHE_SIZE', 10000))
 
-mongo = PyMongo(app)
-CORS(app)
+# Construct the MongoDB URI (MONGO_URI overrides it, e.g. for a local mongod)
+app.config["MONGO_URI"] = os.environ.get('MONGO_URI') or f"mongodb+srv://{MONGO_USER}:{MONGO_PASSWORD}@{MONGO_HOST}/{MONGO_DBNAME}?retryWrites=true&w=majority"
 
-# Configure logging
-logging.basicConfig(filename='app.log', level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
+# Mongo client of each worker process: pool size, timeouts in ms (a socket
+# timeout of 0 waits indefinitely) and wire compression, e.g. "zstd,zlib"
+MONGO_MAX_POOL_SIZE = int(os.environ.get('ORDA_MONGO_MAX_POOL_SIZE', 100))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('ORDA_MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('ORDA_MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('ORDA_MONGO_SOCKET_TIMEOUT_MS', 0))
+MONGO_COMPRESSORS = os.environ.get('ORDA_MONGO_COMPRESSORS', '')
+
+# Per-worker metrics; Mongo command timings are attributed to the current request
+metrics = Registry()
+metrics_store = MetricsStore()
+mongo_timer = MongoTimer(metrics)
+
+mongo_options = {
+    'maxPoolSize': MONGO_MAX_POOL_SIZE,
+    'connectTimeoutMS': MONGO_CONNECT_TIMEOUT_MS,
+    'serverSelectionTimeoutMS': MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    'socketTimeoutMS': MONGO_SOCKET_TIMEOUT_MS or None,
+    'event_listeners': [mongo_timer],
+    # Nothing connects until the first query, which happens in a worker
+    'connect': False,
+}
+if MONGO_COMPRESSORS:
+    mongo_options['compressors'] = MONGO_COMPRESSORS
+mongo = PyMongo(app, **mongo_options)
+
+def connect_mongo():
+    '''Give this process its own Mongo client; clients must not cross a fork'''
+    mongo.cx = MongoClient(app.config['MONGO_URI'], **mongo_options)
+    mongo.db = mongo.cx[mongo.db.name] if mongo.db is not None else None
+# CORS preflights, trailing slashes and response headers are handled before Flask routing
+app.wsgi_app = EdgeMiddleware(app.wsgi_app)
+
+# Create the lookup indexes on startup (idempotent); `flask ensure-indexes` does the same
+if os.environ.get('ORDA_ENSURE_INDEXES', 'false').lower() == 'true':
+    ensure_indexes(mongo.db)
+
+# Configure logging (written by a background thread, level from ORDA_LOG_LEVEL)
+log_listener = configure_logging()
+
+def init_worker():
+    '''
+    Per-process setup when the app is imported once and then forked
+    (gunicorn preload_app; see gunicorn_config.py). The hash pool, event
+    journals and rate limiter notice the new pid on their own.
+    '''
+    connect_mongo()
+    restart_listener(log_listener)
 api = Api(app, version='1.0', title='OrdaSys API', description='OrdaSys API Documentation', doc='/swagger/')
+api.representations['application/json'] = output_json
 
 # Namespaces
 ns_customers = Namespace('customers', path='/api/v1/customers', description='Customer operations')
 ns_items = Namespace('items', path='/api/v1/items', description='Item operations')
 ns_orders = Namespace('orders', path='/api/v1/orders', description='Order operations')
 ns_keys = Namespace('keys', path='/api/v1/keys', description="Keys operations")
+ns_reports = Namespace('reports', path='/api/v1/reports', description='Sales and inventory reports')
 
 # add namespaces
 api.add_namespace(ns_customers)
 api.add_namespace(ns_items)
 api.add_namespace(ns_orders)
 api.add_namespace(ns_keys)
+api.add_namespace(ns_reports)
 
 # Model definitions
 get_order_model = api.model('Get Order', {
@@ -69,6 +142,17 @@ post_order_model = api.model('Post Order', {
     'status': fields.String(required=True, description='Status of the order')
 })
 
+# Orders placed through the API are priced from the catalog, so lines only carry ids and quantities
+place_order_model = api.model('Place Order', {
+    'customer_id': fields.String(required=True, description='Customer identifier'),
+    'items': fields.List(fields.Nested(api.model('Order Line', {
+        'item_id': fields.String(required=True, description='Item identifier'),
+        'quantity': fields.Integer(required=True, min=1, description='Quantity of the item')
+    })), required=True, description='List of items'),
+    'date': fields.String(required=True, description='Date of the order'),
+    'status': fields.String(required=True, description='Status of the order')
+})
+
 post_customer_model = api.model('Post Customer', {
     'name': fields.String(required=True, description='Full name of the customer'),
     'email': fields.String(required=True, description='Email address of the customer'),
@@ -76,6 +160,11 @@ post_customer_model = api.model('Post Customer', {
     'address': fields.String(required=True, description='Physical address of the customer')
 })
 
+login_model = api.model('Customer Login', {
+    'email': fields.String(required=True, description='Email address of the customer'),
+    'password': fields.String(required=True, description='Password for the customer account')
+})
+
 get_customer_model = api.model('Get Customer', {
     'customer_id': fields.String(required=True, description='The unique identifier for the customer'),
     'name': fields.String(required=True, description='Full name of the customer'),
@@ -99,18 +188,158 @@ post_item_model = api.model('Post Item', {
 get_key_model = api.model('Create API Key', {
     'active': fields.Boolean(required=True, description='active key?'),
     'key_id': fields.String(required=True, description='Key id'),
-    'key': fields.String(required=True, description='API Key')
+    'key': fields.String(required=True, description='API Key'),
+    'rate_limit': fields.Float(description='Requests per minute (default ORDA_RATE_LIMIT, 0 for unlimited)'),
+    'burst': fields.Integer(description='Requests allowed at once (default ORDA_RATE_LIMIT_BURST)')
+})
+
+key_limits_model = api.model('Key Limits', {
+    'rate_limit': fields.Float(description='Requests per minute (0 for unlimited)'),
+    'burst': fields.Integer(description='Requests allowed at once')
+})
+
+put_order_row_model = api.inherit('Put Order Row', post_order_model, {
+    'order_id': fields.String(required=True, description='The order unique identifier')
+})
+
+put_item_row_model = api.inherit('Put Item Row', post_item_model, {
+    'item_id': fields.String(required=True, description='The unique identifier for the item')
+})
+
+bulk_delete_model = api.model('Bulk Delete', {
+    'ids': fields.List(fields.String, required=True, description='Identifiers to delete')
+})
+
+bulk_result_model = api.model('Bulk Result', {
+    'index': fields.Integer(description='Position of the row in the request'),
+    'status': fields.Integer(description='HTTP status for this row'),
+    'id': fields.String(description='Identifier of the created, updated or deleted record'),
+    'errors': fields.Raw(description='Validation or write errors for this row')
+})
+
+item_sales_model = api.model('Item Sales', {
+    'date': fields.String(description='Day (YYYY-MM-DD)'),
+    'item_id': fields.String(description='Item identifier'),
+    'orders': fields.Integer(description='Orders containing the item'),
+    'quantity': fields.Integer(description='Units sold'),
+    'revenue': fields.Float(description='Revenue from the item')
+})
+
+customer_sales_model = api.model('Customer Sales', {
+    'date': fields.String(description='Day (YYYY-MM-DD)'),
+    'customer_id': fields.String(description='Customer identifier'),
+    'orders': fields.Integer(description='Orders placed'),
+    'revenue': fields.Float(description='Order totals')
+})
+
+status_report_model = api.model('Order Status Report', {
+    'date': fields.String(description='Day (YYYY-MM-DD)'),
+    'status': fields.String(description='Order status'),
+    'orders': fields.Integer(description='Orders currently in this status'),
+    'revenue': fields.Float(description='Order totals')
+})
+
+order_summary_model = api.model('Order Summary', {
+    'orders': fields.Integer(description='Orders placed'),
+    'spend': fields.Float(description='Sum of order totals'),
+    'last_order_date': fields.String(description='Date of the latest order')
+})
+
+customer_orders_model = api.model('Customer Orders', {
+    'summary': fields.Nested(order_summary_model, description='Totals over all of the customer\'s orders'),
+    'items': fields.List(fields.Nested(get_order_model), description='This page, newest first'),
+    'next': fields.String(description='Cursor for the following page, null on the last one')
 })
 
-# Helper function to convert MongoDB documents to JSON-serializable format
-def convert_to_json(data):
-    if isinstance(data, list):
-        return [convert_to_json(item) for item in data]
-    if isinstance(data, dict):
-        return {k: convert_to_json(v) for k, v in data.items()}
-    if isinstance(data, ObjectId):
-        return str(data)
-    return data
+report_params = {
+    'from': 'First day to include (YYYY-MM-DD)',
+    'to': 'Last day to include (YYYY-MM-DD)'
+}
+
+# Per-row validators for the bulk endpoints, compiled once
+order_row_validator = row_validator(api, post_order_model)
+place_order_row_validator = row_validator(api, place_order_model)
+item_row_validator = row_validator(api, post_item_model)
+
+# Serialized item responses shared by every request in this worker; the
+# version lives in Mongo so all gunicorn workers notice catalog writes
+catalog = Catalog()
+item_encoder = serializer(get_item_model)
+
+# Order events for /api/v1/orders/events, fanned out to every worker through a journal file
+order_events = EventBroker()
+order_encoder = serializer(get_order_model)
+
+# Typeahead search; each worker keeps its own index, fed by a shared journal of writes
+search_journal = EventBroker(SEARCH_FILE)
+item_search = SearchIndex(search_journal, 'items', 'item_id', 'name', projection={'reservations': 0})
+customer_search = SearchIndex(search_journal, 'customers', 'customer_id', 'name', secondary=['email'],
+                              projection={'password': 0})
+
+search_params = {
+    'q': 'Text to match; every word must prefix a word of the name (or email, for customers)',
+    'limit': f'Results to return (default {SEARCH_DEFAULT_LIMIT}, at most {SEARCH_MAX_LIMIT})'
+}
+
+def search_args():
+    '''(q, limit) for a search route'''
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        api.abort(400, 'q is required')
+    try:
+        limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        api.abort(400, 'limit must be an integer')
+    return query, max(1, min(limit, SEARCH_MAX_LIMIT))
+
+# Password hashing runs on its own process pool, away from request threads
+password_hasher = PasswordHasher()
+# Orders and customers by id; writes through this worker invalidate them at
+# once, other workers' copies expire within READ_CACHE_TTL
+read_cache = ReadCache(ttl=READ_CACHE_TTL, maxsize=READ_CACHE_SIZE)
+
+# Token buckets per API key, shared by the workers on this host
+rate_limiter = RateLimiter()
+
+metrics.register_collector(lambda: [
+    ('orda_cache_hits_total', (('cache', 'api_keys'),), api_key_cache.hits),
+    ('orda_cache_misses_total', (('cache', 'api_keys'),), api_key_cache.misses),
+    ('orda_cache_hits_total', (('cache', 'catalog'),), catalog.bodies.hits),
+    ('orda_cache_misses_total', (('cache', 'catalog'),), catalog.bodies.misses),
+    ('orda_password_hash_rejected_total', (), password_hasher.rejected),
+    ('orda_events_published_total', (), order_events.published),
+    ('orda_events_dropped_subscribers_total', (), order_events.dropped),
+    ('orda_events_rejected_streams_total', (), order_events.rejected),
+    ('orda_rate_limited_total', (), rate_limiter.limited),
+    ('orda_cache_hits_total', (('cache', 'reads'),), read_cache.hits),
+    ('orda_cache_misses_total', (('cache', 'reads'),), read_cache.loads),
+    ('orda_reads_coalesced_total', (('cache', 'reads'),), read_cache.coalesced),
+    ('orda_reads_coalesced_total', (('cache', 'catalog'),), catalog.loads.coalesced),
+])
+
+# Every order write path reports (before, after) pairs here so that derived
+# data stays in sync; before is None for new orders and after is None for deletes
+def record_order_changes(changes):
+    changes = [(before, after) for before, after in changes if before or after]
+    if changes:
+        read_cache.invalidate(*{('order', order['order_id']) for change in changes for order in change
+                                if order and order.get('order_id')})
+        apply_orders(mongo.db, changes)
+        apply_summaries(mongo.db, changes)
+        order_events.publish([order_event(before, after, order_encoder) for before, after in changes])
+
+# Per-process cache of API key -> its rate limits (True when unlimited), or
+# False for invalid keys, so that those are remembered too
+api_key_cache = TTLCache(maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL)
+
+def lookup_api_key(api_key):
+    '''False for an unknown or revoked key, else its (rate, burst) limits or True'''
+    limits = api_key_cache.get(api_key)
+    if limits is MISSING:
+        document = mongo.db.api_keys.find_one({'key': api_key, 'active': True}, {'_id': 0, 'rate_limit': 1, 'burst': 1})
+        limits = False if document is None else key_limits(document) or True
+        api_key_cache.set(api_key, limits)
+    return limits
 
 def require_api_key(f):
     @wraps(f)
@@ -119,90 +348,174 @@ def require_api_key(f):
         if not api_key:
             return jsonify({'error': 'API key is missing'}), 401
         
-        key_data = mongo.db.api_keys.find_one({'key': api_key, 'active': True})
-        if not key_data:
+        if not lookup_api_key(api_key):
             return jsonify({'error': 'Invalid or inactive API key'}), 403
         
         return f(*args, **kwargs)
     
     return decorated_function
 
+def read_order(order_id):
+    '''An order by id, live or archived; concurrent reads of one order share a query'''
+    return read_cache.get(('order', order_id), lambda: find_order(mongo.db, order_id))
+
 @ns_orders.route('/')
 @ns_orders.route('')
 class OrderList(Resource):
-    @cross_origin(headers=['Content-Type'])
-    def options(self):
-        return jsonify(success=True)
-
-    @api.doc('list_orders')
-    @api.marshal_list_with(get_order_model)
+    @api.doc('list_orders', params={**list_params, 'archived': 'true to include archived orders'})
+    @api.response(200, 'Success', [get_order_model])
     # @require_api_key
     def get(self):
         '''List all orders'''
-        orders = mongo.db.orders.find()
-        return list(orders)
+        return list_response(mongo.db.orders, get_order_model,
+                             also=order_collections(mongo.db, archived_flag(request.args))[1:])
 
     @api.doc('create_order')
-    @cross_origin(headers=['Content-Type'])
-    @api.expect(post_order_model)
-    @ns_orders.marshal_with(get_order_model, code=201)  # Ensure this uses a model that includes the order_id
+    @api.expect(place_order_model)
+    @api.response(400, 'Invalid or unknown items')
+    @api.response(409, 'Insufficient stock')
+    @serialize_with(api, get_order_model, code=201)  # Ensure this uses a model that includes the order_id
     def post(self):
-        '''Create a new order'''
+        '''Create a new order, pricing it from the catalog and reserving stock'''
         data = request.json
         if not data:
             api.abort(400, "No data provided")
 
-        # Generate a unique order_id
-        order_id = str(uuid.uuid4())
+        # Prices, total and stock come from the items collection, not the client
+        order = place_order(mongo.db, data)
+        catalog.stock_changed(mongo.db)
+        record_order_changes([(None, order)])
+        return order, 201
 
-        # Insert the order into the database with the generated order_id
-        order = {
-            'order_id': order_id,
-            **data
-        }
-        mongo.db.orders.insert_one(order)
-        new_order = mongo.db.orders.find_one({'order_id': order_id})
 
-        # Ensure ObjectId fields are converted to strings
-        return convert_to_json(new_order), 201
+@ns_orders.route('/bulk')
+class OrderBulk(Resource):
+    @api.doc('bulk_create_orders')
+    @api.expect([place_order_model])
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def post(self):
+        '''Create many orders, each priced from the catalog and reserving its stock, with a single insert'''
+        results, inserted = place_orders(mongo.db, api.payload, place_order_row_validator)
+        if inserted:
+            catalog.stock_changed(mongo.db)
+        record_order_changes([(None, order) for order in inserted])
+        return results
+
+    @api.doc('bulk_update_orders')
+    @api.expect([put_order_row_model])
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def put(self):
+        '''Update many orders with a single bulk write'''
+        rows = api.payload
+        results, current = bulk_update(mongo.db.orders, rows, order_row_validator, 'order_id',
+                                       projection={'_id': 0})
+        changes = []
+        for result in results:
+            if result['status'] == 200:
+                before = current[result['id']]
+                after = {**before, **rows[result['index']]}
+                changes.append((before, after))
+                current[result['id']] = after
+        record_order_changes(changes)
+        return results
+
+    @api.doc('bulk_delete_orders')
+    @api.expect(bulk_delete_model)
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def delete(self):
+        '''Delete many orders with a single delete'''
+        data = api.payload or {}
+        results, deleted = bulk_delete(mongo.db.orders, data.get('ids'), 'order_id', projection={'_id': 0})
+        record_order_changes([(order, None) for order in deleted.values()])
+        return results
+
+
+@ns_orders.route('/events')
+class OrderEvents(Resource):
+    @api.doc('order_events', params={
+        'status': 'Only orders with this status',
+        'customer_id': 'Only orders of this customer',
+        'last_event_id': 'Resume after this event id (same as the Last-Event-ID header)'
+    })
+    @api.produces(['text/event-stream'])
+    @api.response(200, 'Server-Sent Events: order.created, order.updated, order.status and order.deleted')
+    @api.response(503, 'This worker has ORDA_EVENTS_MAX_STREAMS streams open, retry after Retry-After seconds')
+    def get(self):
+        '''Stream order changes as Server-Sent Events'''
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        if last_id is not None:
+            try:
+                last_id = int(last_id)
+            except ValueError:
+                api.abort(400, 'Last-Event-ID must be an event id')
+        match = event_filter(request.args.get('status'), request.args.get('customer_id'))
+        try:
+            body = order_events.stream(match, last_id)
+        except BrokerBusy:
+            return {'message': 'Too many open event streams, try again shortly'}, 503, {'Retry-After': '5'}
+        return app.response_class(body, mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@ns_orders.route('/export')
+class OrderExport(Resource):
+    @api.doc('export_orders', params=export_params)
+    @api.produces(list(EXPORT_FORMATS.values()) + ['application/gzip'])
+    @api.response(200, 'The orders as a file; X-Export-Watermark is the `since` of the next export')
+    def get(self):
+        '''Stream orders as NDJSON or CSV straight from the database cursor'''
+        try:
+            fmt, date_from, date_to, since, compress = parse_export_args(request.args)
+        except ValueError as exc:
+            api.abort(400, str(exc))
+        cursors, watermark = export_cursors(order_collections(mongo.db, archived_flag(request.args)),
+                                            since, date_from, date_to)
+        filename = f"orders.{fmt}{'.gz' if compress else ''}"
+        return app.response_class(export_chunks(cursors, fmt, order_encoder, compress),
+                                  mimetype='application/gzip' if compress else EXPORT_FORMATS[fmt],
+                                  headers={'Content-Disposition': f'attachment; filename={filename}',
+                                           'X-Export-Watermark': str(watermark or '')})
 
 
 @ns_orders.route('/<string:order_id>')
 class Order(Resource):
     @api.doc('get_order')
-    @api.marshal_with(get_order_model)
+    @serialize_with(api, get_order_model)
     def get(self, order_id):
         '''Get details of a specific order'''
-        order = mongo.db.orders.find_one({'order_id': order_id})
+        order = read_order(order_id)
         if not order:
             return {'message': 'Order not found'}, 404
         return order
 
     @api.doc('update_order')
     @api.expect(post_order_model)
-    @api.marshal_with(get_order_model)
+    @serialize_with(api, get_order_model)
     def put(self, order_id):
         '''Update details of a specific order'''
         data = api.payload
         if not data:
             return {'message': 'No data provided'}, 400
 
-        # Update the order in the database
-        updated_order = mongo.db.orders.find_one_and_update(
+        # Update the order in the database, keeping the previous version for the reports
+        previous_order = mongo.db.orders.find_one_and_update(
             {'order_id': order_id},
             {'$set': data},
-            return_document=True
+            return_document=ReturnDocument.BEFORE
         )
-        if not updated_order:
+        if not previous_order:
             return {'message': 'Order not found'}, 404
+        updated_order = {**previous_order, **data}
+        record_order_changes([(previous_order, updated_order)])
         return updated_order
 
     @api.doc('delete_order')
     def delete(self, order_id):
         '''Delete a specific order'''
-        result = mongo.db.orders.delete_one({'order_id': order_id})
-        if result.deleted_count == 0:
+        deleted_order = mongo.db.orders.find_one_and_delete({'order_id': order_id})
+        if not deleted_order:
             return {'message': 'Order not found'}, 404
+        record_order_changes([(deleted_order, None)])
         return {'message': 'Order deleted successfully'}
 
 
@@ -211,7 +524,7 @@ class OrderStatus(Resource):
     @api.doc('get_order_status')
     def get(self, order_id):
         '''Get the current status of a specific order'''
-        order = mongo.db.orders.find_one({'order_id': order_id})
+        order = read_order(order_id)
         if not order:
             return {'message': 'Order not found'}, 404
         return {'status': order['status']}
@@ -227,29 +540,31 @@ class OrderStatus(Resource):
             return {'message': 'No data provided'}, 400
 
         # Update the status of the order in the database
-        updated_order = mongo.db.orders.find_one_and_update(
+        previous_order = mongo.db.orders.find_one_and_update(
             {'order_id': order_id},
             {'$set': {'status': data['status']}},
-            return_document=True
+            return_document=ReturnDocument.BEFORE
         )
-        if not updated_order:
+        if not previous_order:
             return {'message': 'Order not found'}, 404
+        updated_order = {**previous_order, 'status': data['status']}
+        record_order_changes([(previous_order, updated_order)])
         return updated_order
 
 
 @ns_customers.route('/')
 @ns_customers.route('')
 class CustomerList(Resource):
-    @api.doc('list_customers')
-    @api.marshal_list_with(get_customer_model)
+    @api.doc('list_customers', params=list_params)
+    @api.response(200, 'Success', [get_customer_model])
     def get(self):
         '''List all customers'''
-        customers = mongo.db.customers.find({}, {'password': 0})  # Exclude passwords from the query result
-        return list(customers)
+        # Exclude passwords from the query result
+        return list_response(mongo.db.customers, get_customer_model, projection={'password': 0})
 
     @api.doc('register_customer')
     @api.expect(post_customer_model)
-    @api.marshal_with(get_customer_model, code=201)
+    @serialize_with(api, get_customer_model, code=201)
     def post(self):
         '''Register a new customer'''
         data = api.payload
@@ -257,8 +572,10 @@ class CustomerList(Resource):
             api.abort(400, "No data provided")
 
         # Hash the password before storing it
-        from werkzeug.security import generate_password_hash
-        hashed_password = generate_password_hash(data['password'])
+        try:
+            hashed_password = password_hasher.hash(data['password'])
+        except HasherBusy:
+            return {'message': 'Too many registrations, try again shortly'}, 503, {'Retry-After': '1'}
 
         customer = {
             'customer_id': str(uuid.uuid4()),  # Generate a new UUID for the customer
@@ -268,28 +585,104 @@ class CustomerList(Resource):
             'address': data['address']
         }
         mongo.db.customers.insert_one(customer)
+        customer_search.record([customer])
         del customer['password']  # Remove password from response for security
         return customer, 201
 
 
+@ns_customers.route('/search')
+class CustomerSearch(Resource):
+    @api.doc('search_customers', params=search_params)
+    @serialize_with(api, get_customer_model, as_list=True)
+    def get(self):
+        '''Find customers by name or email prefix, best matches first'''
+        query, limit = search_args()
+        return customer_search.search(mongo.db, query, limit)
+
+
+@ns_customers.route('/login')
+class CustomerLogin(Resource):
+    @api.doc('login_customer')
+    @api.expect(login_model)
+    @api.response(401, 'Invalid email or password')
+    @api.response(503, 'Password hashing is saturated, retry after Retry-After seconds')
+    @serialize_with(api, get_customer_model)
+    def post(self):
+        '''Check a customer's email and password'''
+        data = api.payload
+        if not data or not data.get('email') or not data.get('password'):
+            api.abort(400, 'email and password are required')
+
+        customer = mongo.db.customers.find_one({'email': data['email']})
+        if not customer:
+            return {'message': 'Invalid email or password'}, 401
+        try:
+            valid, new_hash = password_hasher.verify(customer['password'], data['password'])
+        except HasherBusy:
+            return {'message': 'Too many logins, try again shortly'}, 503, {'Retry-After': '1'}
+        if not valid:
+            return {'message': 'Invalid email or password'}, 401
+        if new_hash:
+            # Upgrade to the current hash parameters unless the password changed meanwhile
+            mongo.db.customers.update_one(
+                {'customer_id': customer['customer_id'], 'password': customer['password']},
+                {'$set': {'password': new_hash}}
+            )
+        del customer['password']  # Remove password from response for security
+        return customer
+
+
+@ns_customers.route('/<string:customer_id>/orders')
+class CustomerOrders(Resource):
+    @api.doc('customer_orders', params={
+        'limit': 'Page size',
+        'after': 'Cursor returned as `next` by the previous page',
+        'status': 'Only orders with this status',
+        'archived': 'true to include archived orders',
+        **report_params
+    })
+    @serialize_with(api, customer_orders_model)
+    def get(self, customer_id):
+        '''A customer's orders, newest first, with their lifetime totals'''
+        try:
+            limit, _, _ = parse_page_args({'limit': request.args.get('limit')})
+            after = decode_cursor(request.args['after']) if request.args.get('after') else None
+        except ValueError as exc:
+            api.abort(400, str(exc))
+
+        customer = mongo.db.customers.find_one({'customer_id': customer_id}, {SUMMARY_FIELD: 1})
+        if not customer:
+            return {'message': 'Customer not found'}, 404
+        orders, next_cursor = find_history(mongo.db, customer_id, limit or DEFAULT_PAGE_SIZE, after,
+                                           request.args.get('status'), request.args.get('from'), request.args.get('to'),
+                                           order_collections(mongo.db, archived_flag(request.args)))
+        return {'summary': customer.get(SUMMARY_FIELD) or EMPTY_SUMMARY, 'items': orders, 'next': next_cursor}
+
+
 @ns_customers.route('/<string:customer_id>')
 class Customer(Resource):
     @api.doc('get_customer')
-    @api.marshal_with(get_customer_model)
+    @serialize_with(api, get_customer_model)
     def get(self, customer_id):
         '''Retrieve a specific customer by their customer ID'''
-        customer = mongo.db.customers.find_one({'customer_id': customer_id }, {'password': 0})
+        customer = read_cache.get(('customer', customer_id),
+                                  lambda: mongo.db.customers.find_one({'customer_id': customer_id }, {'password': 0}))
         if not customer:
             return {'message': 'Customer not found'}, 404
         return customer
     
     @api.doc('update_customer')
-    @api.marshal_with(get_customer_model)
+    @serialize_with(api, get_customer_model)
     def put(self, customer_id):
         '''Update details of a specific customer'''
         data = api.payload
         if not data:
             return {'message': 'No data provided'}, 400
+        if 'password' in data:
+            try:
+                data['password'] = password_hasher.hash(data['password'])
+            except HasherBusy:
+                return {'message': 'Too many password changes, try again shortly'}, 503, {'Retry-After': '1'}
 
         # Update the customer in the database
         updated_customer = mongo.db.customers.find_one_and_update(
@@ -299,6 +692,8 @@ class Customer(Resource):
         )
         if not updated_customer:
             return {'message': 'Customer not found'}, 404
+        read_cache.invalidate(('customer', customer_id))
+        customer_search.record([updated_customer])
         del updated_customer['password']  # Remove password from response for security
         return updated_customer
     
@@ -308,47 +703,102 @@ class Customer(Resource):
         result = mongo.db.customers.delete_one({'customer_id': customer_id})
         if result.deleted_count == 0:
             return {'message': 'Customer not found'}, 404
+        read_cache.invalidate(('customer', customer_id))
+        customer_search.record(removed=[customer_id])
         return {'message': 'Customer deleted successfully'}
     
 @ns_items.route('/')
 @ns_items.route('')
 class itemsList(Resource):
-    @api.doc('get_items')
-    @api.marshal_list_with(get_item_model)
+    @api.doc('get_items', params=list_params)
+    @api.response(200, 'Success', [get_item_model])
+    @api.response(304, 'Not modified since the ETag in If-None-Match')
     def get(self):
         '''Retrieve all items'''
-        items = mongo.db.items.find()
-        return list(items), 200
+        if request.args:
+            return list_response(mongo.db.items, get_item_model)
+        return catalog.response(mongo.db, 'items', lambda: [item_encoder(item) for item in mongo.db.items.find()])
     
     @api.doc('add_item')
     @api.expect(post_item_model)
-    @api.marshal_with(get_item_model, code=201)
+    @serialize_with(api, get_item_model, code=201)
     def post(self):
         '''Add a new item'''
         item = api.payload
         item['item_id'] = str(uuid.uuid4())  # Generate a new UUID for the item
         mongo.db.items.insert_one(item)  # Insert the new item into the database
+        catalog.bump(mongo.db)
+        item_search.record([item])
         return item, 201
+
+@ns_items.route('/search')
+class ItemSearch(Resource):
+    @api.doc('search_items', params=search_params)
+    @serialize_with(api, get_item_model, as_list=True)
+    def get(self):
+        '''Find items by name prefix, best matches first'''
+        query, limit = search_args()
+        return item_search.search(mongo.db, query, limit)
+
+@ns_items.route('/bulk')
+class ItemBulk(Resource):
+    @api.doc('bulk_add_items')
+    @api.expect([post_item_model])
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def post(self):
+        '''Add many items with a single insert'''
+        results, inserted = bulk_insert(mongo.db.items, api.payload, item_row_validator, 'item_id')
+        catalog.bump(mongo.db)
+        item_search.record(inserted)
+        return results
+
+    @api.doc('bulk_update_items')
+    @api.expect([put_item_row_model])
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def put(self):
+        '''Update many items with a single bulk write'''
+        rows = api.payload
+        results, current = bulk_update(mongo.db.items, rows, item_row_validator, 'item_id',
+                                       projection={'item_id': 1, 'name': 1})
+        catalog.bump(mongo.db)
+        item_search.record([{**current[r['id']], **rows[r['index']]} for r in results if r['status'] == 200])
+        return results
+
+    @api.doc('bulk_delete_items')
+    @api.expect(bulk_delete_model)
+    @api.response(200, 'Per-row results', [bulk_result_model])
+    def delete(self):
+        '''Delete many items with a single delete'''
+        data = api.payload or {}
+        results, deleted = bulk_delete(mongo.db.items, data.get('ids'), 'item_id')
+        catalog.bump(mongo.db)
+        item_search.record(removed=list(deleted))
+        return results
     
 @ns_items.route('/<string:item_id>')
 class Item(Resource):
     @api.doc('get_item')
-    @api.marshal_with(get_item_model)
+    @api.response(304, 'Not modified since the ETag in If-None-Match')
+    @serialize_with(api, get_item_model)
     def get(self, item_id):
         '''Retrieve a specific item by its item ID'''
-        item = mongo.db.items.find_one({'item_id': item_id})
-        if item:
-            return item, 200
+        response = catalog.response(mongo.db, 'item-' + item_id,
+                                    lambda: item_encoder(mongo.db.items.find_one({'item_id': item_id})))
+        if response:
+            return response
         else:
             return {'message': 'Item not found'}, 404
         
     @api.doc('update_item')
     @api.expect(post_item_model)
-    @api.marshal_with(get_item_model)
+    @serialize_with(api, get_item_model)
     def put(self, item_id):
         '''Update an existing item with new data'''
         updated_item = api.payload
         mongo.db.items.update_one({'item_id': item_id}, {'$set': updated_item })
+        catalog.bump(mongo.db)
+        if 'name' in updated_item:
+            item_search.record([{**updated_item, 'item_id': item_id}])
         return updated_item, 200
     
     @api.doc('delete_item')
@@ -356,45 +806,245 @@ class Item(Resource):
     def delete(self, item_id):
         '''Delete an item by item ID'''
         mongo.db.items.delete_one({'item_id': item_id})
+        catalog.bump(mongo.db)
+        item_search.record(removed=[item_id])
         return '', 204
 
 @ns_keys.route('/generate')
 class Key(Resource):
-    @api.marshal_with(get_key_model)
+    @api.expect(key_limits_model)
+    @serialize_with(api, get_key_model)
     def post(self):
         new_key = {
             'key_id': str(uuid.uuid4()),
+            'key': secrets.token_urlsafe(32),
             'customer_id': '502',
             'active': True
         }
+        # Optional per-key limits; without them the ORDA_RATE_LIMIT defaults apply
+        data = request.get_json(silent=True)
+        try:
+            new_key.update(parse_key_limits(data if isinstance(data, dict) else {}))
+        except ValueError as exc:
+            api.abort(400, str(exc))
         mongo.db.api_keys.insert_one(new_key)
-        return {'message': 'API key generated', 'key': new_key['key']}
+        api_key_cache.invalidate(new_key['key'])
+        return new_key
 
-@app.after_request
-def enforce_https_in_redirects(response):
-    # Check if the response is a redirect and the scheme is HTTP
-    if response.status_code in (301, 302, 303, 307, 308) and request.url.startswith('http://'):
-        if not request.url.startswith('http://localhost'):
-            # Replace 'http://' with 'https://' in the Location header
-            response.headers['Location'] = response.headers['Location'].replace('http://', 'https://', 1)
-    return response
+@ns_keys.route('/<string:key_id>')
+class KeyRevoke(Resource):
+    @api.doc('update_key_limits')
+    @api.expect(key_limits_model)
+    @serialize_with(api, get_key_model)
+    def put(self, key_id):
+        '''Change the rate limit of an API key'''
+        data = api.payload
+        if not data or not isinstance(data, dict):
+            return {'message': 'No data provided'}, 400
+        try:
+            limits = parse_key_limits(data, allow_null=True)
+        except ValueError as exc:
+            api.abort(400, str(exc))
+        if not limits:
+            api.abort(400, 'Give rate_limit, burst or both')
+        updated_key = mongo.db.api_keys.find_one_and_update(
+            {'key_id': key_id},
+            {'$set': limits},
+            return_document=ReturnDocument.AFTER
+        )
+        if not updated_key:
+            return {'message': 'Key not found'}, 404
+        # Other workers apply the new limits once their cache entry expires (ORDA_API_KEY_CACHE_TTL)
+        api_key_cache.invalidate(updated_key.get('key'))
+        return updated_key
+
+    @api.doc('revoke_key')
+    @serialize_with(api, get_key_model)
+    def delete(self, key_id):
+        '''Deactivate an API key'''
+        revoked_key = mongo.db.api_keys.find_one_and_update(
+            {'key_id': key_id},
+            {'$set': {'active': False}},
+            return_document=True
+        )
+        if not revoked_key:
+            return {'message': 'Key not found'}, 404
+        # Other workers drop the key once their cache entry expires (ORDA_API_KEY_CACHE_TTL)
+        api_key_cache.invalidate(revoked_key.get('key'))
+        return revoked_key
+
+@ns_reports.route('/sales/items')
+class ItemSalesReport(Resource):
+    @api.doc('item_sales_report', params={**report_params, 'item_id': 'Only this item'})
+    @serialize_with(api, item_sales_model, as_list=True)
+    def get(self):
+        '''Daily units and revenue per item'''
+        query = date_range(request.args.get('from'), request.args.get('to'))
+        if request.args.get('item_id'):
+            query['item_id'] = request.args['item_id']
+        return list(mongo.db.sales_daily_item.find(query).sort([('date', 1), ('item_id', 1)]))
+
+
+@ns_reports.route('/sales/customers')
+class CustomerSalesReport(Resource):
+    @api.doc('customer_sales_report', params={**report_params, 'customer_id': 'Only this customer'})
+    @serialize_with(api, customer_sales_model, as_list=True)
+    def get(self):
+        '''Daily orders and spend per customer'''
+        query = date_range(request.args.get('from'), request.args.get('to'))
+        if request.args.get('customer_id'):
+            query['customer_id'] = request.args['customer_id']
+        return list(mongo.db.sales_daily_customer.find(query).sort([('date', 1), ('customer_id', 1)]))
+
+
+@ns_reports.route('/orders/status')
+class OrderStatusReport(Resource):
+    @api.doc('order_status_report', params=report_params)
+    @serialize_with(api, status_report_model, as_list=True)
+    def get(self):
+        '''Daily order counts per status'''
+        query = date_range(request.args.get('from'), request.args.get('to'))
+        return list(mongo.db.orders_daily_status.find(query).sort([('date', 1), ('status', 1)]))
+
+
+@ns_reports.route('/inventory')
+class InventoryReport(Resource):
+    @api.doc('inventory_report', params={'below': 'Only items with stock at or below this level'})
+    @serialize_with(api, get_item_model, as_list=True)
+    def get(self):
+        '''Item stock levels, lowest first'''
+        query = {}
+        if request.args.get('below') is not None:
+            try:
+                query['stock'] = {'$lte': int(request.args['below'])}
+            except ValueError:
+                api.abort(400, 'below must be an integer')
+        return list(mongo.db.items.find(query, {'reservations': 0}).sort('stock', 1))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    '''Prometheus metrics for every worker of this server'''
+    body = render(*metrics_store.collect(metrics))
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    mongo_timer.start_request()
+    metrics.add_gauge('orda_http_requests_in_flight')
+
+@app.before_request
+def limit_api_key_requests():
+    '''
+    Requests made with a valid API key draw on that key's token bucket;
+    the rest (no key, or an unknown one) on their client address's bucket
+    '''
+    if not request.path.startswith('/api/'):
+        return None
+    api_key = request.headers.get('Authorization')
+    limits = lookup_api_key(api_key) if api_key else False
+    if limits is True:
+        return None
+    if limits:
+        bucket = api_key
+    else:
+        if request.environ.get('orda.client_limited'):
+            # The ASGI entry point already charged this request to the client
+            return None
+        bucket = client_bucket(request.remote_addr, request.headers.get('X-Forwarded-For'))
+        limits = client_limits()
+        if limits is None:
+            return None
+    g.rate_limit = rate_limiter.take(bucket, *limits)
+    if not g.rate_limit.allowed:
+        return {'message': 'Rate limit exceeded, retry later'}, 429, limit_headers(g.rate_limit)
 
 @app.after_request
-def add_cors_headers(response):
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-    response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
+def add_rate_limit_headers(response):
+    if 'rate_limit' in g and g.rate_limit.allowed:
+        response.headers.extend(limit_headers(g.rate_limit))
     return response
 
 @app.after_request
-def add_security_headers(response):
-    response.headers['Referrer-Policy'] = 'no-referrer'
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
-    response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
+def record_request_metrics(response):
+    labels = route_labels(request)
+    metrics.inc('orda_http_requests_total', labels + (('status', response.status_code),))
+    metrics.observe('orda_http_request_duration_seconds', labels, time.perf_counter() - g.get('request_started', time.perf_counter()))
+    metrics.observe('orda_mongo_request_duration_seconds', labels, mongo_timer.request_seconds())
+    # Streamed bodies (ndjson lists, event streams) are not sized: measuring would buffer them
+    size = None if response.is_streamed else response.calculate_content_length()
+    if size is not None:
+        metrics.observe('orda_http_response_size_bytes', labels, size, SIZE_BUCKETS)
     return response
 
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'request_started' in g:
+        metrics.add_gauge('orda_http_requests_in_flight', value=-1)
+    metrics_store.flush(metrics)
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    '''Create every index the API queries on and drop the ones it no longer uses'''
+    for collection, names in drop_retired_indexes(mongo.db).items():
+        if names:
+            click.echo(f"{collection}: dropped {', '.join(names)}")
+    for collection, names in create_indexes(mongo.db).items():
+        click.echo(f"{collection}: {', '.join(names)}")
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    '''Fail if any route's query shape still does a collection scan'''
+    failures = check_indexes(mongo.db)
+    for collection, query in failures:
+        click.echo(f"COLLSCAN: {collection} {query}", err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo('All query shapes use an index')
+
+@app.cli.command('rebuild-reports')
+def rebuild_reports_command():
+    '''Recompute the reporting rollups and customer order summaries from the orders collection'''
+    count = rebuild_rollups(mongo.db)
+    click.echo(f'Rebuilt reports from {count} orders')
+    customers = rebuild_summaries(mongo.db)
+    click.echo(f'Rebuilt order summaries for {customers} customers')
+
+@app.cli.command('archive-orders')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True, help='Archive orders older than this many days')
+@click.option('--status', 'statuses', multiple=True, default=ARCHIVE_STATUSES, show_default=True,
+              help='Terminal status to archive (repeatable)')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True, help='Orders moved per batch')
+@click.option('--pause', default=ARCHIVE_PAUSE, show_default=True, help='Seconds to wait between batches')
+def archive_orders_command(days, statuses, batch_size, pause):
+    '''Move old orders in terminal statuses to orders_archive'''
+    cutoff = archive_cutoff(days)
+    moved = archive_orders(mongo.db, cutoff, statuses, batch_size, pause)
+    click.echo(f'Archived {moved} orders dated before {cutoff}')
+
+@app.cli.command('export-orders')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson', show_default=True)
+@click.option('--from', 'date_from', help='First order date (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last order date (YYYY-MM-DD)')
+@click.option('--since', help='Only orders created after this watermark (printed by the previous export)')
+@click.option('--archived', is_flag=True, help='Include archived orders')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write (default: stdout)')
+def export_orders_command(fmt, date_from, date_to, since, archived, compress, output):
+    '''Write orders as NDJSON or CSV, e.g. for an incremental nightly export'''
+    try:
+        since = parse_export_args({'since': since})[3]
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--since')
+    cursors, watermark = export_cursors(order_collections(mongo.db, archived), since, date_from, date_to)
+    for chunk in export_chunks(cursors, fmt, order_encoder, compress):
+        output.write(chunk)
+    click.echo(f'Watermark: {watermark or ""}', err=True)
 
+def warm_up():
+    '''Build what each worker would otherwise build on first use, so that it is done once before forking'''
+    with app.test_request_context():
+        api.__schema__  # the Swagger spec, cached on the Api
 
 if __name__ == '__main__':
     app.run(debug=False, port=5000)
@@ -0,0 +1,76 @@
+import os
+import time
+from datetime import datetime, timedelta
+from pymongo import DeleteOne
+from pymongo.errors import BulkWriteError
+
+# Orders in one of these statuses and older than ARCHIVE_AFTER_DAYS are moved
+# from `orders` to `orders_archive`
+ARCHIVE_STATUSES = [s.strip() for s in os.environ.get('ORDA_ARCHIVE_STATUSES', 'Shipped,Delivered,Collected').split(',') if s.strip()]
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDA_ARCHIVE_AFTER_DAYS', 90))
+# Orders moved per batch, and seconds to wait between batches so that the job
+# can run alongside live traffic
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ORDA_ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_PAUSE = float(os.environ.get('ORDA_ARCHIVE_PAUSE', 0.2))
+
+ARCHIVE_COLLECTION = 'orders_archive'
+
+
+def archived_flag(args):
+    '''True when a list request asks for archived orders too (?archived=true)'''
+    return (args.get('archived') or '').lower() in ('1', 'true', 'yes')
+
+
+def order_collections(db, archived=False):
+    '''The collections a read of orders covers'''
+    return [db.orders, db[ARCHIVE_COLLECTION]] if archived else [db.orders]
+
+
+def find_order(db, order_id, projection=None):
+    '''Look an order up in the live collection, then in the archive'''
+    return (db.orders.find_one({'order_id': order_id}, projection)
+            or db[ARCHIVE_COLLECTION].find_one({'order_id': order_id}, projection))
+
+
+def archive_cutoff(days=ARCHIVE_AFTER_DAYS, now=None):
+    '''Dates are stored as ISO strings, so the cutoff is one too'''
+    return ((now or datetime.utcnow()) - timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def archive_orders(db, cutoff, statuses=ARCHIVE_STATUSES, batch_size=ARCHIVE_BATCH_SIZE,
+                   pause=ARCHIVE_PAUSE, sleep=time.sleep, max_batches=None):
+    '''
+    Move orders dated before `cutoff` in a terminal status into the archive,
+    one batch at a time. Each batch is copied first and then deleted, so an
+    interrupted run leaves every order in at least one collection; re-running
+    finishes the job. An order is only deleted while it still equals the
+    copy, so one updated in between stays live for a later run. Returns the
+    number of orders moved.
+    '''
+    query = {'status': {'$in': list(statuses)}, 'date': {'$lt': cutoff}}
+    archive = db[ARCHIVE_COLLECTION]
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        orders = list(db.orders.find(query).sort('_id', 1).limit(batch_size))
+        if not orders:
+            break
+        try:
+            archive.insert_many(orders, ordered=False)
+        except BulkWriteError as exc:
+            # Copies left behind by an interrupted run are already in place
+            if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+                raise
+        ids = [order['_id'] for order in orders]
+        # Equality on every copied field: an update since the read makes the delete miss
+        deleted = db.orders.bulk_write([DeleteOne(order) for order in orders], ordered=False).deleted_count
+        if deleted < len(ids):
+            # Changed since the batch was read: keep them live only, to be copied again next time
+            kept = [order['_id'] for order in db.orders.find({'_id': {'$in': ids}}, {'_id': 1})]
+            archive.delete_many({'_id': {'$in': kept}})
+        moved += deleted
+        batches += 1
+        if len(orders) < batch_size:
+            break
+        if pause:
+            sleep(pause)
+    return moved
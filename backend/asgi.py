@@ -0,0 +1,282 @@
+'''
+ASGI entry point for the same API, for serving many concurrent connections
+per process:
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+(or ORDA_SERVER=asgi with gunicorn_config.py). The read routes for orders
+and customers are answered on the event loop with an async Mongo client,
+limited per client address like keyless requests to Flask. Every other
+request (writes, items, keys, reports, event streams, Swagger, and anything
+sent with an API key, whose limit Flask checks) runs through the Flask app
+on a bounded thread pool, so routes, models, validation and docs stay
+exactly those of app.py.
+'''
+import io
+import os
+import sys
+import time
+import inspect
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from werkzeug.routing import Map, Rule
+from werkzeug.exceptions import HTTPException
+
+from app import app as flask_app, metrics, metrics_store, order_encoder, get_customer_model, read_cache, rate_limiter
+from ratelimit import client_limits, client_bucket, limit_headers
+from pagination import DEFAULT_PAGE_SIZE, parse_page_args
+from archive import ARCHIVE_COLLECTION, archived_flag
+from serializers import dumps, serializer
+
+# Threads running Flask for the routes that are not served natively; this
+# also caps how many event streams one process can hold open
+ASGI_SYNC_THREADS = int(os.environ.get('ORDA_ASGI_SYNC_THREADS', 32))
+# Connection pool of the async client; requests beyond it queue on the loop
+ASGI_MONGO_POOL_SIZE = int(os.environ.get('ORDA_ASGI_MONGO_POOL_SIZE', 100))
+
+customer_encoder = serializer(get_customer_model)
+
+# Routes answered on the event loop; the rule strings match app.py so that
+# metrics labels are the same in both serving modes
+native_routes = Map([
+    Rule('/api/v1/orders', endpoint='list_orders', methods=['GET']),
+    Rule('/api/v1/orders/<string:order_id>', endpoint='get_order', methods=['GET']),
+    Rule('/api/v1/orders/<string:order_id>/status', endpoint='get_order_status', methods=['GET']),
+    Rule('/api/v1/customers', endpoint='list_customers', methods=['GET']),
+    Rule('/api/v1/customers/<string:customer_id>', endpoint='get_customer', methods=['GET']),
+    # Static siblings of the routes above stay with Flask
+    Rule('/api/v1/orders/events', endpoint='wsgi'),
+    Rule('/api/v1/orders/bulk', endpoint='wsgi'),
+    Rule('/api/v1/orders/export', endpoint='wsgi'),
+    Rule('/api/v1/customers/login', endpoint='wsgi'),
+    Rule('/api/v1/customers/search', endpoint='wsgi'),
+], strict_slashes=False)
+route_rules = {rule.endpoint: rule.rule for rule in native_routes.iter_rules()}
+
+
+class OrdaASGI(object):
+    def __init__(self, wsgi_app, db=None, threads=ASGI_SYNC_THREADS):
+        self.wsgi_app = wsgi_app
+        self.db = db
+        self.client = None
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        # CORS and security headers, as the Flask side sets them
+        self.edge_headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                             for name, value in wsgi_app.wsgi_app.headers]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        if path.startswith('/api/') and path.endswith('/'):
+            path = path.rstrip('/')
+        try:
+            endpoint, values = native_routes.bind('').match(path, scope['method'])
+        except HTTPException:
+            endpoint = 'wsgi'
+        if endpoint == 'wsgi' or any(name == b'authorization' for name, _ in scope['headers']):
+            # Requests made with an API key go through Flask's rate limiter
+            return await self.call_wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        decision = self.limit(scope)
+        if decision is not None and not decision.allowed:
+            status, body = 429, {'message': 'Rate limit exceeded, retry later'}
+        else:
+            status, body = await getattr(self, endpoint)(args, **values)
+            if status is None:
+                # e.g. ?stream= or ?archived=, which Flask serves; the token is already taken
+                return await self.call_wsgi(scope, receive, send, client_limited=decision is not None)
+        body = dumps(body)
+        limited = [] if decision is None else [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                               for name, value in limit_headers(decision).items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ] + limited + self.edge_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+        rule = route_rules[endpoint]
+        labels = (('namespace', rule.split('/')[3]), ('route', rule), ('method', scope['method']))
+        metrics.inc('orda_http_requests_total', labels + (('status', status),))
+        metrics.observe('orda_http_request_duration_seconds', labels, time.perf_counter() - started)
+        metrics_store.flush(metrics)
+
+    def limit(self, scope):
+        '''Take a token from the client's bucket (these requests carry no API key), or None when unlimited'''
+        limits = client_limits()
+        if limits is None:
+            return None
+        forwarded_for = next((value.decode('latin-1') for name, value in scope['headers']
+                              if name == b'x-forwarded-for'), None)
+        return rate_limiter.take(client_bucket((scope.get('client') or ('', 0))[0], forwarded_for), *limits)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    closed = self.client.close()
+                    if inspect.isawaitable(closed):
+                        await closed
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def connect(self):
+        '''Create the async client in the serving process (after any fork)'''
+        if self.db is None:
+            # PyMongo's own async client (4.9+); a db handed to __init__ needs no import
+            from pymongo import AsyncMongoClient
+            self.client = AsyncMongoClient(flask_app.config['MONGO_URI'], maxPoolSize=ASGI_MONGO_POOL_SIZE)
+            self.db = self.client.get_default_database()
+        return self.db
+
+    # Native routes: each returns (status, JSON-ready body), or (None, None) to defer to Flask
+
+    async def list_documents(self, collection, encode, args, projection=None):
+        try:
+            limit, after, stream = parse_page_args(args)
+        except ValueError as exc:
+            return 400, {'message': str(exc)}
+        if stream or (limit is None and after is None):
+            # Whole lists are streamed by Flask
+            return None, None
+
+        limit = limit or DEFAULT_PAGE_SIZE
+        query = {} if after is None else {'_id': {'$gt': after}}
+        documents = await collection.find(query, projection).sort('_id', 1).limit(limit + 1).to_list(None)
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = str(documents[-1]['_id'])
+        return 200, {'items': [encode(d) for d in documents], 'next': next_cursor}
+
+    async def find_order(self, order_id):
+        '''Live order, else the archived one; shares Flask's read cache and in-flight reads'''
+        db = self.connect()
+
+        async def load():
+            return (await db.orders.find_one({'order_id': order_id})
+                    or await db[ARCHIVE_COLLECTION].find_one({'order_id': order_id}))
+        return await read_cache.get_async(('order', order_id), load)
+
+    async def list_orders(self, args):
+        if archived_flag(args):
+            return None, None
+        return await self.list_documents(self.connect().orders, order_encoder, args)
+
+    async def get_order(self, args, order_id):
+        order = await self.find_order(order_id)
+        if not order:
+            return 404, {'message': 'Order not found'}
+        return 200, order_encoder(order)
+
+    async def get_order_status(self, args, order_id):
+        order = await self.find_order(order_id)
+        if not order:
+            return 404, {'message': 'Order not found'}
+        return 200, {'status': order['status']}
+
+    async def list_customers(self, args):
+        return await self.list_documents(self.connect().customers, customer_encoder, args, {'password': 0})
+
+    async def get_customer(self, args, customer_id):
+        customers = self.connect().customers
+        customer = await read_cache.get_async(
+            ('customer', customer_id), lambda: customers.find_one({'customer_id': customer_id}, {'password': 0}))
+        if not customer:
+            return 404, {'message': 'Customer not found'}
+        return 200, customer_encoder(customer)
+
+    # Everything else: the Flask app on the thread pool
+
+    def environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        # The body has been read in full, whatever its transfer encoding was
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
+    async def call_wsgi(self, scope, receive, send, client_limited=False):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, body)
+        environ['orda.client_limited'] = client_limited
+        disconnected = threading.Event()
+
+        def relay(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            # One thread per request: streamed bodies run inside Flask's request
+            # context, which belongs to the thread that entered it
+            def start_response(status, headers, exc_info=None):
+                relay({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                       'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]})
+
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                # Streamed bodies (ndjson, event streams) are relayed chunk by chunk until the client leaves
+                for chunk in iterable:
+                    if disconnected.is_set():
+                        return
+                    if chunk:
+                        relay({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                relay({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        watcher = asyncio.ensure_future(self.wait_for_disconnect(receive, disconnected))
+        try:
+            await loop.run_in_executor(self.executor, run)
+        finally:
+            watcher.cancel()
+
+    async def wait_for_disconnect(self, receive, disconnected):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+app = OrdaASGI(flask_app)
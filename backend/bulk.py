@@ -0,0 +1,111 @@
+import os
+import uuid
+from jsonschema import Draft4Validator
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from flask_restx import abort
+
+# Largest array accepted by a single bulk request
+BULK_MAX_ROWS = int(os.environ.get('ORDA_BULK_MAX_ROWS', 10000))
+
+
+def row_validator(api, model):
+    '''Compile a jsonschema validator for one model, resolving nested models'''
+    schema = dict(model.__schema__)
+    schema['definitions'] = {name: m.__schema__ for name, m in api.models.items()}
+    return Draft4Validator(schema)
+
+
+def row_errors(validator, row):
+    '''Return {field: message} for every schema violation in a row'''
+    if not isinstance(row, dict):
+        return {'': 'Expected an object'}
+    return {'.'.join(str(p) for p in error.path) or error.validator: error.message
+            for error in validator.iter_errors(row)}
+
+
+def check_rows(rows):
+    '''Abort unless the payload is a non-empty array within BULK_MAX_ROWS'''
+    if not isinstance(rows, list) or not rows:
+        abort(400, 'Expected a non-empty JSON array')
+    if len(rows) > BULK_MAX_ROWS:
+        abort(413, f'At most {BULK_MAX_ROWS} rows per request')
+
+
+def bulk_insert(collection, rows, validator, id_field):
+    '''Validate rows and insert the valid ones with one unordered insert_many'''
+    check_rows(rows)
+    results = [None] * len(rows)
+    documents, positions = [], []
+    for index, row in enumerate(rows):
+        errors = row_errors(validator, row)
+        if errors:
+            results[index] = {'index': index, 'status': 400, 'errors': errors}
+            continue
+        documents.append({id_field: str(uuid.uuid4()), **row})
+        positions.append(index)
+
+    failed = {}
+    if documents:
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            failed = {error['index']: error['errmsg'] for error in exc.details['writeErrors']}
+
+    for n, (index, document) in enumerate(zip(positions, documents)):
+        if n in failed:
+            results[index] = {'index': index, 'status': 409, 'errors': {'': failed[n]}}
+        else:
+            results[index] = {'index': index, 'status': 201, 'id': document[id_field]}
+    return results, [d for n, d in enumerate(documents) if n not in failed]
+
+
+def bulk_update(collection, rows, validator, id_field, projection=None):
+    '''
+    Apply `$set` updates keyed by id_field with one unordered bulk_write.
+    Returns the per-row results and the matched documents as they were
+    before the update (limited to `projection`, default just the id).
+    '''
+    check_rows(rows)
+    results = [None] * len(rows)
+    updates = []
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict) or not isinstance(row.get(id_field), str):
+            results[index] = {'index': index, 'status': 400, 'errors': {id_field: f'{id_field} is required'}}
+            continue
+        fields = {k: v for k, v in row.items() if k != id_field}
+        errors = row_errors(validator, fields)
+        if errors:
+            results[index] = {'index': index, 'status': 400, 'errors': errors}
+            continue
+        updates.append((index, row[id_field], fields))
+
+    ids = [doc_id for _, doc_id, _ in updates]
+    existing = {doc[id_field]: doc for doc in collection.find(
+        {id_field: {'$in': ids}}, projection or {id_field: 1})} if ids else {}
+
+    operations = []
+    for index, doc_id, fields in updates:
+        if doc_id in existing:
+            operations.append(UpdateOne({id_field: doc_id}, {'$set': fields}))
+            results[index] = {'index': index, 'status': 200, 'id': doc_id}
+        else:
+            results[index] = {'index': index, 'status': 404, 'id': doc_id}
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return results, existing
+
+
+def bulk_delete(collection, ids, id_field, projection=None):
+    '''
+    Delete every listed id with a single delete_many. Returns the per-row
+    results and the deleted documents (limited to `projection`).
+    '''
+    check_rows(ids)
+    existing = {doc[id_field]: doc for doc in collection.find(
+        {id_field: {'$in': ids}}, projection or {id_field: 1})}
+    if existing:
+        collection.delete_many({id_field: {'$in': list(existing)}})
+    results = [{'index': index, 'status': 200 if doc_id in existing else 404, 'id': doc_id}
+               for index, doc_id in enumerate(ids)]
+    return results, existing
@@ -0,0 +1,146 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+
+# Returned by TTLCache.get() when the key is absent or expired, so that falsy
+# values (e.g. "this API key is invalid") can be cached as well
+MISSING = object()
+
+
+class TTLCache(object):
+    '''Thread-safe, size-bounded LRU cache whose entries expire after `ttl` seconds'''
+
+    def __init__(self, maxsize=1024, ttl=30.0, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self.timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self.timer() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class ReadCache(object):
+    '''
+    Per-process read-through cache of documents by key. Concurrent misses
+    for one key share a single load (single flight), from threads or from
+    coroutines; loaded documents are kept for `ttl` seconds, and with a ttl
+    of 0 reads are only coalesced. Writers call invalidate(): a load already
+    running when the key is invalidated is returned to its waiters but not
+    cached. None (not found) is never cached.
+    '''
+
+    def __init__(self, ttl=0.0, maxsize=10000, timer=time.monotonic):
+        self.values = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer) if ttl > 0 else None
+        self.hits = 0
+        self.loads = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        '''(cached value, flight to wait for, flight to run); exactly one is set'''
+        with self._lock:
+            if self.values is not None:
+                value = self.values.get(key)
+                if value is not MISSING:
+                    self.hits += 1
+                    return value, None, None
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return MISSING, flight, None
+            flight = self._flights[key] = Future()
+            self.loads += 1
+            return MISSING, None, flight
+
+    def _land(self, key, flight, value=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+                if error is None and value is not None and self.values is not None:
+                    self.values.set(key, value)
+        if error is None:
+            flight.set_result(value)
+        else:
+            flight.set_exception(error)
+
+    def get(self, key, load):
+        '''The document for `key`, calling load() only if no other thread is loading it'''
+        value, waiting, flight = self._lookup(key)
+        if waiting is not None:
+            return waiting.result()
+        if flight is None:
+            return value
+        try:
+            value = load()
+        except BaseException as exc:
+            self._land(key, flight, error=exc)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    async def get_async(self, key, load):
+        '''get() for coroutines: `load` is a coroutine function'''
+        value, waiting, flight = self._lookup(key)
+        if waiting is not None:
+            return await asyncio.wrap_future(waiting)
+        if flight is None:
+            return value
+        try:
+            value = await load()
+        except BaseException as exc:
+            self._land(key, flight, error=exc)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                # Whoever asks next loads afresh instead of joining the older read
+                self._flights.pop(key, None)
+                if self.values is not None:
+                    self.values.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._flights.clear()
+            if self.values is not None:
+                self.values.clear()
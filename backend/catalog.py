@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+from flask import current_app, request
+from pymongo import ReturnDocument
+from cache import MISSING, ReadCache, TTLCache
+from serializers import dumps
+
+# How often (seconds) a worker re-reads the shared catalog version; writes made
+# by the worker itself are visible immediately, other workers' within this window
+CATALOG_VERSION_INTERVAL = float(os.environ.get('ORDA_CATALOG_VERSION_INTERVAL', 1.0))
+CATALOG_CACHE_SIZE = int(os.environ.get('ORDA_CATALOG_CACHE_SIZE', 10000))
+# Orders change stock on every write; a worker bumps the version for them at
+# most once per this many seconds, so cached stock trails by no more than
+# this plus the version interval
+CATALOG_STOCK_INTERVAL = float(os.environ.get('ORDA_CATALOG_STOCK_INTERVAL', 1.0))
+
+# Document in the counters collection holding the catalog version
+CATALOG_VERSION_ID = 'catalog'
+
+
+class Catalog(object):
+    '''
+    Per-process cache of serialized item responses, keyed by the catalog
+    version stored in Mongo. The item write paths bump the version, which
+    retires every cached body and ETag in every worker. Orders report the
+    stock they take through stock_changed(), which bumps it too, debounced
+    so that a busy worker writes the counter about once per stock interval.
+    '''
+
+    def __init__(self, interval=CATALOG_VERSION_INTERVAL, maxsize=CATALOG_CACHE_SIZE, timer=time.monotonic,
+                 stock_interval=CATALOG_STOCK_INTERVAL):
+        self.interval = interval
+        self.stock_interval = stock_interval
+        self.timer = timer
+        self.version = None
+        self.checked = 0.0
+        self.stock_bumped = None
+        self._stock_flush = None
+        self.bodies = TTLCache(maxsize=maxsize, ttl=float('inf'), timer=timer)
+        # Concurrent misses for one body share a single load
+        self.loads = ReadCache()
+        self._lock = threading.Lock()
+
+    def _observe(self, version):
+        with self._lock:
+            if self.version is None or version > self.version:
+                if self.version is not None:
+                    # Bodies of older versions are never served again
+                    self.bodies.clear()
+                self.version = version
+            self.checked = self.timer()
+
+    def reset(self):
+        '''Forget the version and every cached body (e.g. after a database restore)'''
+        with self._lock:
+            self.version = None
+            self.stock_bumped = None
+            if self._stock_flush is not None:
+                self._stock_flush.cancel()
+                self._stock_flush = None
+            self.bodies.clear()
+            self.loads.clear()
+
+    def current_version(self, db):
+        '''The catalog version, re-read from Mongo at most once per interval'''
+        if self.version is None or self.timer() - self.checked >= self.interval:
+            document = db.counters.find_one({'_id': CATALOG_VERSION_ID})
+            self._observe(document['version'] if document else 0)
+        return self.version
+
+    def bump(self, db):
+        '''Record a change to the items collection'''
+        document = db.counters.find_one_and_update(
+            {'_id': CATALOG_VERSION_ID},
+            {'$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._observe(document['version'])
+
+    def stock_changed(self, db):
+        '''
+        Record stock taken or returned by an order. The first change after a
+        quiet stock interval bumps the version at once; later ones within it
+        share a single bump at the end of the interval.
+        '''
+        with self._lock:
+            if self._stock_flush is not None:
+                return
+            now = self.timer()
+            wait = 0 if self.stock_bumped is None else self.stock_bumped + self.stock_interval - now
+            if wait > 0:
+                self._stock_flush = threading.Timer(wait, self._flush_stock, (db,))
+                self._stock_flush.daemon = True
+                self._stock_flush.start()
+                return
+            self.stock_bumped = now
+        self.bump(db)
+
+    def _flush_stock(self, db):
+        with self._lock:
+            self._stock_flush = None
+            self.stock_bumped = self.timer()
+        self.bump(db)
+
+    def _encode(self, version, key, load):
+        data = load()
+        if data is None:
+            return None
+        body = dumps(data)
+        # A load that started before a newer version was seen is not kept
+        if version == self.version:
+            self.bodies.set((version, key), body)
+        return body
+
+    def response(self, db, key, load):
+        '''
+        Serve `key` at the current version: 304 when the client already has
+        it, the cached body when this worker has it, otherwise `load()` (which
+        returns a JSON-ready value, or None for a 404) is encoded and cached.
+        '''
+        version = self.current_version(db)
+        etag = f'{key}-v{version}'
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            body = self.bodies.get((version, key))
+            if body is MISSING:
+                body = self.loads.get((version, key), lambda: self._encode(version, key, load))
+                if body is None:
+                    return None
+            response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
@@ -0,0 +1,313 @@
+import os
+import json
+import queue
+import fcntl
+import tempfile
+import threading
+from werkzeug.wsgi import ClosingIterator
+from serializers import dumps
+
+# Journal shared by every worker on the host; events are appended here and
+# each worker tails it once for all of its subscribers
+EVENTS_FILE = os.environ.get('ORDA_EVENTS_FILE', os.path.join(tempfile.gettempdir(), 'orda-events.log'))
+# The journal is rotated to EVENTS_FILE.1 past this size; clients that fall
+# further behind than both files resume from the oldest event still kept
+EVENTS_MAX_BYTES = int(os.environ.get('ORDA_EVENTS_MAX_BYTES', 64 * 1024 * 1024))
+# How often (seconds) a worker checks the journal for events from other workers
+EVENTS_POLL_INTERVAL = float(os.environ.get('ORDA_EVENTS_POLL_INTERVAL', 0.1))
+# Seconds between keep-alive comments on an idle stream
+EVENTS_HEARTBEAT = float(os.environ.get('ORDA_EVENTS_HEARTBEAT', 15))
+# Events buffered per subscriber; a client that falls this far behind is
+# disconnected and catches up from the journal with Last-Event-ID
+EVENTS_QUEUE_SIZE = int(os.environ.get('ORDA_EVENTS_QUEUE_SIZE', 1000))
+# Client reconnection delay (milliseconds) sent at the start of every stream
+EVENTS_RETRY_MS = int(os.environ.get('ORDA_EVENTS_RETRY_MS', 1000))
+# Streams open at once per worker (0 for no limit); each holds a request
+# thread, so this must stay below the worker's threads or API calls queue
+# behind the screens. Clients beyond it get a 503 and retry.
+EVENTS_MAX_STREAMS = int(os.environ.get('ORDA_EVENTS_MAX_STREAMS', 16))
+
+
+class BrokerBusy(Exception):
+    '''Raised when EVENTS_MAX_STREAMS streams are already open in this process'''
+
+
+def order_event(before, after, encode):
+    '''The event for one (before, after) order change, with `encode` applied to the order'''
+    order = after if after is not None else before
+    if before is None:
+        kind = 'order.created'
+    elif after is None:
+        kind = 'order.deleted'
+    elif before.get('status') != after.get('status'):
+        kind = 'order.status'
+    else:
+        kind = 'order.updated'
+    return {
+        'type': kind,
+        'order_id': order.get('order_id'),
+        'customer_id': order.get('customer_id'),
+        'status': order.get('status'),
+        'order': encode(order),
+    }
+
+
+def event_filter(status=None, customer_id=None):
+    '''Predicate matching events by order status and/or customer'''
+    def match(event):
+        return ((status is None or event['status'] == status)
+                and (customer_id is None or event['customer_id'] == customer_id))
+    return match
+
+
+def format_event(event):
+    '''One SSE message'''
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['type'].encode(), dumps(event['order']))
+
+
+def _header(base):
+    return dumps({'base': base}) + b'\n'
+
+
+def _read_base(f):
+    '''Event id of the first byte of a journal file (its header line)'''
+    f.seek(0)
+    line = f.readline()
+    return json.loads(line)['base'] if line.endswith(b'\n') else None
+
+
+class Subscription(object):
+    def __init__(self, match, maxsize=EVENTS_QUEUE_SIZE):
+        self.match = match
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def get(self, timeout):
+        '''The next event, or None after `timeout` seconds'''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker(object):
+    '''
+    Publishes events to an append-only journal file and fans them out to the
+    subscribers in this process. An event's id is its position in the journal
+    (monotonic across rotations), so a reconnecting client resumes exactly
+    after the last id it saw.
+    '''
+
+    def __init__(self, path=EVENTS_FILE, max_bytes=EVENTS_MAX_BYTES, poll_interval=EVENTS_POLL_INTERVAL,
+                 queue_size=EVENTS_QUEUE_SIZE, max_streams=EVENTS_MAX_STREAMS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.subscribers = set()
+        self.streams = 0
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._file = None
+        self._base = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+
+    def _locked(self):
+        '''Exclusive lock shared by every process writing the journal'''
+        lock = open(self.path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _open_journal(self):
+        '''The journal (created if needed), positioned after its last complete event'''
+        with self._locked():
+            if not os.path.exists(self.path):
+                with open(self.path, 'ab') as f:
+                    f.write(_header(0))
+            f = open(self.path, 'rb')
+            base = _read_base(f)
+            f.seek(0, os.SEEK_END)
+        return f, base
+
+    def publish(self, events):
+        '''Append events to the journal; returns them with their ids set'''
+        if not events:
+            return []
+        with self._locked():
+            f = open(self.path, 'ab+')
+            try:
+                size = f.seek(0, os.SEEK_END)
+                base = _read_base(f) if size else 0
+                if not size:
+                    size = f.write(_header(0))
+                elif size >= self.max_bytes:
+                    f.close()
+                    os.replace(self.path, self.path + '.1')
+                    base += size
+                    f = open(self.path, 'ab+')
+                    size = f.write(_header(base))
+                lines = []
+                for event in events:
+                    event = {'id': base + size, **event}
+                    line = dumps(event) + b'\n'
+                    size += len(line)
+                    lines.append(line)
+                f.seek(0, os.SEEK_END)
+                f.write(b''.join(lines))
+            finally:
+                f.close()
+        self.published += len(lines)
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return [json.loads(line) for line in lines]
+
+    def _start(self):
+        # Called with self._lock held; (re)started lazily, also in forked workers
+        if self._pid == os.getpid():
+            return
+        self._file, self._base = self._open_journal()
+        self._pid = os.getpid()
+        threading.Thread(target=self._follow, name='event-broker', daemon=True).start()
+
+    @property
+    def position(self):
+        '''Id the next event appended to the journal will get'''
+        return self._base + self._file.tell()
+
+    def _follow(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            with self._wakeup:
+                self._wakeup.wait(self.poll_interval)
+            self.poll()
+
+    def poll(self):
+        '''Deliver events appended since the last poll to matching subscribers'''
+        with self._lock:
+            rotated = False
+            while True:
+                start = self.position
+                line = self._file.readline()
+                if line.endswith(b'\n'):
+                    event = json.loads(line)
+                    event['id'] = start
+                    self._dispatch(event)
+                    continue
+                if line:
+                    # a write in progress in another process; finish it next time
+                    self._file.seek(-len(line), os.SEEK_CUR)
+                    break
+                if rotated:
+                    # The old file is fully read; carry on from the new one's first event
+                    self._file.close()
+                    self._file = open(self.path, 'rb')
+                    self._base = _read_base(self._file)
+                    rotated = False
+                    continue
+                try:
+                    rotated = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+                except FileNotFoundError:
+                    rotated = False
+                if not rotated:
+                    break
+                # Events may have reached the old file between the read above and
+                # its rotation; nothing is written to it any more, so read it to
+                # the end once more before switching
+
+    def _dispatch(self, event):
+        for subscription in list(self.subscribers):
+            if not subscription.match(event):
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.overflowed = True
+                self.subscribers.discard(subscription)
+                self.dropped += 1
+
+    def subscribe(self, match, last_id=None):
+        '''
+        Register a subscriber. Returns it along with the events after
+        `last_id` that are already in the journal (empty without last_id);
+        everything later arrives through the subscription's queue.
+        '''
+        subscription = Subscription(match, self.queue_size)
+        with self._lock:
+            self._start()
+            self.subscribers.add(subscription)
+            until = self.position
+        backlog = [] if last_id is None else [e for e in self.replay(last_id, until) if match(e)]
+        return subscription, backlog
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+
+    def replay(self, after, until):
+        '''Events with after < id < until still held in the journal files'''
+        for path in (self.path + '.1', self.path):
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                base = _read_base(f)
+                if base is None:
+                    continue
+                if after >= base:
+                    f.seek(after - base)
+                    f.readline()  # the event the client already has, or the header
+                while True:
+                    start = base + f.tell()
+                    line = f.readline()
+                    if start >= until or not line.endswith(b'\n'):
+                        break
+                    event = json.loads(line)
+                    event['id'] = start
+                    if after < start:
+                        yield event
+
+    def stream(self, match, last_id=None, heartbeat=EVENTS_HEARTBEAT):
+        '''
+        SSE body: missed events first, then live ones, with keep-alives while
+        idle. Raises BrokerBusy when max_streams streams are already open; the
+        slot is given back when the body is closed.
+        '''
+        with self._lock:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.rejected += 1
+                raise BrokerBusy()
+            self.streams += 1
+        try:
+            subscription, backlog = self.subscribe(match, last_id)
+        except BaseException:
+            with self._lock:
+                self.streams -= 1
+            raise
+        closed = []
+
+        def close():
+            # Also runs for a body that was never iterated
+            self.unsubscribe(subscription)
+            with self._lock:
+                if not closed:
+                    closed.append(True)
+                    self.streams -= 1
+
+        return ClosingIterator(self._messages(subscription, backlog, heartbeat), close)
+
+    def _messages(self, subscription, backlog, heartbeat):
+        try:
+            yield b'retry: %d\n\n' % EVENTS_RETRY_MS
+            for event in backlog:
+                yield format_event(event)
+            while not subscription.overflowed:
+                event = subscription.get(heartbeat)
+                yield b': keep-alive\n\n' if event is None else format_event(event)
+            # Too slow to keep up: drop the connection and let the client resume with Last-Event-ID
+        finally:
+            self.unsubscribe(subscription)
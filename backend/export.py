@@ -0,0 +1,145 @@
+import io
+import os
+import csv
+import zlib
+import itertools
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import DESCENDING
+from serializers import dumps
+
+# Documents pulled from Mongo per getMore, and bytes of output gathered
+# before each write to the client
+EXPORT_BATCH_SIZE = int(os.environ.get('ORDA_EXPORT_BATCH_SIZE', 1000))
+EXPORT_CHUNK_BYTES = int(os.environ.get('ORDA_EXPORT_CHUNK_BYTES', 64 * 1024))
+
+# Orders with an _id from the last this many seconds are left for the next
+# export. ObjectIds are made by each client from its own clock, so an order
+# inserted by another worker or host during an export can get an _id just
+# below the newest one; the lag has to cover clock skew and slow inserts.
+EXPORT_WATERMARK_LAG = float(os.environ.get('ORDA_EXPORT_WATERMARK_LAG', 60))
+
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# One CSV row per order line; orders without lines get one row with empty item columns
+CSV_COLUMNS = ['order_id', 'customer_id', 'date', 'status', 'total', 'item_id', 'item_name', 'quantity', 'price']
+
+# Query string parameters of the export route (for Swagger)
+export_params = {
+    'format': 'ndjson (one order per line) or csv (one row per order line)',
+    'from': 'First order date (YYYY-MM-DD)',
+    'to': 'Last order date (YYYY-MM-DD)',
+    'since': 'Only orders created after this watermark (X-Export-Watermark of a previous export)',
+    'gzip': 'true to gzip the file',
+    'archived': 'true to include archived orders'
+}
+
+
+def parse_export_args(args):
+    '''(fmt, date_from, date_to, since, gzip) from a query string mapping; raises ValueError with the 400 message'''
+    fmt = args.get('format') or 'ndjson'
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('format must be one of: ' + ', '.join(EXPORT_FORMATS))
+    since = args.get('since')
+    if since:
+        if not ObjectId.is_valid(since):
+            raise ValueError('Invalid watermark')
+        since = ObjectId(since)
+    gzip = (args.get('gzip') or '').lower() in ('1', 'true', 'yes')
+    return fmt, args.get('from') or None, args.get('to') or None, since or None, gzip
+
+
+def export_watermark(collections, lag=None, now=None):
+    '''
+    Where the export stops and the next one starts: the newest order _id,
+    held back to `lag` seconds ago so that orders still being inserted with
+    slightly older ids are not skipped for good
+    '''
+    newest = None
+    for collection in collections:
+        for order in collection.find({}, {'_id': 1}).sort('_id', DESCENDING).limit(1):
+            newest = order['_id'] if newest is None else max(newest, order['_id'])
+    if newest is None:
+        return None
+    lag = EXPORT_WATERMARK_LAG if lag is None else lag
+    cutoff = ObjectId.from_datetime((now or datetime.now(timezone.utc)) - timedelta(seconds=lag))
+    return min(newest, cutoff)
+
+
+def export_query(until, since=None, date_from=None, date_to=None):
+    query = {'_id': {'$lte': until}}
+    if since is not None:
+        query['_id']['$gt'] = since
+    bounds = {}
+    if date_from:
+        bounds['$gte'] = date_from
+    if date_to:
+        # Dates may carry a time; keep the whole last day
+        bounds['$lte'] = date_to + '\uffff'
+    if bounds:
+        query['date'] = bounds
+    return query
+
+
+def export_cursors(collections, since=None, date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    '''
+    (cursors, watermark) for the orders to export, in _id order per collection.
+    Orders created while the export runs, or in the EXPORT_WATERMARK_LAG
+    before it, are left for the next one; with nothing to read the
+    watermark is `since`.
+    '''
+    until = export_watermark(collections)
+    if until is None or (since is not None and until <= since):
+        return [], since
+    query = export_query(until, since, date_from, date_to)
+    return [c.find(query).sort('_id', 1).batch_size(batch_size) for c in collections], until
+
+
+def csv_rows(order):
+    '''The flattened rows of one order'''
+    head = [order.get('order_id'), order.get('customer_id'), order.get('date'), order.get('status'), order.get('total')]
+    lines = order.get('items') or [{}]
+    return [head + [line.get('item_id'), line.get('name'), line.get('quantity'), line.get('price')] for line in lines]
+
+
+def export_chunks(cursors, fmt='ndjson', encode=None, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+    '''
+    Yield the export as byte chunks of about `chunk_bytes`, gzipped when
+    `compress` is set. Only one batch of documents and one chunk are held
+    at a time, whatever the size of the export. `encode` shapes each order
+    for NDJSON (e.g. the API's order serializer).
+    '''
+    orders = itertools.chain.from_iterable(cursors)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    encode = encode or (lambda order: order)
+    buffer = io.StringIO(newline='') if fmt == 'csv' else io.BytesIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+
+    def take():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        if fmt == 'csv':
+            data = data.encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    try:
+        if writer:
+            writer.writerow(CSV_COLUMNS)
+        for order in orders:
+            if writer:
+                writer.writerows(csv_rows(order))
+            else:
+                buffer.write(dumps(encode(order)) + b'\n')
+            if buffer.tell() >= chunk_bytes:
+                data = take()
+                if data:
+                    yield data
+        data = take()
+        if compressor:
+            data += compressor.flush()
+        if data:
+            yield data
+    finally:
+        for cursor in cursors:
+            cursor.close()
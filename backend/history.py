@@ -0,0 +1,135 @@
+import json
+import base64
+from bson import ObjectId
+from pymongo import DESCENDING, UpdateOne
+from archive import ARCHIVE_COLLECTION
+
+# Field on the customer document holding the running order totals
+SUMMARY_FIELD = 'order_summary'
+
+# Rows written per bulk_write while rebuilding
+REBUILD_BATCH_SIZE = 1000
+
+EMPTY_SUMMARY = {'orders': 0, 'spend': 0, 'last_order_date': None}
+
+
+def summary_changes(changes):
+    '''
+    Fold (before, after) order pairs into per-customer increments. Returns
+    ({customer_id: {'orders', 'spend', 'last_order_date'}}, customers whose
+    last order date may have been removed and has to be looked up again).
+    '''
+    totals, recheck = {}, set()
+    for before, after in changes:
+        if before:
+            row = totals.setdefault(before.get('customer_id'), dict(EMPTY_SUMMARY))
+            row['orders'] -= 1
+            row['spend'] -= before.get('total') or 0
+            if not after or after.get('customer_id') != before.get('customer_id') or after.get('date') != before.get('date'):
+                recheck.add(before.get('customer_id'))
+        if after:
+            row = totals.setdefault(after.get('customer_id'), dict(EMPTY_SUMMARY))
+            row['orders'] += 1
+            row['spend'] += after.get('total') or 0
+            if after.get('date') and (row['last_order_date'] is None or after['date'] > row['last_order_date']):
+                row['last_order_date'] = after['date']
+    return totals, recheck
+
+
+def apply_summaries(db, changes):
+    '''Keep each customer's order_summary in step with a list of (before, after) order pairs'''
+    totals, recheck = summary_changes(changes)
+    updates = []
+    for customer_id, row in totals.items():
+        update = {}
+        increments = {f'{SUMMARY_FIELD}.{field}': row[field] for field in ('orders', 'spend') if row[field]}
+        if increments:
+            update['$inc'] = increments
+        if row['last_order_date'] and customer_id not in recheck:
+            update['$max'] = {f'{SUMMARY_FIELD}.last_order_date': row['last_order_date']}
+        if update:
+            updates.append(UpdateOne({'customer_id': customer_id}, update))
+    if updates:
+        db.customers.bulk_write(updates, ordered=False)
+
+    # An order left this customer; its latest remaining order is one indexed lookup away
+    for customer_id in recheck:
+        latest = None
+        for collection in (db.orders, db[ARCHIVE_COLLECTION]):
+            latest = collection.find_one({'customer_id': customer_id}, {'date': 1},
+                                         sort=[('date', DESCENDING), ('_id', DESCENDING)])
+            if latest:
+                break
+        db.customers.update_one({'customer_id': customer_id},
+                                {'$set': {f'{SUMMARY_FIELD}.last_order_date': latest.get('date') if latest else None}})
+
+
+def rebuild_summaries(db, batch_size=REBUILD_BATCH_SIZE):
+    '''Recompute every customer's order_summary from the live and archived orders'''
+    summaries = {}
+    for collection in (db.orders, db[ARCHIVE_COLLECTION]):
+        for row in collection.aggregate([
+            {'$group': {'_id': '$customer_id', 'orders': {'$sum': 1}, 'spend': {'$sum': '$total'},
+                        'last_order_date': {'$max': '$date'}}},
+        ]):
+            summary = summaries.setdefault(row['_id'], dict(EMPTY_SUMMARY))
+            summary['orders'] += row['orders']
+            summary['spend'] += row['spend']
+            if row['last_order_date'] and (summary['last_order_date'] is None
+                                           or row['last_order_date'] > summary['last_order_date']):
+                summary['last_order_date'] = row['last_order_date']
+    db.customers.update_many({}, {'$set': {SUMMARY_FIELD: EMPTY_SUMMARY}})
+    updates = [UpdateOne({'customer_id': customer_id}, {'$set': {SUMMARY_FIELD: summary}})
+               for customer_id, summary in summaries.items()]
+    for start in range(0, len(updates), batch_size):
+        db.customers.bulk_write(updates[start:start + batch_size], ordered=False)
+    return len(updates)
+
+
+def encode_cursor(order):
+    '''Opaque position after `order` in (date, _id) order'''
+    raw = json.dumps([order.get('date'), str(order['_id'])]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''(date, ObjectId) from encode_cursor(); raises ValueError for anything else'''
+    try:
+        date, oid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not ObjectId.is_valid(oid):
+        raise ValueError('Invalid cursor')
+    return date, ObjectId(oid)
+
+
+def find_history(db, customer_id, limit, after=None, status=None, date_from=None, date_to=None, collections=None):
+    '''
+    One page of a customer's orders, newest first, walking the
+    (customer_id, date, _id) index of each collection (default: orders).
+    Returns (orders, next_cursor).
+    '''
+    query = {'customer_id': customer_id}
+    if status:
+        query['status'] = status
+    bounds = {}
+    if date_from:
+        bounds['$gte'] = date_from
+    if date_to:
+        # Dates may carry a time; keep the whole last day
+        bounds['$lte'] = date_to + '\uffff'
+    if bounds:
+        query['date'] = bounds
+    if after is not None:
+        date, oid = after
+        query['$or'] = [{'date': {'$lt': date}}, {'date': date, '_id': {'$lt': oid}}]
+
+    orders = []
+    for collection in collections or [db.orders]:
+        orders += collection.find(query).sort([('date', DESCENDING), ('_id', DESCENDING)]).limit(limit + 1)
+    orders.sort(key=lambda order: (order.get('date') or '', order['_id']), reverse=True)
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1])
+    return orders, next_cursor
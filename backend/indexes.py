@@ -0,0 +1,126 @@
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Every index the API relies on, per collection. create_indexes() is a no-op
+# for indexes that already exist with the same spec, so applying this
+# registry repeatedly is safe.
+INDEXES = {
+    'orders': [
+        IndexModel([('order_id', ASCENDING)], name='order_id_unique', unique=True),
+        # Customer order history: equality on customer_id, then (date, _id) keyset order
+        IndexModel([('customer_id', ASCENDING), ('date', ASCENDING), ('_id', ASCENDING)], name='customer_id_date_id'),
+        # Archival job: terminal statuses older than the cutoff
+        IndexModel([('status', ASCENDING), ('date', ASCENDING)], name='status_date'),
+    ],
+    'orders_archive': [
+        IndexModel([('order_id', ASCENDING)], name='order_id_unique', unique=True),
+        IndexModel([('customer_id', ASCENDING), ('date', ASCENDING), ('_id', ASCENDING)], name='customer_id_date_id'),
+    ],
+    'customers': [
+        IndexModel([('customer_id', ASCENDING)], name='customer_id_unique', unique=True),
+        IndexModel([('email', ASCENDING)], name='email'),
+    ],
+    'items': [
+        IndexModel([('item_id', ASCENDING)], name='item_id_unique', unique=True),
+        IndexModel([('stock', ASCENDING)], name='stock'),
+    ],
+    'api_keys': [
+        IndexModel([('key', ASCENDING), ('active', ASCENDING)], name='key_active'),
+        IndexModel([('key_id', ASCENDING)], name='key_id_unique', unique=True),
+    ],
+    # Reporting rollups, one row per day and key
+    'sales_daily_item': [
+        IndexModel([('date', ASCENDING), ('item_id', ASCENDING)], name='date_item_id_unique', unique=True),
+    ],
+    'sales_daily_customer': [
+        IndexModel([('date', ASCENDING), ('customer_id', ASCENDING)], name='date_customer_id_unique', unique=True),
+    ],
+    'orders_daily_status': [
+        IndexModel([('date', ASCENDING), ('status', ASCENDING)], name='date_status_unique', unique=True),
+    ],
+}
+
+# Indexes replaced by an entry above; ensure_indexes() drops them so older
+# deployments stop paying their write cost
+RETIRED_INDEXES = {
+    # Superseded by customer_id_date_id, which adds _id for keyset paging
+    'orders': ['customer_id_date'],
+}
+
+# Server error code for dropping an index that is already gone, e.g. dropped
+# by another worker starting at the same time
+INDEX_NOT_FOUND = 27
+
+# The filter each route sends to Mongo, used by check_indexes() to make sure
+# none of them falls back to a collection scan.
+QUERY_SHAPES = [
+    ('orders', {'order_id': ''}),
+    ('orders', {'customer_id': ''}),
+    ('orders', {'status': {'$in': ['']}, 'date': {'$lt': ''}}),
+    ('orders_archive', {'order_id': ''}),
+    ('orders_archive', {'customer_id': ''}),
+    ('customers', {'customer_id': ''}),
+    ('customers', {'email': ''}),
+    ('items', {'item_id': ''}),
+    ('api_keys', {'key': '', 'active': True}),
+    ('items', {'stock': {'$lte': 0}}),
+    ('sales_daily_item', {'date': {'$gte': '', '$lte': ''}}),
+    ('sales_daily_customer', {'date': {'$gte': '', '$lte': ''}}),
+    ('orders_daily_status', {'date': {'$gte': '', '$lte': ''}}),
+]
+
+
+def drop_retired_indexes(db):
+    '''Drop the RETIRED_INDEXES still present, returning the names this call dropped per collection'''
+    dropped = {}
+    for collection, names in RETIRED_INDEXES.items():
+        present = db[collection].index_information()
+        dropped[collection] = []
+        for name in names:
+            if name not in present:
+                continue
+            try:
+                db[collection].drop_index(name)
+            except OperationFailure as exc:
+                if exc.code != INDEX_NOT_FOUND:
+                    raise
+                continue
+            dropped[collection].append(name)
+    return dropped
+
+
+def create_indexes(db):
+    '''Create any missing index from INDEXES, returning the created names per collection'''
+    created = {}
+    for collection, indexes in INDEXES.items():
+        created[collection] = db[collection].create_indexes(indexes)
+    return created
+
+
+def ensure_indexes(db):
+    '''Drop retired indexes and create any missing index from INDEXES, returning the created names per collection'''
+    drop_retired_indexes(db)
+    return create_indexes(db)
+
+
+def plan_stages(plan):
+    '''Yield every stage name found in an explain() plan tree'''
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def check_indexes(db):
+    '''Explain every query shape and return the ones still doing a COLLSCAN'''
+    failures = []
+    for collection, query in QUERY_SHAPES:
+        explain = db[collection].find(query).explain()
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in plan_stages(winning_plan):
+            failures.append((collection, query))
+    return failures
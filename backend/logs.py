@@ -0,0 +1,35 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FILE = os.environ.get('ORDA_LOG_FILE', 'app.log')
+LOG_LEVEL = os.environ.get('ORDA_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s'
+
+
+def configure_logging(filename=LOG_FILE, level=LOG_LEVEL):
+    '''
+    Send log records through a queue to a background thread that writes the
+    file, so request threads never block on log I/O. Returns the listener,
+    which must be restarted in a process forked after this call.
+    '''
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def restart_listener(listener):
+    '''Start the writer thread of a listener inherited through fork, where it is not running'''
+    listener._thread = None
+    listener.start()
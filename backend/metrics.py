@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import glob
+import threading
+from pymongo import monitoring
+
+# Where each gunicorn worker drops its metrics snapshot so that /metrics can
+# report totals for the whole server; unset means single-process metrics
+METRICS_DIR = os.environ.get('ORDA_METRICS_DIR')
+# Seconds between snapshot writes per worker (a scrape always writes its own)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('ORDA_METRICS_FLUSH_INTERVAL', 1.0))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HELP = {
+    'orda_http_requests_total': ('counter', 'HTTP requests by route, method and status'),
+    'orda_http_request_duration_seconds': ('histogram', 'Time spent handling a request'),
+    'orda_http_response_size_bytes': ('histogram', 'Response body size'),
+    'orda_http_requests_in_flight': ('gauge', 'Requests currently being handled'),
+    'orda_mongo_request_duration_seconds': ('histogram', 'Time spent in Mongo commands per request'),
+    'orda_mongo_commands_total': ('counter', 'Mongo commands by command name and outcome'),
+    'orda_cache_hits_total': ('counter', 'Cache hits by cache'),
+    'orda_cache_misses_total': ('counter', 'Cache misses by cache'),
+    'orda_reads_coalesced_total': ('counter', 'Reads that joined a load already running for the same key, by cache'),
+    'orda_password_hash_rejected_total': ('counter', 'Password hashes refused because the pool was saturated'),
+    'orda_events_published_total': ('counter', 'Order events written to the journal'),
+    'orda_rate_limited_total': ('counter', 'Requests refused with 429 by the rate limiter'),
+    'orda_events_dropped_subscribers_total': ('counter', 'Event streams closed because the client fell behind'),
+    'orda_events_rejected_streams_total': ('counter', 'Event streams refused because the worker had too many open'),
+}
+
+
+class Registry(object):
+    '''Counters, gauges and histograms for one process'''
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def register_collector(self, collector):
+        '''Add a callable returning (name, labels, value) counters read at snapshot time'''
+        self.collectors.append(collector)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set_gauge(self, name, labels=(), value=0):
+        with self._lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets),
+                                                    'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        '''JSON-ready copy of every metric'''
+        collected = [[name, list(labels), value] for collector in self.collectors
+                     for name, labels, value in collector()]
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()] + collected,
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, list(labels), dict(h, counts=list(h['counts']))]
+                               for (name, labels), h in self.histograms.items()],
+            }
+
+
+def merge(snapshots):
+    '''Sum a list of snapshots into one'''
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['gauges']:
+            key = (name, tuple(map(tuple, labels)))
+            gauges[key] = gauges.get(key, 0) + value
+        for name, labels, h in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, {'buckets': h['buckets'], 'counts': [0] * len(h['counts']),
+                                                'sum': 0.0, 'count': 0})
+            total['counts'] = [a + b for a, b in zip(total['counts'], h['counts'])]
+            total['sum'] += h['sum']
+            total['count'] += h['count']
+    return counters, gauges, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render(counters, gauges, histograms):
+    '''Prometheus text exposition format (0.0.4)'''
+    lines = []
+    for name, (kind, description) in HELP.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        elif kind == 'gauge':
+            for (metric, labels), value in sorted(gauges.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        else:
+            for (metric, labels), h in sorted(histograms.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(h['buckets'], h['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {h["count"]}')
+                lines.append(f'{name}_sum{_labels(labels)} {h["sum"]}')
+                lines.append(f'{name}_count{_labels(labels)} {h["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsStore(object):
+    '''Shares per-worker snapshots through files in METRICS_DIR'''
+
+    def __init__(self, directory=METRICS_DIR, interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.flushed = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def flush(self, registry, force=False):
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self.flushed < self.interval:
+            return
+        self.flushed = now
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self, registry):
+        '''Merge every worker's snapshot; gauges of exited workers are dropped'''
+        if not self.directory:
+            return merge([registry.snapshot()])
+        self.flush(registry, force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _alive(snapshot['pid']):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return merge(snapshots)
+
+
+class MongoTimer(monitoring.CommandListener):
+    '''Counts Mongo commands and adds their duration to the current request'''
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.local = threading.local()
+
+    def start_request(self):
+        self.local.seconds = 0.0
+
+    def request_seconds(self):
+        return getattr(self.local, 'seconds', 0.0)
+
+    def _finished(self, event, outcome):
+        self.local.seconds = self.request_seconds() + event.duration_micros / 1e6
+        self.registry.inc('orda_mongo_commands_total', (('command', event.command_name), ('outcome', outcome)))
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._finished(event, 'success')
+
+    def failed(self, event):
+        self._finished(event, 'failure')
+
+
+def route_labels(request):
+    '''(namespace, route, method) labels; unmatched URLs share one label'''
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    parts = rule.split('/')
+    namespace = parts[3] if rule.startswith('/api/v1/') and len(parts) > 3 else 'other'
+    return (('namespace', namespace), ('route', rule), ('method', request.method))
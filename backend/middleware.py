@@ -0,0 +1,57 @@
+import os
+
+# How long (seconds) browsers may cache a preflight answer
+CORS_MAX_AGE = int(os.environ.get('ORDA_CORS_MAX_AGE', 7200))
+
+# Response headers browser clients may read
+EXPOSE_HEADERS = ','.join(['ETag', 'X-Export-Watermark', 'Retry-After',
+                           'X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset'])
+
+REDIRECT_STATUSES = ('301', '302', '303', '307', '308')
+
+
+class EdgeMiddleware(object):
+    '''
+    WSGI middleware in front of the Flask app. It answers CORS preflights
+    without routing, serves /api/ paths with or without a trailing slash
+    (no 308 round trip) and sets every CORS and security header in one place.
+    '''
+
+    def __init__(self, app, allow_origin='*', allow_headers='Content-Type,Authorization',
+                 allow_methods='GET,POST,PUT,DELETE,OPTIONS', expose_headers=EXPOSE_HEADERS,
+                 max_age=CORS_MAX_AGE):
+        self.app = app
+        self.headers = [
+            ('Access-Control-Allow-Origin', allow_origin),
+            ('Access-Control-Allow-Headers', allow_headers),
+            ('Access-Control-Allow-Methods', allow_methods),
+            ('Access-Control-Expose-Headers', expose_headers),
+            ('Referrer-Policy', 'no-referrer'),
+        ]
+        self.preflight_headers = self.headers + [
+            ('Access-Control-Max-Age', str(max_age)),
+            ('Content-Length', '0'),
+        ]
+        self.managed = {name.lower() for name, _ in self.headers}
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith('/api/') and path.endswith('/'):
+            environ['PATH_INFO'] = path.rstrip('/')
+
+        if environ['REQUEST_METHOD'] == 'OPTIONS' and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ:
+            start_response('204 No Content', list(self.preflight_headers))
+            return [b'']
+
+        # Redirects from behind a TLS-terminating proxy keep the https scheme
+        rewrite_location = (environ.get('wsgi.url_scheme') == 'http'
+                            and not environ.get('HTTP_HOST', '').startswith('localhost'))
+
+        def edge_start_response(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers if name.lower() not in self.managed]
+            if rewrite_location and status[:3] in REDIRECT_STATUSES:
+                headers = [(name, value.replace('http://', 'https://', 1) if name.lower() == 'location' else value)
+                           for name, value in headers]
+            return start_response(status, headers + self.headers, exc_info)
+
+        return self.app(environ, edge_start_response)
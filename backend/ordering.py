@@ -0,0 +1,156 @@
+import os
+import uuid
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from flask_restx import abort
+from bulk import check_rows, row_errors
+
+# Each item keeps the ids of its most recent reservations so that a failed
+# order can give back exactly the stock it took, without a transaction
+RESERVATION_LOG_SIZE = int(os.environ.get('ORDA_RESERVATION_LOG_SIZE', 100))
+
+
+def line_error(data):
+    '''The 400 message for an order's lines, or None when they are valid'''
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return 'An order needs at least one item'
+    for line in items:
+        item_id = line.get('item_id') if isinstance(line, dict) else None
+        quantity = line.get('quantity') if isinstance(line, dict) else None
+        if not isinstance(item_id, str) or not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return 'Every item needs an item_id and a positive integer quantity'
+    return None
+
+
+def order_lines(data):
+    '''Validate the requested lines and sum quantities per item_id'''
+    error = line_error(data)
+    if error:
+        abort(400, error)
+
+    quantities = {}
+    for line in data['items']:
+        quantities[line['item_id']] = quantities.get(line['item_id'], 0) + line['quantity']
+    return quantities
+
+
+def release_stock(items, quantities, order_id):
+    '''Give back the stock taken by order_id on the items it actually reserved'''
+    items.bulk_write([
+        UpdateOne({'item_id': item_id, 'reservations': order_id},
+                  {'$inc': {'stock': quantity}, '$pull': {'reservations': order_id}})
+        for item_id, quantity in quantities.items()
+    ], ordered=False)
+
+
+def reserve_stock(items, quantities, order_id):
+    '''Take stock for every line with one guarded bulk write; gives it all back and returns False if any is short'''
+    result = items.bulk_write([
+        UpdateOne({'item_id': item_id, 'stock': {'$gte': quantity}},
+                  {'$inc': {'stock': -quantity},
+                   '$push': {'reservations': {'$each': [order_id], '$slice': -RESERVATION_LOG_SIZE}}})
+        for item_id, quantity in quantities.items()
+    ], ordered=False)
+    if result.modified_count < len(quantities):
+        release_stock(items, quantities, order_id)
+        return False
+    return True
+
+
+def priced_order(data, quantities, order_id, catalog):
+    '''The order document, with names and prices taken from `catalog`'''
+    lines = [{
+        'item_id': item_id,
+        'name': catalog[item_id].get('name'),
+        'quantity': quantity,
+        'price': catalog[item_id]['price']
+    } for item_id, quantity in quantities.items()]
+
+    return {
+        **data,
+        'order_id': order_id,
+        'items': lines,
+        'total': round(sum(line['price'] * line['quantity'] for line in lines), 2)
+    }
+
+
+def find_catalog(db, item_ids):
+    '''Name and price of each known item among item_ids, by item_id'''
+    return {item['item_id']: item for item in db.items.find(
+        {'item_id': {'$in': list(item_ids)}}, {'_id': 0, 'item_id': 1, 'name': 1, 'price': 1})}
+
+
+def place_order(db, data):
+    '''
+    Price the order from the catalog, reserve stock with one guarded bulk
+    write and insert the order. Nothing is kept if any line can't be filled.
+    '''
+    quantities = order_lines(data)
+    order_id = str(uuid.uuid4())
+
+    catalog = find_catalog(db, quantities)
+    unknown = [item_id for item_id in quantities if item_id not in catalog]
+    if unknown:
+        abort(400, 'Unknown items', item_ids=unknown)
+
+    if not reserve_stock(db.items, quantities, order_id):
+        abort(409, 'Insufficient stock')
+
+    order = priced_order(data, quantities, order_id, catalog)
+    try:
+        db.orders.insert_one(order)
+    except PyMongoError:
+        release_stock(db.items, quantities, order_id)
+        raise
+    return order
+
+
+def place_orders(db, rows, validator):
+    '''
+    Bulk place_order: one catalog query for every row, a guarded stock
+    reservation per row (rolled back on its own when a line is short) and
+    one unordered insert_many. Returns the per-row results and the orders
+    inserted.
+    '''
+    check_rows(rows)
+    results = [None] * len(rows)
+    valid = []
+    for index, row in enumerate(rows):
+        errors = row_errors(validator, row)
+        error = None if errors else line_error(row)
+        if error:
+            errors = {'items': error}
+        if errors:
+            results[index] = {'index': index, 'status': 400, 'errors': errors}
+            continue
+        valid.append((index, row, order_lines(row)))
+
+    catalog = find_catalog(db, {item_id for _, _, quantities in valid for item_id in quantities})
+    orders, reserved = [], []
+    for index, row, quantities in valid:
+        unknown = [item_id for item_id in quantities if item_id not in catalog]
+        if unknown:
+            results[index] = {'index': index, 'status': 400, 'errors': {'items': 'Unknown items: ' + ', '.join(unknown)}}
+            continue
+        order_id = str(uuid.uuid4())
+        if not reserve_stock(db.items, quantities, order_id):
+            results[index] = {'index': index, 'status': 409, 'errors': {'items': 'Insufficient stock'}}
+            continue
+        orders.append(priced_order(row, quantities, order_id, catalog))
+        reserved.append((index, quantities))
+
+    failed = {}
+    if orders:
+        try:
+            db.orders.insert_many(orders, ordered=False)
+        except BulkWriteError as exc:
+            failed = {error['index']: error['errmsg'] for error in exc.details['writeErrors']}
+
+    for n, ((index, quantities), order) in enumerate(zip(reserved, orders)):
+        if n in failed:
+            release_stock(db.items, quantities, order['order_id'])
+            results[index] = {'index': index, 'status': 409, 'errors': {'': failed[n]}}
+        else:
+            results[index] = {'index': index, 'status': 201, 'id': order['order_id']}
+    return results, [order for n, order in enumerate(orders) if n not in failed]
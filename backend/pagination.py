@@ -0,0 +1,126 @@
+import os
+import itertools
+from bson import ObjectId
+from flask import Response, request, stream_with_context
+from flask_restx import abort
+from serializers import dumps, json_response, serializer
+
+# Page sizes for keyset pagination on the list endpoints
+DEFAULT_PAGE_SIZE = int(os.environ.get('ORDA_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('ORDA_MAX_PAGE_SIZE', 1000))
+
+# Number of documents pulled from Mongo per getMore while streaming
+STREAM_BATCH_SIZE = int(os.environ.get('ORDA_STREAM_BATCH_SIZE', 500))
+
+STREAM_FORMATS = ('ndjson', 'json')
+
+# Query string parameters shared by every paginated list route (for Swagger)
+list_params = {
+    'limit': 'Page size; the response becomes {"items": [...], "next": cursor}',
+    'after': 'Cursor returned as `next` by the previous page',
+    'stream': 'Stream the whole collection as `ndjson` or a chunked `json` array'
+}
+
+
+def parse_page_args(args):
+    '''(limit, after, stream) from a query string mapping; raises ValueError with the 400 message'''
+    limit = args.get('limit')
+    after = args.get('after')
+    stream = args.get('stream')
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('limit must be an integer')
+        if limit < 1:
+            raise ValueError('limit must be a positive integer')
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            raise ValueError('Invalid cursor')
+        after = ObjectId(after)
+
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise ValueError('stream must be one of: ' + ', '.join(STREAM_FORMATS))
+
+    return limit, after, stream
+
+
+def page_args():
+    '''Read ?limit=, ?after= and ?stream= from the current request'''
+    try:
+        return parse_page_args(request.args)
+    except ValueError as exc:
+        abort(400, str(exc))
+
+
+def find_page(collection, query=None, projection=None, limit=DEFAULT_PAGE_SIZE, after=None):
+    '''Fetch one page ordered by _id, returning (documents, next_cursor)'''
+    query = dict(query or {})
+    if after is not None:
+        query['_id'] = {'$gt': after}
+
+    # Ask for one extra document to know whether another page exists
+    cursor = collection.find(query, projection).sort('_id', 1).limit(limit + 1)
+    documents = list(cursor)
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = str(documents[-1]['_id'])
+    return documents, next_cursor
+
+
+def stream_documents(cursors, model, fmt='ndjson'):
+    '''Stream one or more PyMongo cursors, one after the other, as NDJSON or a chunked JSON array'''
+    if not isinstance(cursors, (list, tuple)):
+        cursors = [cursors]
+    documents = itertools.chain.from_iterable(cursor.batch_size(STREAM_BATCH_SIZE) for cursor in cursors)
+    encode = serializer(model)
+
+    def generate():
+        if fmt == 'ndjson':
+            for document in documents:
+                yield dumps(encode(document)) + b'\n'
+            return
+
+        yield b'['
+        separator = b''
+        for document in documents:
+            yield separator + dumps(encode(document))
+            separator = b','
+        yield b']'
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def list_response(collection, model, query=None, projection=None, also=()):
+    '''
+    Serve a list route: one keyset page, or the whole list streamed from the
+    cursor. Without ?limit=, ?after= or ?stream= the list keeps its plain
+    JSON array shape but is streamed as well, so no request holds a whole
+    collection in memory. `also` names further collections (e.g. an
+    archive) listed alongside.
+    '''
+    limit, after, stream = page_args()
+    collections = [collection, *also]
+
+    if stream or (limit is None and after is None):
+        cursors = [c.find(query or {}, projection).sort('_id', 1) for c in collections]
+        return stream_documents(cursors, model, stream or 'json')
+
+    encode = serializer(model)
+    limit = limit or DEFAULT_PAGE_SIZE
+    documents, more = [], False
+    for c in collections:
+        page, next_cursor = find_page(c, query, projection, limit, after)
+        documents += page
+        more = more or next_cursor is not None
+    # _ids from every collection share one order, so the pages merge into one
+    documents.sort(key=lambda d: d['_id'])
+    more = more or len(documents) > limit
+    documents = documents[:limit]
+    next_cursor = str(documents[-1]['_id']) if more else None
+    return json_response({'items': [encode(d) for d in documents], 'next': next_cursor})
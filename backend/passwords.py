@@ -0,0 +1,124 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Werkzeug hash method, including its cost parameters; stored hashes made with
+# any other method are upgraded on the customer's next successful login
+PASSWORD_METHOD = os.environ.get('ORDA_PASSWORD_METHOD', 'scrypt:32768:8:1')
+# Hashing processes per worker; 0 hashes inline on the request thread
+HASH_WORKERS = int(os.environ.get('ORDA_HASH_WORKERS', 2))
+# Hashes queued or running at once per worker, and how long (seconds) a request
+# waits for a free slot before it is turned away with a 503
+HASH_MAX_PENDING = int(os.environ.get('ORDA_HASH_MAX_PENDING', 16))
+HASH_QUEUE_TIMEOUT = float(os.environ.get('ORDA_HASH_QUEUE_TIMEOUT', 0.5))
+HASH_TIMEOUT = float(os.environ.get('ORDA_HASH_TIMEOUT', 10))
+
+
+class HasherBusy(Exception):
+    '''
+    Raised when every hashing slot stays taken for HASH_QUEUE_TIMEOUT, a hash
+    outlasts HASH_TIMEOUT, or a hashing process died under it
+    '''
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(stored, password, method):
+    '''(matches, new hash when the stored one used another method)'''
+    if not check_password_hash(stored, password):
+        return False, None
+    if stored.split('$', 1)[0] != method:
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+class PasswordHasher(object):
+    '''
+    Runs password hashing on a small process pool so that a burst of
+    signups or logins does not hold request threads (and the GIL) for the
+    length of a KDF. At most `max_pending` hashes are in flight; callers
+    beyond that wait up to `queue_timeout` and then get HasherBusy.
+    '''
+
+    def __init__(self, method=PASSWORD_METHOD, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING,
+                 queue_timeout=HASH_QUEUE_TIMEOUT, timeout=HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.rejected = 0
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Started on first use, and again in a forked gunicorn worker
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # forkserver children start clean instead of inheriting this
+                # process's threads, sockets and Mongo client
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['passwords'])
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _replace(self, pool):
+        '''Drop a pool that broke (one of its processes died) so the next call starts a new one'''
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise HasherBusy()
+        pool = self._executor()
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._replace(pool)
+            self.rejected += 1
+            raise HasherBusy()
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the pool is done with the job, not just until
+        # this request stops waiting, so at most max_pending jobs are ever queued
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self.rejected += 1
+            raise HasherBusy()
+        except BrokenProcessPool:
+            self._replace(pool)
+            self.rejected += 1
+            raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, stored, password):
+        '''
+        Check `password` against a stored hash. Returns (matches, new_hash);
+        new_hash is set when the stored hash should be replaced because it was
+        made with an older method or cost.
+        '''
+        return self._run(_verify, stored, password, self.method)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
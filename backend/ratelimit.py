@@ -0,0 +1,172 @@
+import os
+import mmap
+import math
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+
+# Memory-mapped bucket table shared by every worker on the host
+RATE_LIMIT_FILE = os.environ.get('ORDA_RATE_LIMIT_FILE', os.path.join(tempfile.gettempdir(), 'orda-ratelimit.bin'))
+# Default limit per API key in requests per minute (0 disables limiting), and
+# how many requests a key may send at once; a key document's `rate_limit`
+# and `burst` fields override them
+RATE_LIMIT = float(os.environ.get('ORDA_RATE_LIMIT', 600))
+RATE_LIMIT_BURST = int(os.environ.get('ORDA_RATE_LIMIT_BURST', 100))
+# Limit per client address for requests without a valid API key (0 disables
+# it), so that leaving the key out is not a way around the limit
+CLIENT_RATE_LIMIT = float(os.environ.get('ORDA_CLIENT_RATE_LIMIT', RATE_LIMIT))
+CLIENT_RATE_LIMIT_BURST = int(os.environ.get('ORDA_CLIENT_RATE_LIMIT_BURST', RATE_LIMIT_BURST))
+# Reverse proxies in front of the app; with N set, the client address is the
+# N-th entry from the end of X-Forwarded-For instead of the connection's peer
+PROXY_COUNT = int(os.environ.get('ORDA_PROXY_COUNT', 0))
+# Buckets in the table; keys beyond it share slots with the least recently used ones
+RATE_LIMIT_SLOTS = int(os.environ.get('ORDA_RATE_LIMIT_SLOTS', 8192))
+
+# Key fingerprint, tokens left, time of the last update
+SLOT = struct.Struct('<Qdd')
+# Slots tried from a key's home slot before the oldest of them is reused
+PROBES = 8
+
+Decision = namedtuple('Decision', 'allowed limit remaining retry_after reset')
+
+
+def _limit(value):
+    '''A limit as a non-negative finite number, or None when it is absent or unusable'''
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value if math.isfinite(value) and value >= 0 else None
+
+
+def key_limits(document):
+    '''(requests per minute, burst) for an API key document, or None when it is not limited'''
+    # A bad stored value falls back to the default instead of failing every request with the key
+    rate = _limit(document.get('rate_limit'))
+    rate = RATE_LIMIT if rate is None else float(rate)
+    if rate <= 0:
+        return None
+    burst = _limit(document.get('burst'))
+    return rate, max(int(RATE_LIMIT_BURST if burst is None else burst), 1)
+
+
+def parse_key_limits(data, allow_null=False):
+    '''
+    The `rate_limit` and `burst` fields given in a request body; raises
+    ValueError with the 400 message. With `allow_null`, null puts a field
+    back to its default.
+    '''
+    limits = {}
+    for field in ('rate_limit', 'burst'):
+        if field not in data or (data[field] is None and not allow_null):
+            continue
+        if data[field] is not None and _limit(data[field]) is None:
+            raise ValueError(f'{field} must be a non-negative number')
+        limits[field] = data[field]
+    return limits
+
+
+def client_limits():
+    '''(requests per minute, burst) for a client without an API key, or None when they are not limited'''
+    if CLIENT_RATE_LIMIT <= 0:
+        return None
+    return CLIENT_RATE_LIMIT, max(CLIENT_RATE_LIMIT_BURST, 1)
+
+
+def client_bucket(remote_addr, forwarded_for=None, proxies=None):
+    '''Bucket key of a client without an API key, from its address'''
+    proxies = PROXY_COUNT if proxies is None else proxies
+    address = remote_addr or ''
+    if proxies and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= proxies:
+            address = hops[-proxies]
+    return 'client:' + address
+
+
+def limit_headers(decision):
+    '''Rate limit headers for a response, plus Retry-After when it was refused'''
+    headers = {
+        'X-RateLimit-Limit': str(decision.limit),
+        'X-RateLimit-Remaining': str(decision.remaining),
+        'X-RateLimit-Reset': str(decision.reset),
+    }
+    if not decision.allowed:
+        headers['Retry-After'] = str(decision.retry_after)
+    return headers
+
+
+class RateLimiter(object):
+    '''
+    Token buckets in a small memory-mapped file, so that every worker
+    process on the host draws from the same bucket for a key. A take() is
+    a hash, one file lock round trip and a few struct reads and writes.
+    '''
+
+    def __init__(self, path=RATE_LIMIT_FILE, slots=RATE_LIMIT_SLOTS, timer=time.time):
+        self.path = path
+        self.slots = slots
+        self.timer = timer
+        self.limited = 0
+        self._file = None
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Mapped on first use, and again in a forked worker (fcntl locks are per process)
+        if self._pid != os.getpid():
+            self._file = open(self.path, 'a+b')
+            size = self.slots * SLOT.size
+            if os.fstat(self._file.fileno()).st_size < size:
+                fcntl.lockf(self._file, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self._file.fileno()).st_size < size:
+                        os.ftruncate(self._file.fileno(), size)
+                finally:
+                    fcntl.lockf(self._file, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._file.fileno(), size)
+            self._pid = os.getpid()
+        return self._map
+
+    def take(self, key, rate, burst, cost=1):
+        '''Spend `cost` tokens of `key`'s bucket (`rate` per minute, at most `burst`) if it has them'''
+        fingerprint = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        per_second = rate / 60.0
+        home = fingerprint % self.slots
+        with self._lock:
+            data = self._open()
+            fcntl.lockf(self._file, fcntl.LOCK_EX, 1, 0)
+            try:
+                now = self.timer()
+                offset = tokens = None
+                oldest = None
+                for probe in range(PROBES):
+                    at = ((home + probe) % self.slots) * SLOT.size
+                    owner, left, updated = SLOT.unpack_from(data, at)
+                    if owner == fingerprint:
+                        offset = at
+                        tokens = min(burst, left + max(now - updated, 0) * per_second)
+                        break
+                    if owner == 0:
+                        oldest = (-1, at)
+                        break
+                    if oldest is None or updated < oldest[0]:
+                        oldest = (updated, at)
+                if offset is None:
+                    offset, tokens = oldest[1], float(burst)
+
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                SLOT.pack_into(data, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, 1, 0)
+
+        if not allowed:
+            self.limited += 1
+        return Decision(allowed, burst, int(tokens),
+                        max(math.ceil((cost - tokens) / per_second), 1) if not allowed else 0,
+                        math.ceil((burst - tokens) / per_second))
@@ -0,0 +1,103 @@
+from pymongo import UpdateOne
+from archive import ARCHIVE_COLLECTION
+
+# Rollup collection -> the order fields that make up its key (besides the day)
+ROLLUPS = {
+    'sales_daily_item': ('item_id',),
+    'sales_daily_customer': ('customer_id',),
+    'orders_daily_status': ('status',),
+}
+
+# Rows written per bulk_write while rebuilding
+REBUILD_BATCH_SIZE = 1000
+
+
+def order_day(order):
+    '''Day bucket of an order; dates are stored as ISO strings'''
+    return str(order.get('date') or 'unknown')[:10]
+
+
+def order_increments(order, sign=1):
+    '''Yield (collection, key, increments) for everything an order contributes'''
+    day = order_day(order)
+    total = order.get('total') or 0
+    yield 'sales_daily_customer', (day, order.get('customer_id')), {'orders': sign, 'revenue': sign * total}
+    yield 'orders_daily_status', (day, order.get('status')), {'orders': sign, 'revenue': sign * total}
+    for line in order.get('items') or []:
+        quantity = line.get('quantity') or 0
+        revenue = quantity * (line.get('price') or 0)
+        yield 'sales_daily_item', (day, line.get('item_id')), {
+            'orders': sign, 'quantity': sign * quantity, 'revenue': sign * revenue}
+
+
+def accumulate(totals, changes):
+    '''Fold (collection, key, increments) tuples into totals'''
+    for collection, key, increments in changes:
+        row = totals.setdefault(collection, {}).setdefault(key, {})
+        for field, value in increments.items():
+            row[field] = row.get(field, 0) + value
+    return totals
+
+
+def rollup_updates(collection, rows):
+    '''Turn accumulated rows into upserting $inc updates, skipping net-zero rows'''
+    fields = ROLLUPS[collection]
+    updates = []
+    for (day, *values), increments in rows.items():
+        increments = {k: v for k, v in increments.items() if v}
+        if not increments:
+            continue
+        key = {'date': day, **dict(zip(fields, values))}
+        updates.append(UpdateOne(key, {'$inc': increments}, upsert=True))
+    return updates
+
+
+def apply_orders(db, changes):
+    '''
+    Update the rollups for a list of (before, after) order pairs. Pass None as
+    `before` for a new order and None as `after` for a deleted one.
+    '''
+    totals = {}
+    for before, after in changes:
+        if before:
+            accumulate(totals, order_increments(before, -1))
+        if after:
+            accumulate(totals, order_increments(after, 1))
+    for collection, rows in totals.items():
+        updates = rollup_updates(collection, rows)
+        if updates:
+            db[collection].bulk_write(updates, ordered=False)
+
+
+def apply_order(db, before=None, after=None):
+    '''Update the rollups for one created, changed or deleted order'''
+    apply_orders(db, [(before, after)])
+
+
+def rebuild_rollups(db, batch_size=REBUILD_BATCH_SIZE):
+    '''Recompute every rollup from the live and archived orders'''
+    totals = {}
+    projection = {'_id': 0, 'date': 1, 'customer_id': 1, 'status': 1, 'total': 1,
+                  'items.item_id': 1, 'items.quantity': 1, 'items.price': 1}
+    count = 0
+    for collection in (db.orders, db[ARCHIVE_COLLECTION]):
+        for order in collection.find({}, projection).batch_size(batch_size):
+            accumulate(totals, order_increments(order))
+            count += 1
+
+    for collection in ROLLUPS:
+        db[collection].delete_many({})
+        updates = rollup_updates(collection, totals.get(collection, {}))
+        for start in range(0, len(updates), batch_size):
+            db[collection].bulk_write(updates[start:start + batch_size], ordered=False)
+    return count
+
+
+def date_range(date_from=None, date_to=None):
+    '''Mongo filter for an inclusive YYYY-MM-DD range on a rollup's date'''
+    bounds = {}
+    if date_from:
+        bounds['$gte'] = date_from
+    if date_to:
+        bounds['$lte'] = date_to
+    return {'date': bounds} if bounds else {}
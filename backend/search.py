@@ -0,0 +1,201 @@
+import os
+import re
+import time
+import bisect
+import heapq
+import tempfile
+import threading
+import unicodedata
+
+# Journal through which every worker learns about writes to indexed collections
+SEARCH_FILE = os.environ.get('ORDA_SEARCH_FILE', os.path.join(tempfile.gettempdir(), 'orda-search.log'))
+# Results per search by default and at most
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('ORDA_SEARCH_LIMIT', 10))
+SEARCH_MAX_LIMIT = int(os.environ.get('ORDA_SEARCH_MAX_LIMIT', 50))
+# Candidates ranked per query; very short prefixes (e.g. one letter) are
+# ranked among the first this many matches so latency stays flat
+SEARCH_SCAN_LIMIT = int(os.environ.get('ORDA_SEARCH_SCAN_LIMIT', 500))
+# Seconds after which a worker reloads its index from Mongo, picking up
+# changes made outside the API
+SEARCH_REBUILD_INTERVAL = float(os.environ.get('ORDA_SEARCH_REBUILD_INTERVAL', 3600))
+
+_separators = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def normalize(text):
+    '''Lower-case, accent-free form used for both documents and queries'''
+    text = unicodedata.normalize('NFKD', str(text or '')).lower()
+    return ''.join(c for c in text if not unicodedata.combining(c)).strip()
+
+
+def tokenize(text):
+    '''Words of a field, plus the whole value so "john.doe@" still matches as a prefix'''
+    text = normalize(text)
+    tokens = {word for word in _separators.split(text) if word}
+    if text:
+        tokens.add(text)
+    return tokens
+
+
+class PrefixIndex(object):
+    '''
+    Sorted (token, key) pairs answering prefix queries by bisection, plus
+    each key's tokens for ranking. Keys are ranked by: primary field starts
+    with the query, every term prefixes a primary-field word, matched via
+    other fields; then shorter primary values first.
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _document(self, primary, secondary):
+        primary_tokens = tokenize(primary)
+        tokens = set(primary_tokens)
+        for value in secondary:
+            tokens |= tokenize(value)
+        return normalize(primary), primary_tokens, tokens
+
+    def load(self, rows):
+        '''Replace the contents with (key, primary, [secondary...]) rows'''
+        self.documents = {key: self._document(primary, secondary) for key, primary, secondary in rows}
+        self.entries = sorted((token, key) for key, (_, _, tokens) in self.documents.items() for token in tokens)
+
+    def add(self, key, primary, secondary=()):
+        self.remove(key)
+        document = self.documents[key] = self._document(primary, secondary)
+        for token in document[2]:
+            bisect.insort(self.entries, (token, key))
+
+    def remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for token in document[2]:
+            index = bisect.bisect_left(self.entries, (token, key))
+            if index < len(self.entries) and self.entries[index] == (token, key):
+                del self.entries[index]
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.entries, (prefix,))
+        end = bisect.bisect_left(self.entries, (prefix + '\uffff',), start)
+        return start, end
+
+    def search(self, query, limit=SEARCH_DEFAULT_LIMIT, scan_limit=SEARCH_SCAN_LIMIT):
+        '''Keys matching every term of `query` as a prefix, best first'''
+        phrase = normalize(query)
+        terms = [term for term in _separators.split(phrase) if term]
+        if not terms:
+            return []
+
+        # Walk the narrowest term's range and check the other terms per candidate
+        ranges = sorted(((self._range(term), term) for term in terms), key=lambda item: item[0][1] - item[0][0])
+        (start, end), _ = ranges[0]
+        others = [term for _, term in ranges[1:]]
+        candidates = set()
+        for index in range(start, end):
+            key = self.entries[index][1]
+            if key in candidates:
+                continue
+            tokens = self.documents[key][2]
+            if all(any(token.startswith(term) for token in tokens) for term in others):
+                candidates.add(key)
+                if len(candidates) >= scan_limit:
+                    break
+
+        def rank(key):
+            primary, primary_tokens, _ = self.documents[key]
+            if primary.startswith(phrase):
+                tier = 0
+            elif all(any(token.startswith(term) for token in primary_tokens) for term in terms):
+                tier = 1
+            else:
+                tier = 2
+            return tier, len(primary), primary, key
+
+        return heapq.nsmallest(limit, candidates, key=rank)
+
+
+class SearchIndex(object):
+    '''
+    Per-worker prefix index over one collection. It is loaded from Mongo on
+    first use and then kept current from the search journal, which every
+    write path publishes to, so writes through any worker are searchable at
+    once here and within the journal poll interval elsewhere.
+    '''
+
+    def __init__(self, broker, collection, id_field, primary, secondary=(), projection=None,
+                 rebuild_interval=SEARCH_REBUILD_INTERVAL, timer=time.monotonic):
+        self.broker = broker
+        self.collection = collection
+        self.id_field = id_field
+        self.primary = primary
+        self.secondary = tuple(secondary)
+        self.projection = projection
+        self.rebuild_interval = rebuild_interval
+        self.timer = timer
+        self.index = PrefixIndex()
+        self.subscription = None
+        self.loaded = None
+        self._lock = threading.Lock()
+
+    def _row(self, document):
+        return (document[self.id_field], document.get(self.primary),
+                [document.get(field) for field in self.secondary])
+
+    def reset(self):
+        '''Drop the index; the next search reloads it'''
+        with self._lock:
+            self._unsubscribe()
+            self.index = PrefixIndex()
+
+    def _unsubscribe(self):
+        if self.subscription is not None:
+            self.broker.unsubscribe(self.subscription)
+        self.subscription = None
+        self.loaded = None
+
+    def _load(self, db):
+        # Subscribe before reading so that no write falls between the two;
+        # replaying a change the load already saw is harmless
+        self._unsubscribe()
+        self.subscription, _ = self.broker.subscribe(lambda event: event['type'] == self.collection)
+        fields = {self.id_field: 1, self.primary: 1, **{field: 1 for field in self.secondary}}
+        self.index.load(self._row(document) for document in db[self.collection].find({}, fields))
+        self.loaded = self.timer()
+
+    def _sync(self, db):
+        if (self.subscription is None or self.subscription.overflowed
+                or self.timer() - self.loaded >= self.rebuild_interval):
+            self._load(db)
+        self.broker.poll()
+        while True:
+            event = self.subscription.get(0)
+            if event is None:
+                return
+            for key in event['removed']:
+                self.index.remove(key)
+            for document in event['documents']:
+                self.index.add(*self._row(document))
+
+    def search(self, db, query, limit=SEARCH_DEFAULT_LIMIT):
+        '''The best matching documents, read fresh from Mongo in rank order'''
+        with self._lock:
+            self._sync(db)
+            keys = self.index.search(query, limit)
+        if not keys:
+            return []
+        found = {document[self.id_field]: document for document in
+                 db[self.collection].find({self.id_field: {'$in': keys}}, self.projection)}
+        return [found[key] for key in keys if key in found]
+
+    def record(self, documents=(), removed=()):
+        '''Publish written documents and deleted ids to every worker's index'''
+        fields = (self.id_field, self.primary) + self.secondary
+        documents = [{field: document.get(field) for field in fields} for document in documents]
+        removed = list(removed)
+        if documents or removed:
+            self.broker.publish([{'type': self.collection, 'documents': documents, 'removed': removed}])
@@ -0,0 +1,136 @@
+import os
+import json
+from datetime import date, datetime
+from functools import wraps
+from http import HTTPStatus
+from bson import ObjectId
+from flask import Response, current_app
+from flask_restx import fields
+from flask_restx.utils import unpack
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is used without it
+    orjson = None
+
+# 'orjson' or 'json'; defaults to orjson whenever it is installed
+JSON_ENCODER = os.environ.get('ORDA_JSON_ENCODER', 'orjson' if orjson else 'json')
+
+
+def _default(value):
+    '''Encode the BSON/date types Mongo documents carry'''
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if JSON_ENCODER == 'orjson' and orjson is not None:
+    def dumps(data):
+        '''Encode data to JSON bytes'''
+        return orjson.dumps(data, default=_default)
+else:
+    def dumps(data):
+        '''Encode data to JSON bytes'''
+        return json.dumps(data, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _datetime(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else str(value)
+
+
+def _compile_field(field):
+    '''Build a value -> JSON-ready value converter for one flask_restx field'''
+    if isinstance(field, type):
+        field = field()
+
+    if isinstance(field, fields.Nested):
+        convert = serializer(field.nested)
+    elif isinstance(field, fields.List):
+        item = _compile_field(field.container)
+
+        def convert(value):
+            return [item(v) for v in value]
+    elif isinstance(field, fields.Boolean):
+        convert = bool
+    elif isinstance(field, fields.Integer):
+        convert = int
+    elif isinstance(field, fields.Float):
+        convert = float
+    elif isinstance(field, fields.DateTime):
+        convert = _datetime
+    elif isinstance(field, fields.String):
+        convert = _string
+    else:
+        convert = field.format
+
+    default = field.default
+    if default is None:
+        return lambda value: None if value is None else convert(value)
+    return lambda value: convert(default if value is None else value)
+
+
+_compiled = {}
+
+
+def serializer(model):
+    '''Compile (once) a flask_restx model into a document -> dict function'''
+    encode = _compiled.get(id(model))
+    if encode is not None:
+        return encode
+
+    converters = [(name, getattr(field, 'attribute', None) or name, _compile_field(field))
+                  for name, field in model.items()]
+
+    def encode(document):
+        if document is None:
+            return None
+        get = document.get
+        return {name: convert(get(key)) for name, key, convert in converters}
+
+    _compiled[id(model)] = encode
+    return encode
+
+
+def json_response(data, code=HTTPStatus.OK, headers=None):
+    '''Build a response straight from the encoded bytes'''
+    response = current_app.response_class(dumps(data), status=code, mimetype='application/json')
+    if headers:
+        response.headers.extend(headers)
+    return response
+
+
+def output_json(data, code, headers=None):
+    '''flask_restx representation for application/json using the fast encoder'''
+    return json_response(data, code, headers)
+
+
+def serialize_with(api, model, code=HTTPStatus.OK, description='Success', as_list=False):
+    '''
+    Drop-in replacement for api.marshal_with: documents the model for Swagger
+    and serializes successful responses with the precompiled encoder. Error
+    bodies (e.g. {'message': ...}, 404) are passed through unchanged.
+    '''
+    encode = serializer(model)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            rv = f(*args, **kwargs)
+            if isinstance(rv, Response):
+                return rv
+            data, status, headers = unpack(rv)
+            if 200 <= status < 300:
+                data = [encode(d) for d in data] if as_list else encode(data)
+            return json_response(data, status, headers)
+        return api.response(code, description, [model] if as_list else model)(wrapper)
+    return decorator
@@ -1,9 +1,117 @@
 #!/usr/bin/python3
+import os
 import unittest
-from app import app, api
+import tempfile
+import asyncio
+import io
+import threading
+import time
+from unittest import mock
+import csv
+import gzip
+
+# Point the app at a local URI so importing it never needs DNS; tests swap in mongomock below
+os.environ.setdefault('MONGO_URI', 'mongodb://fake_server.example.com:27017/db')
+# Keep the order event journal out of the shared temp directory
+EVENTS_DIR = tempfile.mkdtemp()
+os.environ.setdefault('ORDA_EVENTS_FILE', os.path.join(EVENTS_DIR, 'events.log'))
+os.environ.setdefault('ORDA_SEARCH_FILE', os.path.join(EVENTS_DIR, 'search.log'))
+os.environ.setdefault('ORDA_RATE_LIMIT_FILE', os.path.join(EVENTS_DIR, 'ratelimit.bin'))
+# Most tests send many requests without a key from one address
+os.environ.setdefault('ORDA_CLIENT_RATE_LIMIT', '0')
+
+from app import app, api, mongo, init_worker, warm_up, log_listener, api_key_cache, catalog, get_order_model, password_hasher, item_search, customer_search, order_events
+from cache import MISSING, ReadCache, TTLCache
+from catalog import Catalog
+from serializers import dumps, serializer
+from reports import rebuild_rollups
+from metrics import Registry, merge, render
+from middleware import CORS_MAX_AGE
+from passwords import PasswordHasher, HasherBusy
+from events import EventBroker, event_filter
+from search import PrefixIndex
+from archive import archive_orders
+from ratelimit import RateLimiter, client_bucket
+from flask_restx import marshal
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from indexes import INDEXES, INDEX_NOT_FOUND, ensure_indexes, drop_retired_indexes, plan_stages
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import mongomock
 import json
+import sys
+
+# The sample data generator lives in seed/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'seed'))
+import generate
+import app as app_module
+
+from asgi import OrdaASGI
+
+
+class AsyncCursor(object):
+    '''The part of an async driver cursor the ASGI routes use, over a mongomock cursor'''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args):
+        self.cursor.sort(*args)
+        return self
+
+    def limit(self, count):
+        self.cursor.limit(count)
+        return self
+
+    async def to_list(self, length):
+        return list(self.cursor)
+
+
+class AsyncCollection(object):
+    '''An async stand-in for a collection, answering from the mongomock one'''
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args):
+        return AsyncCursor(self.collection.find(*args))
+
+    async def find_one(self, *args):
+        await asyncio.sleep(0)
+        return self.collection.find_one(*args)
+
+
+class AsyncDatabase(object):
+    '''Async stand-ins for the collections of a mongomock database'''
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.db[name])
+
+    __getattr__ = __getitem__
+
+
+async def asgi_request(asgi_app, method, path, payload=None):
+    '''Drive one HTTP request through an ASGI app, returning (status, body)'''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition('?')
+    await asgi_app({'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('latin-1'), 'http_version': '1.1',
+                    'headers': [(b'content-type', b'application/json')]}, receive, send)
+    return sent[0]['status'], b''.join(m.get('body', b'') for m in sent[1:])
 
 
 class OrdaSysTests(unittest.TestCase):
@@ -19,8 +127,14 @@ class OrdaSysTests(unittest.TestCase):
         # Use mongomock to create a fake database
         self.mongo_client = mongomock.MongoClient('mongodb://fake_server.example.com:27017')
         self.db = self.mongo_client.db  # Adjust 'db' based on how it's called in your app
+        mongo.cx, mongo.db = self.mongo_client, self.db
 
     def tearDown(self):
+        self.mongo_client.drop_database('db')
+        api_key_cache.clear()
+        catalog.reset()
+        item_search.reset()
+        customer_search.reset()
         self.patcher.stop()
 
     def test_delete_order(self):
@@ -28,7 +142,7 @@ class OrdaSysTests(unittest.TestCase):
         self.db.orders.insert_one({'order_id': '1', 'details': 'Some details'})
         
         # Perform the test
-        response = self.app.delete('/api/orders/1')
+        response = self.app.delete('/api/v1/orders/1')
         self.assertEqual(response.status_code, 200)
 
         # Verify deletion
@@ -36,16 +150,17 @@ class OrdaSysTests(unittest.TestCase):
         self.assertIsNone(result)
 
     def test_get_orders(self):
-        """Test the /api/orders GET endpoint"""
+        """Test the /api/v1/orders GET endpoint"""
         # Assuming you have a function to insert data for testing
         self.db.orders.insert_one({'order_id': '1', 'customer_id': 'c1', 'items': [], 'total': 0, 'date': '2024-04-15', 'status': 'Collected'})
 
-        response = self.app.get('/api/orders')
+        response = self.app.get('/api/v1/orders')
         self.assertEqual(response.status_code, 200)
         self.assertIn('Collected', str(response.data))
 
     def test_post_order(self):
-        """Test the /api/orders POST endpoint"""
+        """Test the /api/v1/orders POST endpoint"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 10.0, 'stock': 5})
         order_data = {
             'customer_id': 'c1',
             'items': [{'item_id': 'i1', 'quantity': 1, 'price': 10.0}],
@@ -53,57 +168,902 @@ class OrdaSysTests(unittest.TestCase):
             'date': '2024-04-15',
             'status': 'Pending'
         }
-        response = self.app.post('/api/orders', json=order_data)
+        response = self.app.post('/api/v1/orders', json=order_data)
         self.assertEqual(response.status_code, 201)
         self.assertIn('Pending', str(response.data))
 
     def test_get_customer(self):
-        """Test the /api/customers/<customer_id> GET endpoint"""
+        """Test the /api/v1/customers/<customer_id> GET endpoint"""
         self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com', 'password': 'hashedpass', 'address': '123 Elm St'})
 
-        response = self.app.get('/api/customers/c1')
+        response = self.app.get('/api/v1/customers/c1')
         self.assertEqual(response.status_code, 200)
         self.assertIn('John Doe', str(response.data))
 
     def test_register_customer(self):
-        """Test the /api/customers POST endpoint for registering a new customer"""
+        """Test the /api/v1/customers POST endpoint for registering a new customer"""
         new_customer = {
             'name': 'Alice Smith',
             'email': 'alice@example.com',
             'password': 'securePassword123',
             'address': '456 Tree St'
         }
-        response = self.app.post('/api/customers', json=new_customer)
+        response = self.app.post('/api/v1/customers', json=new_customer)
         self.assertEqual(response.status_code, 201)
         self.assertIn('Alice Smith', str(response.data))
 
     def test_update_order(self):
-        """Test the /api/orders/<order_id> PUT endpoint for updating an existing order"""
-        # Assuming order_id '1' exists from test setup or previous test
+        """Test the /api/v1/orders/<order_id> PUT endpoint for updating an existing order"""
+        self.db.orders.insert_one({'order_id': '1', 'customer_id': 'c1', 'items': [], 'total': 0, 'date': '2024-04-15', 'status': 'Collected'})
         update_data = {
             'status': 'Shipped'
         }
-        response = self.app.put('/api/orders/1', json=update_data)
+        response = self.app.put('/api/v1/orders/1', json=update_data)
         self.assertEqual(response.status_code, 200)
         self.assertIn('Shipped', str(response.data))
 
     def test_get_order_status(self):
-        """Test the /api/orders/<order_id>/status GET endpoint"""
+        """Test the /api/v1/orders/<order_id>/status GET endpoint"""
         # Ensure the order with specific status exists
-        response = self.app.get('/api/orders/1/status')
+        self.db.orders.insert_one({'order_id': '1', 'customer_id': 'c1', 'items': [], 'total': 0, 'date': '2024-04-15', 'status': 'Collected'})
+        response = self.app.get('/api/v1/orders/1/status')
         self.assertEqual(response.status_code, 200)
         # Check for specific status in the response
         response_data = json.loads(response.data.decode('utf-8'))
         self.assertEqual(response_data['status'], 'Collected')
 
     def test_update_order_status(self):
-        """Test the /api/orders/<order_id>/status PUT endpoint"""
+        """Test the /api/v1/orders/<order_id>/status PUT endpoint"""
+        self.db.orders.insert_one({'order_id': '1', 'customer_id': 'c1', 'items': [], 'total': 0, 'date': '2024-04-15', 'status': 'Collected'})
         status_update = {'status': 'Delivered'}
-        response = self.app.put('/api/orders/1/status', json=status_update)
+        response = self.app.put('/api/v1/orders/1/status', json=status_update)
         self.assertEqual(response.status_code, 200)
         response_data = json.loads(response.data.decode('utf-8'))
         self.assertEqual(response_data['status'], 'Delivered')
 
+    def test_list_items_keyset_pagination(self):
+        """Test ?limit= and ?after= on the /api/v1/items GET endpoint"""
+        self.db.items.insert_many([{'item_id': str(i), 'name': 'Item %d' % i, 'price': 1.0, 'stock': i} for i in range(5)])
+
+        response = self.app.get('/api/v1/items?limit=2')
+        self.assertEqual(response.status_code, 200)
+        page = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([item['item_id'] for item in page['items']], ['0', '1'])
+        self.assertIsNotNone(page['next'])
+
+        response = self.app.get('/api/v1/items?limit=3&after=' + page['next'])
+        page = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([item['item_id'] for item in page['items']], ['2', '3', '4'])
+        self.assertIsNone(page['next'])
+
+    def test_list_orders_default_is_streamed(self):
+        """Test the /api/v1/orders GET endpoint without paging parameters streams a plain JSON array"""
+        self.db.orders.insert_many([{'order_id': str(i), 'customer_id': 'c1', 'items': [], 'total': 0,
+                                     'date': '2024-04-15', 'status': 'Pending'} for i in range(3)])
+        response = self.app.get('/api/v1/orders', buffered=False)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual([order['order_id'] for order in json.loads(response.get_data())], ['0', '1', '2'])
+
+    def test_list_items_invalid_cursor(self):
+        """Test the /api/v1/items GET endpoint rejects a malformed cursor"""
+        response = self.app.get('/api/v1/items?after=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_customers_ndjson(self):
+        """Test ?stream=ndjson on the /api/v1/customers GET endpoint"""
+        self.db.customers.insert_many([
+            {'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com', 'password': 'x', 'address': '1 Elm St'},
+            {'customer_id': 'c2', 'name': 'Jane Doe', 'email': 'jane@example.com', 'password': 'x', 'address': '2 Elm St'}
+        ])
+
+        response = self.app.get('/api/v1/customers?stream=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual([c['customer_id'] for c in lines], ['c1', 'c2'])
+        self.assertNotIn('password', lines[0])
+
+    def test_ensure_indexes_drops_retired_indexes(self):
+        """Test ensure-indexes removes indexes the registry has replaced"""
+        self.db.orders.create_index([('customer_id', 1), ('date', 1)], name='customer_id_date')
+        result = app.test_cli_runner().invoke(args=['ensure-indexes'])
+        self.assertIn('orders: dropped customer_id_date', result.output)
+        self.assertNotIn('customer_id_date', self.db.orders.index_information())
+        self.assertIn('customer_id_date_id', self.db.orders.index_information())
+
+    def test_drop_retired_indexes_tolerates_a_concurrent_drop(self):
+        """Test an index another worker dropped first counts as dropped, and ensure-indexes drops only once"""
+        self.db.orders.create_index([('customer_id', 1), ('date', 1)], name='customer_id_date')
+        gone = OperationFailure('index not found with name [customer_id_date]', code=INDEX_NOT_FOUND)
+        with mock.patch.object(mongomock.Collection, 'drop_index', side_effect=gone) as drop_index:
+            result = app.test_cli_runner().invoke(args=['ensure-indexes'])
+        self.assertIsNone(result.exception)
+        self.assertNotIn('dropped', result.output)
+        self.assertEqual(drop_index.call_count, 1)
+
+        with mock.patch.object(mongomock.Collection, 'drop_index', side_effect=OperationFailure('denied', code=13)):
+            self.assertRaises(OperationFailure, drop_retired_indexes, self.db)
+
+    def test_ensure_indexes_is_idempotent(self):
+        """Test the index registry can be applied more than once"""
+        ensure_indexes(self.db)
+        ensure_indexes(self.db)
+        for collection, indexes in INDEXES.items():
+            existing = self.db[collection].index_information()
+            for index in indexes:
+                self.assertIn(index.document['name'], existing)
+        self.assertTrue(self.db.orders.index_information()['order_id_unique'].get('unique'))
+
+    def test_plan_stages_finds_collscan(self):
+        """Test explain() plans are walked down to their input stages"""
+        indexed = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'order_id_unique'}}
+        scanned = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+        self.assertNotIn('COLLSCAN', plan_stages(indexed))
+        self.assertIn('COLLSCAN', plan_stages(scanned))
+
+    def test_ttl_cache_expiry_and_lru_eviction(self):
+        """Test the TTL cache expires entries and evicts the least recently used"""
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set('a', True)
+        cache.set('b', False)
+        self.assertIs(cache.get('a'), True)
+        cache.set('c', True)  # evicts 'b', the least recently used
+        self.assertIs(cache.get('b'), MISSING)
+        now[0] = 11
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_revoke_key_invalidates_cache(self):
+        """Test the /api/v1/keys/<key_id> DELETE endpoint deactivates the key and drops it from the cache"""
+        response = self.app.post('/api/v1/keys/generate')
+        new_key = json.loads(response.data.decode('utf-8'))
+        api_key_cache.set(new_key['key'], True)
+
+        response = self.app.delete('/api/v1/keys/' + new_key['key_id'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(api_key_cache.get(new_key['key']), MISSING)
+        self.assertFalse(self.db.api_keys.find_one({'key_id': new_key['key_id']})['active'])
+
+    def test_bulk_create_items(self):
+        """Test the /api/v1/items/bulk POST endpoint returns per-row results"""
+        rows = [
+            {'name': 'Widget A', 'price': 25.5, 'stock': 50},
+            {'name': 'Widget B', 'price': 'free', 'stock': 10}
+        ]
+        response = self.app.post('/api/v1/items/bulk', json=rows)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([r['status'] for r in results], [201, 400])
+        self.assertIn('price', results[1]['errors'])
+        self.assertEqual(self.db.items.count_documents({}), 1)
+        self.assertIsNotNone(self.db.items.find_one({'item_id': results[0]['id']}))
+
+    def test_bulk_create_orders_reserves_stock(self):
+        """Test the /api/v1/orders/bulk POST endpoint prices rows from the catalog and rejects rows over the stock"""
+        self.db.items.insert_many([{'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 3},
+                                   {'item_id': 'i2', 'name': 'Widget B', 'price': 2.0, 'stock': 10}])
+        order = {'customer_id': 'c1', 'date': '2024-04-15', 'status': 'Pending'}
+        response = self.app.post('/api/v1/orders/bulk', json=[
+            {**order, 'items': [{'item_id': 'i1', 'quantity': 2}], 'total': 0.01},
+            {**order, 'items': [{'item_id': 'i2', 'quantity': 1}, {'item_id': 'i1', 'quantity': 2}]},
+            {**order, 'items': [{'item_id': 'missing', 'quantity': 1}]},
+            {**order, 'items': []}
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()
+        self.assertEqual([r['status'] for r in results], [201, 409, 400, 400])
+        self.assertEqual(self.db.orders.find_one({'order_id': results[0]['id']})['total'], 51.0)
+        self.assertEqual(self.db.orders.count_documents({}), 1)
+        # The rejected row gave back what it took from i2
+        self.assertEqual([item['stock'] for item in self.db.items.find().sort('item_id', 1)], [1, 10])
+
+    def test_bulk_update_and_delete_items(self):
+        """Test the /api/v1/items/bulk PUT and DELETE endpoints"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 50})
+
+        response = self.app.put('/api/v1/items/bulk', json=[
+            {'item_id': 'i1', 'name': 'Widget A', 'price': 20.0, 'stock': 40},
+            {'item_id': 'missing', 'name': 'Widget Z', 'price': 1.0, 'stock': 1}
+        ])
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([r['status'] for r in results], [200, 404])
+        self.assertEqual(self.db.items.find_one({'item_id': 'i1'})['price'], 20.0)
+
+        response = self.app.delete('/api/v1/items/bulk', json={'ids': ['i1', 'missing']})
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([r['status'] for r in results], [200, 404])
+        self.assertIsNone(self.db.items.find_one({'item_id': 'i1'}))
+
+    def test_post_order_prices_and_reserves_stock(self):
+        """Test the /api/v1/orders POST endpoint prices lines from the catalog and decrements stock"""
+        self.db.items.insert_many([
+            {'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 5},
+            {'item_id': 'i2', 'name': 'Widget B', 'price': 5.75, 'stock': 1}
+        ])
+        order_data = {
+            'customer_id': 'c1',
+            'items': [{'item_id': 'i1', 'quantity': 2, 'price': 0.01}, {'item_id': 'i2', 'quantity': 1}],
+            'total': 0.01,
+            'date': '2024-04-15',
+            'status': 'Pending'
+        }
+        response = self.app.post('/api/v1/orders', json=order_data)
+        self.assertEqual(response.status_code, 201)
+        order = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(order['total'], 56.75)
+        self.assertEqual(self.db.items.find_one({'item_id': 'i1'})['stock'], 3)
+        self.assertEqual(self.db.items.find_one({'item_id': 'i2'})['stock'], 0)
+
+    def test_post_order_insufficient_stock_rolls_back(self):
+        """Test the /api/v1/orders POST endpoint keeps no reservation when a line can't be filled"""
+        self.db.items.insert_many([
+            {'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 5},
+            {'item_id': 'i2', 'name': 'Widget B', 'price': 5.75, 'stock': 1}
+        ])
+        order_data = {
+            'customer_id': 'c1',
+            'items': [{'item_id': 'i1', 'quantity': 2}, {'item_id': 'i2', 'quantity': 3}],
+            'date': '2024-04-15',
+            'status': 'Pending'
+        }
+        response = self.app.post('/api/v1/orders', json=order_data)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.db.items.find_one({'item_id': 'i1'})['stock'], 5)
+        self.assertEqual(self.db.items.find_one({'item_id': 'i2'})['stock'], 1)
+        self.assertEqual(self.db.orders.count_documents({}), 0)
+
+    def test_serializer_matches_marshal(self):
+        """Test the compiled serializer produces the same output as flask_restx marshal"""
+        order = {'_id': ObjectId(), 'order_id': '1', 'customer_id': 'c1',
+                 'items': [{'item_id': 'i1', 'name': 'Widget A', 'quantity': 2, 'price': 25.5, 'extra': True}],
+                 'total': 51, 'date': '2024-04-15'}
+        self.assertEqual(serializer(get_order_model)(order), json.loads(json.dumps(marshal(order, get_order_model))))
+
+    def test_dumps_handles_bson_types(self):
+        """Test the JSON encoder writes ObjectId and datetime values"""
+        object_id = ObjectId()
+        encoded = json.loads(dumps({'_id': object_id, 'at': datetime(2024, 4, 15, 12, 30)}))
+        self.assertEqual(encoded, {'_id': str(object_id), 'at': '2024-04-15T12:30:00'})
+
+    def test_reports_follow_order_writes(self):
+        """Test the /api/v1/reports rollups are updated by order create, status change and delete"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 10.0, 'stock': 10})
+        response = self.app.post('/api/v1/orders', json={
+            'customer_id': 'c1', 'items': [{'item_id': 'i1', 'quantity': 3}],
+            'date': '2024-04-15', 'status': 'Pending'
+        })
+        order_id = json.loads(response.data.decode('utf-8'))['order_id']
+        self.app.put('/api/v1/orders/%s/status' % order_id, json={'status': 'Shipped'})
+
+        response = self.app.get('/api/v1/reports/sales/items?from=2024-04-01&to=2024-04-30')
+        rows = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([(r['item_id'], r['quantity'], r['revenue']) for r in rows], [('i1', 3, 30.0)])
+
+        response = self.app.get('/api/v1/reports/orders/status')
+        rows = json.loads(response.data.decode('utf-8'))
+        self.assertEqual({r['status']: r['orders'] for r in rows}, {'Pending': 0, 'Shipped': 1})
+
+        self.app.delete('/api/v1/orders/' + order_id)
+        response = self.app.get('/api/v1/reports/sales/customers?customer_id=c1')
+        rows = json.loads(response.data.decode('utf-8'))
+        self.assertEqual((rows[0]['orders'], rows[0]['revenue']), (0, 0))
+
+    def test_rebuild_rollups(self):
+        """Test the report rollups can be rebuilt from the orders collection"""
+        self.db.orders.insert_many([
+            {'order_id': '1', 'customer_id': 'c1', 'items': [{'item_id': 'i1', 'quantity': 2, 'price': 5.0}],
+             'total': 10.0, 'date': '2024-04-15', 'status': 'Shipped'},
+            {'order_id': '2', 'customer_id': 'c1', 'items': [{'item_id': 'i1', 'quantity': 1, 'price': 5.0}],
+             'total': 5.0, 'date': '2024-04-15', 'status': 'Pending'}
+        ])
+        self.assertEqual(rebuild_rollups(self.db), 2)
+        row = self.db.sales_daily_item.find_one({'date': '2024-04-15', 'item_id': 'i1'})
+        self.assertEqual((row['orders'], row['quantity'], row['revenue']), (2, 3, 15.0))
+        self.assertEqual(self.db.sales_daily_customer.find_one({'customer_id': 'c1'})['revenue'], 15.0)
+
+    def test_items_conditional_get(self):
+        """Test the /api/v1/items GET endpoint answers If-None-Match with 304 until the catalog changes"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 50})
+
+        response = self.app.get('/api/v1/items')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.app.get('/api/v1/items', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.app.put('/api/v1/items/i1', json={'name': 'Widget A', 'price': 20.0, 'stock': 50})
+        response = self.app.get('/api/v1/items', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))[0]['price'], 20.0)
+
+    def test_orders_refresh_cached_stock(self):
+        """Test that placing an order retires item ETags so stock is read again, and older bodies are dropped"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 50})
+        etag = self.app.get('/api/v1/items').headers['ETag']
+        self.app.get('/api/v1/items/i1')
+        self.assertEqual(len(catalog.bodies), 2)
+        response = self.app.post('/api/v1/orders', json={'customer_id': 'c1', 'items': [{'item_id': 'i1', 'quantity': 1}],
+                                                         'date': '2024-04-15', 'status': 'Pending'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(catalog.bodies), 0)
+        response = self.app.get('/api/v1/items', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()[0]['stock'], 49)
+
+        # Orders inside one stock interval share a single bump at its end
+        shared = Catalog(stock_interval=0.05)
+        shared.stock_changed(self.db)
+        first = shared.version
+        shared.stock_changed(self.db)
+        flush = shared._stock_flush
+        shared.stock_changed(self.db)
+        self.assertEqual(shared.version, first)
+        flush.join()
+        self.assertEqual(shared.version, first + 1)
+
+    def test_item_etag_and_not_found(self):
+        """Test the /api/v1/items/<item_id> GET endpoint sets an ETag and still returns 404 for unknown items"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 25.5, 'stock': 50})
+        response = self.app.get('/api/v1/items/i1')
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/api/v1/items/i1', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.app.get('/api/v1/items/missing').status_code, 404)
+
+    def test_metrics_endpoint(self):
+        """Test the /metrics endpoint reports per-route request counts in Prometheus format"""
+        self.app.get('/api/v1/items/missing')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode('utf-8')
+        self.assertIn('# TYPE orda_http_request_duration_seconds histogram', body)
+        self.assertIn('orda_http_requests_total{namespace="items",route="/api/v1/items/<string:item_id>",'
+                      'method="GET",status="404"}', body)
+
+    def test_metrics_do_not_buffer_streamed_lists(self):
+        """Test recording metrics for a ?stream= response leaves its body unread"""
+        self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com',
+                                      'password': 'x', 'address': '1 Elm St'})
+        with mock.patch.object(app.response_class, 'make_sequence', side_effect=AssertionError('body buffered')):
+            response = self.app.get('/api/v1/customers?stream=ndjson', buffered=False)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(json.loads(response.get_data())['customer_id'], 'c1')
+
+    def test_metrics_merge_across_workers(self):
+        """Test snapshots from several workers are summed"""
+        workers = [Registry(), Registry()]
+        for registry in workers:
+            registry.inc('orda_http_requests_total', (('route', '/x'),))
+            registry.observe('orda_http_request_duration_seconds', (('route', '/x'),), 0.003)
+        body = render(*merge([registry.snapshot() for registry in workers]))
+        self.assertIn('orda_http_requests_total{route="/x"} 2', body)
+        self.assertIn('orda_http_request_duration_seconds_bucket{route="/x",le="0.005"} 2', body)
+        self.assertIn('orda_http_request_duration_seconds_bucket{route="/x",le="0.0025"} 0', body)
+
+
+    def test_cors_preflight_short_circuits(self):
+        """Test a CORS preflight is answered with 204 and a cacheable Max-Age"""
+        response = self.app.options('/api/v1/orders/', headers={
+            'Origin': 'https://example.com',
+            'Access-Control-Request-Method': 'POST',
+            'Access-Control-Request-Headers': 'Content-Type'
+        })
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertIn('POST', response.headers['Access-Control-Allow-Methods'])
+        self.assertEqual(response.headers['Access-Control-Max-Age'], str(CORS_MAX_AGE))
+
+    def test_trailing_slash_served_without_redirect(self):
+        """Test /api/ paths with a trailing slash are served directly with CORS headers"""
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget', 'price': 1.0, 'stock': 1, 'image': ''})
+        response = self.app.get('/api/v1/items/i1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(response.headers['Referrer-Policy'], 'no-referrer')
+        self.assertEqual(response.headers.getlist('Access-Control-Allow-Origin'), ['*'])
+
+    def test_login_rehashes_to_current_method(self):
+        """Test a successful login upgrades a hash made with an older method"""
+        response = self.app.post('/api/v1/customers', json={
+            'name': 'Jane', 'email': 'jane@example.com', 'password': 's3cret', 'address': '1 Main St'
+        })
+        self.assertEqual(response.status_code, 201)
+        stored = self.db.customers.find_one({'email': 'jane@example.com'})['password']
+        self.assertTrue(stored.startswith(password_hasher.method + '$'))
+
+        response = self.app.post('/api/v1/customers/login', json={'email': 'jane@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+
+        method = password_hasher.method
+        password_hasher.method = 'pbkdf2:sha256:1000'
+        try:
+            response = self.app.post('/api/v1/customers/login', json={'email': 'jane@example.com', 'password': 's3cret'})
+        finally:
+            password_hasher.method = method
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('password', response.get_json())
+        stored = self.db.customers.find_one({'email': 'jane@example.com'})['password']
+        self.assertTrue(stored.startswith('pbkdf2:sha256:1000$'))
+
+    def test_password_hasher_backpressure(self):
+        """Test hashing is refused once every slot stays taken"""
+        hasher = PasswordHasher(method='pbkdf2:sha256:1000', max_pending=1, queue_timeout=0)
+        try:
+            hasher.slots.acquire()
+            with self.assertRaises(HasherBusy):
+                hasher.hash('pw')
+            self.assertEqual(hasher.rejected, 1)
+            hasher.slots.release()
+            self.assertEqual(hasher.verify(hasher.hash('pw'), 'pw'), (True, None))
+        finally:
+            hasher.shutdown()
+
+    def test_password_hasher_timeout_keeps_the_slot(self):
+        """Test a hash that outlasts the timeout is refused and holds its slot until the pool finishes it"""
+        hasher = PasswordHasher(max_pending=1, queue_timeout=0, timeout=0.05)
+        try:
+            with self.assertRaises(HasherBusy):
+                hasher._run(time.sleep, 0.5)
+            self.assertFalse(hasher.slots.acquire(blocking=False))
+            self.assertTrue(hasher.slots.acquire(timeout=30))
+            hasher.slots.release()
+        finally:
+            hasher.shutdown()
+
+    def test_password_hasher_replaces_a_broken_pool(self):
+        """Test a hashing process that dies is answered with HasherBusy and the next hash gets a new pool"""
+        hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1, max_pending=1, queue_timeout=5)
+        try:
+            with self.assertRaises(HasherBusy):
+                hasher._run(os._exit, 1)
+            self.assertEqual(hasher.rejected, 1)
+            self.assertEqual(hasher.verify(hasher.hash('pw'), 'pw'), (True, None))
+        finally:
+            hasher.shutdown()
+
+    def test_event_broker_resume_and_rotation(self):
+        """Test events keep increasing ids across a journal rotation and resume after Last-Event-ID"""
+        broker = EventBroker(os.path.join(EVENTS_DIR, 'rotate.log'), max_bytes=200)
+        match = event_filter(customer_id='c1')
+        events = []
+        for n in range(6):
+            events += broker.publish([{'type': 'order.created', 'order_id': str(n), 'customer_id': 'c1' if n % 2 else 'c2',
+                                       'status': 'Pending', 'order': {'order_id': str(n)}}])
+        self.assertTrue(os.path.exists(broker.path + '.1'))
+        ids = [event['id'] for event in events]
+        self.assertEqual(ids, sorted(set(ids)))
+
+        subscription, backlog = broker.subscribe(match, last_id=events[1]['id'])
+        self.assertEqual([e['order_id'] for e in backlog], ['3', '5'])
+        broker.publish([{'type': 'order.status', 'order_id': '7', 'customer_id': 'c1', 'status': 'Ready',
+                         'order': {'order_id': '7'}}])
+        broker.poll()
+        self.assertEqual(subscription.get(1)['order_id'], '7')
+        broker.unsubscribe(subscription)
+
+    def test_event_broker_finishes_the_rotated_journal(self):
+        """Test events appended to the old journal just before it rotated are still delivered"""
+        broker = EventBroker(os.path.join(EVENTS_DIR, 'rotate-race.log'))
+        event = {'type': 'order.created', 'customer_id': 'c1', 'status': 'Pending'}
+        broker.publish([{**event, 'order_id': '0'}])
+        subscription, _ = broker.subscribe(event_filter(customer_id='c1'))
+        broker.poll()
+        broker.max_bytes = os.path.getsize(broker.path) + 1
+        stat, raced = os.stat, []
+
+        def stat_after_writes(path, *args, **kwargs):
+            # Another process appends to the old journal and rotates it after this poll reached its end
+            if path == broker.path and not raced:
+                raced.append(True)
+                broker.publish([{**event, 'order_id': '1'}])
+                broker.publish([{**event, 'order_id': '2'}])
+            return stat(path, *args, **kwargs)
+
+        with mock.patch('events.os.stat', stat_after_writes):
+            broker.poll()
+        self.assertTrue(raced)
+        self.assertEqual([subscription.get(1)['order_id'] for _ in range(2)], ['1', '2'])
+        broker.unsubscribe(subscription)
+
+    def test_order_events_stream(self):
+        """Test /api/v1/orders/events replays status changes after Last-Event-ID"""
+        self.db.orders.insert_one({'order_id': 'e1', 'customer_id': 'c-events', 'items': [], 'total': 0,
+                                   'date': '2024-04-15', 'status': 'Pending'})
+        self.app.put('/api/v1/orders/e1/status', json={'status': 'Ready'})
+        response = self.app.get('/api/v1/orders/events?customer_id=c-events', headers={'Last-Event-ID': '0'},
+                                buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        message = next(chunks).decode('utf-8')
+        self.assertIn('event: order.status\n', message)
+        self.assertEqual(json.loads(message.split('data: ', 1)[1])['status'], 'Ready')
+        response.close()
+
+    def test_order_events_stream_limit(self):
+        """Test a worker refuses event streams beyond its limit with 503 and frees the slot on close"""
+        with mock.patch.object(order_events, 'max_streams', 1):
+            first = self.app.get('/api/v1/orders/events', buffered=False)
+            self.assertEqual(first.status_code, 200)
+            response = self.app.get('/api/v1/orders/events', buffered=False)
+            self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '5'))
+            first.close()
+            second = self.app.get('/api/v1/orders/events', buffered=False)
+            self.assertEqual(second.status_code, 200)
+            second.close()
+        self.assertEqual(order_events.streams, 0)
+
+    def test_asgi_reads_natively_and_writes_through_flask(self):
+        """Test the ASGI entry point answers reads with the async client and hands writes to Flask"""
+        self.db.orders.insert_one({'order_id': 'a1', 'customer_id': 'c1', 'items': [], 'total': 0,
+                                   'date': '2024-04-15', 'status': 'Pending'})
+        self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com',
+                                      'password': 'hashedpass', 'address': '123 Elm St'})
+        asgi_app = OrdaASGI(app, db=AsyncDatabase(self.db))
+        status, _ = asyncio.run(asgi_request(asgi_app, 'PUT', '/api/v1/orders/a1/status', {'status': 'Ready'}))
+        self.assertEqual(status, 200)
+        status, body = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/orders/a1/'))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), self.app.get('/api/v1/orders/a1').get_json())
+        status, _ = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/orders/missing'))
+        self.assertEqual(status, 404)
+        status, body = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/orders/a1/status'))
+        self.assertEqual((status, json.loads(body)), (200, {'status': 'Ready'}))
+
+        status, body = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/customers?limit=1'))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), self.app.get('/api/v1/customers?limit=1').get_json())
+        self.assertNotIn('password', json.loads(body)['items'][0])
+        status, body = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/customers/c1'))
+        self.assertEqual((status, json.loads(body)['email']), (200, 'john@example.com'))
+        status, _ = asyncio.run(asgi_request(asgi_app, 'GET', '/api/v1/customers?limit=x'))
+        self.assertEqual(status, 400)
+
+    def test_customer_order_history(self):
+        """Test /api/v1/customers/<id>/orders pages newest first and keeps the summary in step"""
+        self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com',
+                                      'password': 'hashedpass', 'address': '123 Elm St'})
+        self.db.items.insert_one({'item_id': 'i1', 'name': 'Widget A', 'price': 10.0, 'stock': 10})
+        order_ids = []
+        for day, quantity in (('2024-04-15', 1), ('2024-04-16', 2), ('2024-04-17', 3)):
+            response = self.app.post('/api/v1/orders', json={
+                'customer_id': 'c1', 'items': [{'item_id': 'i1', 'quantity': quantity}], 'date': day, 'status': 'Pending'})
+            order_ids.append(json.loads(response.data.decode('utf-8'))['order_id'])
+        self.app.put('/api/v1/orders/%s/status' % order_ids[0], json={'status': 'Shipped'})
+
+        page = self.app.get('/api/v1/customers/c1/orders?limit=2').get_json()
+        self.assertEqual([o['date'] for o in page['items']], ['2024-04-17', '2024-04-16'])
+        self.assertEqual(page['summary'], {'orders': 3, 'spend': 60.0, 'last_order_date': '2024-04-17'})
+        page = self.app.get('/api/v1/customers/c1/orders?limit=2&after=' + page['next']).get_json()
+        self.assertEqual(([o['order_id'] for o in page['items']], page['next']), ([order_ids[0]], None))
+
+        page = self.app.get('/api/v1/customers/c1/orders?status=Pending&from=2024-04-16&to=2024-04-16').get_json()
+        self.assertEqual([o['order_id'] for o in page['items']], [order_ids[1]])
+
+        self.app.delete('/api/v1/orders/' + order_ids[2])
+        summary = self.app.get('/api/v1/customers/c1/orders').get_json()['summary']
+        self.assertEqual(summary, {'orders': 2, 'spend': 30.0, 'last_order_date': '2024-04-16'})
+        self.assertEqual(self.app.get('/api/v1/customers/c1/orders?after=bogus').status_code, 400)
+        self.assertEqual(self.app.get('/api/v1/customers/missing/orders').status_code, 404)
+
+    def test_prefix_index_ranking(self):
+        """Test prefix matches rank name-start first, then word matches, then other fields"""
+        index = PrefixIndex()
+        index.load([
+            ('1', 'Red Apple', []),
+            ('2', 'Apple Juice', []),
+            ('3', 'Apple', []),
+            ('4', 'Pineapple', ['apple@example.com']),
+            ('5', 'Banana', []),
+        ])
+        self.assertEqual(index.search('app'), ['3', '2', '1', '4'])
+        self.assertEqual(index.search('ju ap'), ['2'])
+        index.remove('3')
+        index.add('6', 'Crème Brûlée')
+        self.assertEqual(index.search('APP', limit=2), ['2', '1'])
+        self.assertEqual(index.search('creme'), ['6'])
+
+    def test_search_endpoints_follow_writes(self):
+        """Test /api/v1/items/search and /api/v1/customers/search see creates, renames and deletes"""
+        self.db.items.insert_one({'item_id': 'i0', 'name': 'Widget Classic', 'price': 5.0, 'stock': 1})
+        self.assertEqual([i['item_id'] for i in self.app.get('/api/v1/items/search?q=wid').get_json()], ['i0'])
+
+        response = self.app.post('/api/v1/items', json={'name': 'Widget', 'price': 1.0, 'stock': 3, 'image': ''})
+        item_id = response.get_json()['item_id']
+        self.assertEqual([i['item_id'] for i in self.app.get('/api/v1/items/search?q=wid').get_json()], [item_id, 'i0'])
+        self.app.put('/api/v1/items/' + item_id, json={'name': 'Gadget'})
+        self.assertEqual([i['name'] for i in self.app.get('/api/v1/items/search?q=gad').get_json()], ['Gadget'])
+        self.app.delete('/api/v1/items/' + item_id)
+        self.assertEqual(self.app.get('/api/v1/items/search?q=gad').get_json(), [])
+        self.assertEqual(self.app.get('/api/v1/items/search').status_code, 400)
+
+        self.app.post('/api/v1/customers', json={'name': 'Alice Smith', 'email': 'alice@example.com',
+                                                  'password': 'pw', 'address': '456 Tree St'})
+        customers = self.app.get('/api/v1/customers/search?q=alice@ex').get_json()
+        self.assertEqual([c['name'] for c in customers], ['Alice Smith'])
+        self.assertNotIn('password', customers[0])
+
+    def test_archive_orders_with_read_through(self):
+        """Test old terminal orders move to orders_archive in batches and stay readable"""
+        self.db.orders.insert_many([
+            {'order_id': 'old1', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2023-01-01', 'status': 'Delivered'},
+            {'order_id': 'old2', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2023-01-02', 'status': 'Shipped'},
+            {'order_id': 'open', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2023-01-03', 'status': 'Pending'},
+            {'order_id': 'new', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2024-06-01', 'status': 'Delivered'},
+        ])
+        pauses = []
+        moved = archive_orders(self.db, '2024-01-01', ['Shipped', 'Delivered'], batch_size=1, pause=0.5, sleep=pauses.append)
+        self.assertEqual(moved, 2)
+        self.assertEqual(pauses, [0.5, 0.5])
+        self.assertEqual(sorted(o['order_id'] for o in self.db.orders_archive.find()), ['old1', 'old2'])
+
+        self.assertEqual(self.app.get('/api/v1/orders/old1').get_json()['status'], 'Delivered')
+        self.assertEqual(self.app.get('/api/v1/orders/old2/status').get_json(), {'status': 'Shipped'})
+        listed = [o['order_id'] for o in self.app.get('/api/v1/orders').get_json()]
+        self.assertEqual(sorted(listed), ['new', 'open'])
+        page = self.app.get('/api/v1/orders?archived=true&limit=3').get_json()
+        self.assertEqual([o['order_id'] for o in page['items']], ['old1', 'old2', 'open'])
+        page = self.app.get('/api/v1/orders?archived=true&limit=3&after=' + page['next']).get_json()
+        self.assertEqual(([o['order_id'] for o in page['items']], page['next']), (['new'], None))
+
+        self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com'})
+        history = self.app.get('/api/v1/customers/c1/orders?archived=true').get_json()['items']
+        self.assertEqual([o['order_id'] for o in history], ['new', 'open', 'old2', 'old1'])
+        self.assertEqual(rebuild_rollups(self.db), 4)
+
+    def test_archive_orders_keeps_orders_updated_during_the_copy(self):
+        """Test an order updated between the copy and the delete stays live with the update"""
+        self.db.orders.insert_many([
+            {'order_id': 'old1', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2023-01-01', 'status': 'Shipped'},
+            {'order_id': 'old2', 'customer_id': 'c1', 'items': [], 'total': 5, 'date': '2023-01-02', 'status': 'Shipped'},
+        ])
+        archive = self.db.orders_archive
+        insert_many = archive.insert_many
+
+        def copy_then_update(orders, **kwargs):
+            result = insert_many(orders, **kwargs)
+            # Still a terminal status, so the archive query keeps matching it
+            self.db.orders.update_one({'order_id': 'old2'}, {'$set': {'status': 'Delivered'}})
+            return result
+
+        with mock.patch.object(archive, 'insert_many', copy_then_update):
+            moved = archive_orders(self.db, '2024-01-01', ['Shipped', 'Delivered'], max_batches=1)
+        self.assertEqual(moved, 1)
+        self.assertEqual([o['order_id'] for o in archive.find()], ['old1'])
+        self.assertEqual(self.db.orders.find_one({'order_id': 'old2'})['status'], 'Delivered')
+
+        # The next run moves it as it is now
+        self.assertEqual(archive_orders(self.db, '2024-01-01', ['Shipped', 'Delivered']), 1)
+        self.assertEqual(archive.find_one({'order_id': 'old2'})['status'], 'Delivered')
+
+    def test_export_orders_streams_csv_ndjson_and_watermark(self):
+        """Test orders export as flattened CSV or NDJSON, gzipped, and incrementally from a watermark"""
+        hour_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        self.db.orders.insert_many([
+            {'_id': ObjectId.from_datetime(hour_ago),
+             'order_id': 'o1', 'customer_id': 'c1', 'total': 25.0, 'date': '2024-01-01', 'status': 'Delivered',
+             'items': [{'item_id': 'i1', 'name': 'Widget', 'quantity': 2, 'price': 10.0},
+                       {'item_id': 'i2', 'name': 'Gadget, large', 'quantity': 1, 'price': 5.0}]},
+            {'_id': ObjectId.from_datetime(hour_ago + timedelta(seconds=1)),
+             'order_id': 'o2', 'customer_id': 'c2', 'total': 0, 'date': '2024-02-01', 'status': 'Pending', 'items': []},
+            # Too recent: left for the next export
+            {'_id': ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=10)),
+             'order_id': 'o4', 'customer_id': 'c2', 'total': 0, 'date': '2024-04-01', 'status': 'Pending', 'items': []},
+        ])
+        response = self.app.get('/api/v1/orders/export?format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[0][:5], ['order_id', 'customer_id', 'date', 'status', 'total'])
+        self.assertEqual([row[0] for row in rows[1:]], ['o1', 'o1', 'o2'])
+        self.assertEqual(rows[2][6], 'Gadget, large')
+        watermark = response.headers['X-Export-Watermark']
+
+        response = self.app.get('/api/v1/orders/export?gzip=true&from=2024-02-01')
+        lines = gzip.decompress(response.data).splitlines()
+        self.assertEqual([json.loads(line)['order_id'] for line in lines], ['o2'])
+
+        # Inserted after the export by a worker whose ids are behind the newest order
+        self.db.orders.insert_one({'_id': ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=30)),
+                                   'order_id': 'o3', 'customer_id': 'c1', 'total': 1, 'date': '2024-03-01',
+                                   'status': 'Pending', 'items': []})
+        with mock.patch('export.EXPORT_WATERMARK_LAG', 5):
+            response = self.app.get('/api/v1/orders/export?since=' + watermark)
+            result = app.test_cli_runner().invoke(args=['export-orders', '--since', watermark])
+        self.assertEqual([json.loads(line)['order_id'] for line in response.data.splitlines()], ['o3', 'o4'])
+        self.assertEqual(json.loads(result.stdout_bytes.splitlines()[0])['order_id'], 'o3')
+        self.assertEqual(self.app.get('/api/v1/orders/export?format=xml').status_code, 400)
+
+    def test_api_key_rate_limit(self):
+        """Test requests with an API key are limited per key, with 429 and rate limit headers"""
+        limited = self.app.post('/api/v1/keys/generate', json={'rate_limit': 60, 'burst': 2}).get_json()
+        other = self.app.post('/api/v1/keys/generate').get_json()
+        headers = {'Authorization': limited['key']}
+        response = self.app.get('/api/v1/items', headers=headers)
+        self.assertEqual((response.status_code, response.headers['X-RateLimit-Remaining']), (200, '1'))
+        self.assertEqual(self.app.get('/api/v1/items', headers=headers).status_code, 200)
+        response = self.app.get('/api/v1/items', headers=headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual((response.headers['Retry-After'], response.headers['X-RateLimit-Limit']), ('1', '2'))
+        self.assertRegex(self.app.get('/metrics').get_data(as_text=True), r'\norda_rate_limited_total [1-9]')
+        self.assertEqual(self.app.get('/api/v1/items', headers={'Authorization': other['key']}).status_code, 200)
+        self.assertEqual(self.app.get('/api/v1/items').status_code, 200)
+
+        response = self.app.put('/api/v1/keys/' + limited['key_id'], json={'rate_limit': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.get('/api/v1/items', headers=headers).status_code, 200)
+
+        # Two workers mapping the same file share one bucket, refilled over time
+        now = [1000.0]
+        path = os.path.join(EVENTS_DIR, 'shared-buckets.bin')
+        first, second = RateLimiter(path, timer=lambda: now[0]), RateLimiter(path, timer=lambda: now[0])
+        self.assertTrue(first.take('k', 60, 1).allowed)
+        self.assertFalse(second.take('k', 60, 1).allowed)
+        now[0] += 1
+        self.assertTrue(second.take('k', 60, 1).allowed)
+        self.assertEqual(second.limited, 1)
+
+    def test_requests_without_key_are_limited_per_client(self):
+        """Test requests without a valid API key draw on their client address's bucket"""
+        first = {'environ_base': {'REMOTE_ADDR': '192.0.2.1'}}
+        with mock.patch('ratelimit.CLIENT_RATE_LIMIT', 60), mock.patch('ratelimit.CLIENT_RATE_LIMIT_BURST', 1):
+            self.assertEqual(self.app.get('/api/v1/items', **first).status_code, 200)
+            response = self.app.get('/api/v1/items', headers={'Authorization': 'unknown'}, **first)
+            self.assertEqual((response.status_code, response.headers['Retry-After']), (429, '1'))
+            self.assertEqual(self.app.get('/api/v1/items', environ_base={'REMOTE_ADDR': '192.0.2.2'}).status_code, 200)
+            key = self.app.post('/api/v1/keys/generate', environ_base={'REMOTE_ADDR': '192.0.2.3'}).get_json()
+            self.assertEqual(self.app.get('/api/v1/items', headers={'Authorization': key['key']}, **first).status_code, 200)
+
+        # Behind N proxies, entries the client wrote itself before theirs are ignored
+        self.assertEqual(client_bucket('10.0.0.1', '203.0.113.9, 198.51.100.4, 10.0.0.2', proxies=2), 'client:198.51.100.4')
+        self.assertEqual(client_bucket('10.0.0.1', '203.0.113.9', proxies=0), 'client:10.0.0.1')
+
+    def test_api_key_limits_validation(self):
+        """Test key limits must be non-negative numbers, and bad stored limits fall back to the defaults"""
+        self.assertEqual(self.app.post('/api/v1/keys/generate', json={'rate_limit': 'fast'}).status_code, 400)
+        self.assertEqual(self.db.api_keys.count_documents({}), 0)
+        key = self.app.post('/api/v1/keys/generate').get_json()
+        for body in ({'rate_limit': 60, 'burst': 'x'}, {'burst': -1}, {'rate_limit': True}, {'foo': 1}):
+            self.assertEqual(self.app.put('/api/v1/keys/' + key['key_id'], json=body).status_code, 400)
+        self.assertEqual(self.app.put('/api/v1/keys/' + key['key_id'], json={'burst': None}).status_code, 200)
+
+        self.db.api_keys.update_one({'key_id': key['key_id']}, {'$set': {'rate_limit': 'fast', 'burst': 'x'}})
+        api_key_cache.clear()
+        self.assertEqual(self.app.get('/api/v1/items', headers={'Authorization': key['key']}).status_code, 200)
+
+    def test_metrics_report_coalesced_reads(self):
+        """Test two concurrent reads of one order share a query and show up on /metrics"""
+        self.db.orders.insert_one({'order_id': 'm1', 'customer_id': 'c1', 'items': [], 'total': 0,
+                                   'date': '2024-04-15', 'status': 'Pending'})
+        started, release = threading.Event(), threading.Event()
+        find_order = app_module.find_order
+
+        def slow_find_order(db, order_id):
+            started.set()
+            release.wait(5)
+            return find_order(db, order_id)
+
+        statuses = []
+        with mock.patch.object(app_module, 'find_order', slow_find_order):
+            threads = [threading.Thread(target=lambda: statuses.append(self.app.get('/api/v1/orders/m1').status_code))
+                       for _ in range(2)]
+            threads[0].start()
+            started.wait(5)
+            coalesced = app_module.read_cache.coalesced
+            threads[1].start()
+            while app_module.read_cache.coalesced == coalesced:
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(statuses, [200, 200])
+        self.assertIn('orda_reads_coalesced_total{cache="reads"} ', self.app.get('/metrics').get_data(as_text=True))
+
+    def test_read_cache_coalesces_concurrent_reads(self):
+        """Test concurrent misses for one key share a single load, and invalidated loads are not cached"""
+        cache = ReadCache(ttl=60)
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'order_id': 'o1'}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('o1', load))) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while cache.coalesced < 4:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), cache.loads, cache.coalesced), (1, 1, 4))
+        self.assertEqual(results, [{'order_id': 'o1'}] * 5)
+        self.assertEqual(cache.get('o1', load), {'order_id': 'o1'})
+        self.assertEqual((len(calls), cache.hits), (1, 1))
+
+        cache.invalidate('o1')
+        self.assertEqual(cache.get('o1', lambda: cache.invalidate('o1') or {'order_id': 'stale'}), {'order_id': 'stale'})
+        self.assertEqual(cache.get('o1', lambda: {'order_id': 'fresh'}), {'order_id': 'fresh'})
+        self.assertIsNone(cache.get('missing', lambda: None))
+        self.assertEqual(cache.loads, 4)
+
+    def test_order_and_customer_reads_cached_until_written(self):
+        """Test GET by id is served from the read cache and the matching put/delete invalidates it"""
+        self.db.orders.insert_one({'order_id': 'o1', 'customer_id': 'c1', 'items': [], 'total': 5,
+                                   'date': '2024-04-15', 'status': 'Pending'})
+        self.db.customers.insert_one({'customer_id': 'c1', 'name': 'John Doe', 'email': 'john@example.com',
+                                      'password': 'x', 'address': '1 Elm St'})
+        with mock.patch('app.read_cache', ReadCache(ttl=60)) as cache:
+            self.assertEqual(self.app.get('/api/v1/orders/o1').get_json()['status'], 'Pending')
+            self.db.orders.update_one({'order_id': 'o1'}, {'$set': {'status': 'Ready'}})
+            self.assertEqual(self.app.get('/api/v1/orders/o1/status').get_json(), {'status': 'Pending'})
+            self.app.put('/api/v1/orders/o1/status', json={'status': 'Collected'})
+            self.assertEqual(self.app.get('/api/v1/orders/o1/status').get_json(), {'status': 'Collected'})
+            self.app.delete('/api/v1/orders/o1')
+            self.assertEqual(self.app.get('/api/v1/orders/o1').status_code, 404)
+
+            self.assertEqual(self.app.get('/api/v1/customers/c1').get_json()['name'], 'John Doe')
+            self.app.put('/api/v1/customers/c1', json={'name': 'Jane Doe'})
+            self.assertEqual(self.app.get('/api/v1/customers/c1').get_json()['name'], 'Jane Doe')
+            self.assertEqual((cache.hits, cache.loads), (1, 5))
+
+    def test_init_worker_after_fork(self):
+        """Test a preloaded app gives each worker its own Mongo client and log thread, and prebuilds the spec"""
+        warm_up()
+        self.assertIn('/api/v1/orders/export', api.__schema__['paths'])
+
+        log_listener.stop()
+        init_worker()
+        try:
+            self.assertIsInstance(mongo.cx, MongoClient)
+            self.assertEqual(mongo.db.name, 'db')
+            self.assertTrue(log_listener._thread.is_alive())
+        finally:
+            mongo.cx.close()
+
+    def test_generate_is_deterministic_across_workers(self):
+        """Test the sample data generator writes the same data with any number of workers"""
+        outputs = []
+        for workers in (1, 2):
+            directory = tempfile.mkdtemp(dir=EVENTS_DIR)
+            generate.main(['--target', 'ndjson:' + directory, '--customers', '50', '--items', '20',
+                           '--orders', str(generate.CHUNK_SIZE + 10), '--workers', str(workers),
+                           '--start', '2024-01-01', '--end', '2024-03-31'])
+            files = {}
+            for name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    files[name] = f.read()
+            outputs.append(files)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(sorted(outputs[0]), ['customers-00000.ndjson', 'items-00000.ndjson',
+                                              'orders-00000.ndjson', 'orders-00001.ndjson'])
+
+    def test_generate_creates_indexes_after_dropping(self):
+        """Test --indexes leaves the API indexes in place on the regenerated collections"""
+        args = generate.build_parser().parse_args(['--customers', '5', '--items', '5', '--orders', '20'])
+        sink = generate.Sink('mongomock', args.batch_size)
+        generate.run(generate.Plan(args), sink, 1, indexes=True, out=io.StringIO())
+        self.assertIn('order_id_unique', sink.db.orders.index_information())
+        self.assertEqual(sink.db.orders.count_documents({}), 20)
+
+    def test_generate_pool_workers_connect_on_their_own(self):
+        """Test a connected database sink can be handed to a pool of workers"""
+        args = generate.build_parser().parse_args(['--customers', '0', '--items', '0', '--orders', '0'])
+        sink = generate.Sink('mongodb://fake_server.example.com:27017/orda', args.batch_size)
+        results = generate.run(generate.Plan(args), sink, 2, indexes=True, out=io.StringIO())
+        self.assertEqual(results['orders'][0], 0)
+        self.assertIn('order_id_unique', sink.db.orders.index_information())
+
 
 if __name__ == '__main__':
     unittest.main()
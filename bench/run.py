@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+'''
+Load test and benchmark for the OrdaSys API.
+
+Seeds a database (mongomock or a real mongod), drives every namespace at a
+fixed concurrency and reports throughput and p50/p95/p99 latency per route.
+Results can be saved as a JSON baseline and compared against one later:
+
+    python bench/run.py --orders 20000 --duration 20 --save bench/baseline.json
+    python bench/run.py --orders 20000 --duration 20 --compare bench/baseline.json
+
+By default the app is served in-process against mongomock. Use --mongo-uri to
+seed a local mongod and --target http://127.0.0.1:5000 to drive a running
+server (which must use the same database).
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import platform
+from collections import defaultdict
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+# Route label -> (weight, method, path template, body builder name)
+SCENARIOS = {
+    'GET /api/v1/orders?limit': (8, 'GET', '/api/v1/orders?limit=100', None),
+    'GET /api/v1/orders/<id>': (20, 'GET', '/api/v1/orders/{order_id}', None),
+    'GET /api/v1/orders/<id>/status': (20, 'GET', '/api/v1/orders/{order_id}/status', None),
+    'PUT /api/v1/orders/<id>/status': (5, 'PUT', '/api/v1/orders/{order_id}/status', 'status'),
+    'POST /api/v1/orders': (10, 'POST', '/api/v1/orders', 'order'),
+    'GET /api/v1/customers?limit': (3, 'GET', '/api/v1/customers?limit=100', None),
+    'GET /api/v1/customers/<id>': (8, 'GET', '/api/v1/customers/{customer_id}', None),
+    'POST /api/v1/customers': (1, 'POST', '/api/v1/customers', 'customer'),
+    'GET /api/v1/items': (10, 'GET', '/api/v1/items', None),
+    'GET /api/v1/items/<id>': (12, 'GET', '/api/v1/items/{item_id}', None),
+    'PUT /api/v1/items/<id>': (1, 'PUT', '/api/v1/items/{item_id}', 'item'),
+    'POST /api/v1/keys/generate': (2, 'POST', '/api/v1/keys/generate', None),
+}
+
+STATUSES = ['Pending', 'Preparing', 'Ready', 'Collected', 'Shipped', 'Delivered']
+
+
+def seed(db, customers, items, orders, rng):
+    '''Insert a deterministic data set and return the ids to request'''
+    for name in ('customers', 'items', 'orders', 'api_keys'):
+        db[name].delete_many({})
+
+    customer_ids = [f'c{i}' for i in range(customers)]
+    item_ids = [f'i{i}' for i in range(items)]
+    db.customers.insert_many([{'customer_id': c, 'name': f'Customer {c}', 'email': f'{c}@example.com',
+                               'password': 'x', 'address': f'{i} Elm St'} for i, c in enumerate(customer_ids)])
+    db.items.insert_many([{'item_id': i, 'name': f'Item {i}', 'price': round(rng.uniform(1, 50), 2),
+                           'stock': 10 ** 9} for i in item_ids])
+
+    order_ids = []
+    batch = []
+    for n in range(orders):
+        lines = [{'item_id': rng.choice(item_ids), 'name': 'x', 'quantity': rng.randint(1, 4),
+                  'price': 10.0} for _ in range(rng.randint(1, 4))]
+        order_id = f'o{n}'
+        order_ids.append(order_id)
+        batch.append({'order_id': order_id, 'customer_id': rng.choice(customer_ids), 'items': lines,
+                      'total': sum(line['quantity'] * line['price'] for line in lines),
+                      'date': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+                      'status': rng.choice(STATUSES)})
+        if len(batch) == 5000:
+            db.orders.insert_many(batch)
+            batch = []
+    if batch:
+        db.orders.insert_many(batch)
+    return {'customer_id': customer_ids, 'item_id': item_ids, 'order_id': order_ids}
+
+
+def build_body(kind, ids, rng):
+    if kind == 'order':
+        return {'customer_id': rng.choice(ids['customer_id']), 'date': '2024-05-20', 'status': 'Pending',
+                'items': [{'item_id': rng.choice(ids['item_id']), 'quantity': rng.randint(1, 3)}]}
+    if kind == 'status':
+        return {'status': rng.choice(STATUSES)}
+    if kind == 'customer':
+        return {'name': 'Bench User', 'email': 'bench@example.com', 'password': 'benchmark', 'address': '1 Elm St'}
+    if kind == 'item':
+        return {'name': 'Bench Item', 'price': round(rng.uniform(1, 50), 2), 'stock': 10 ** 9}
+    return None
+
+
+def load_replay(path):
+    '''
+    Read traffic to replay: either a gunicorn/Apache access log or JSON lines
+    with method, path and an optional body. Bodies missing from an access log
+    are generated from the matching scenario. Other lines are skipped.
+    '''
+    entries = []
+    access_line = re.compile(r'"(GET|POST|PUT|DELETE|OPTIONS|PATCH) (\S+) HTTP/[\d.]+"')
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and 'method' in entry and 'path' in entry:
+                    entries.append((entry['method'].upper(), entry['path'], entry.get('body')))
+                continue
+            match = access_line.search(line)
+            if match:
+                entries.append((match.group(1), match.group(2), None))
+    return entries
+
+
+def route_label(method, path):
+    '''Group concrete paths under the scenario label they belong to'''
+    for label, (_, scenario_method, template, _) in SCENARIOS.items():
+        pattern = '^' + re.escape(template).replace(r'\{order_id\}', '[^/?]+') \
+            .replace(r'\{customer_id\}', '[^/?]+').replace(r'\{item_id\}', '[^/?]+') + '$'
+        if method == scenario_method and re.match(pattern, path):
+            return label
+    return f'{method} {path.split("?")[0]}'
+
+
+class InProcessClient(object):
+    '''Calls the WSGI app directly, without sockets'''
+
+    def __init__(self, app):
+        from werkzeug.test import Client
+        self.client = Client(app)
+
+    def __call__(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        response.close()
+        return response.status_code
+
+
+class HttpClient(object):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def __call__(self, method, path, body):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib_request.Request(self.base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib_request.urlopen(req) as response:
+                response.read()
+                return response.status
+        except HTTPError as exc:
+            return exc.code
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run(client, plan, concurrency, duration, max_requests):
+    '''Drive `plan()` from `concurrency` threads; returns {label: [(seconds, status)]}'''
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    budget = [max_requests]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        local = defaultdict(list)
+        while time.perf_counter() < deadline:
+            if max_requests:
+                with lock:
+                    if budget[0] <= 0:
+                        break
+                    budget[0] -= 1
+            method, path, body = plan(rng)
+            started = time.perf_counter()
+            status = client(method, path, body)
+            local[route_label(method, path)].append((time.perf_counter() - started, status))
+        with lock:
+            for label, values in local.items():
+                samples[label].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, elapsed):
+    routes = {}
+    for label, values in sorted(samples.items()):
+        latencies = sorted(seconds for seconds, _ in values)
+        routes[label] = {
+            'requests': len(values),
+            'errors': sum(1 for _, status in values if status >= 500),
+            'throughput': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        }
+    return routes
+
+
+def compare(routes, baseline, threshold):
+    '''Return a message for every route slower (p95) or lower-throughput than the baseline'''
+    regressions = []
+    for label, before in baseline['routes'].items():
+        after = routes.get(label)
+        if not after:
+            continue
+        if before['p95_ms'] and after['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append(f"{label}: p95 {before['p95_ms']}ms -> {after['p95_ms']}ms")
+        if before['throughput'] and after['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append(f"{label}: throughput {before['throughput']}/s -> {after['throughput']}/s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='OrdaSys API load test')
+    parser.add_argument('--target', default='inprocess', help="'inprocess' or the base URL of a running server")
+    parser.add_argument('--mongo-uri', help='Seed this mongod instead of mongomock (in-process mode uses it too)')
+    parser.add_argument('--no-seed', action='store_true', help='Use the data already in the database')
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run')
+    parser.add_argument('--requests', type=int, default=0, help='Stop after this many requests')
+    parser.add_argument('--replay', help='Replay an access log or a JSON lines request file instead of the mix')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    # Read before seeding, which can take a while
+    entries = load_replay(args.replay) if args.replay else None
+    if args.replay and not entries:
+        parser.error(f'--replay {args.replay}: no requests found (expected access log lines or JSON lines with method and path)')
+
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+    os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017/orda_bench')
+    sys.path.insert(0, BACKEND)
+
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        db = MongoClient(args.mongo_uri).get_default_database()
+    else:
+        import mongomock
+        db = mongomock.MongoClient().orda_bench
+
+    if args.target == 'inprocess':
+        import app as orda
+        if not args.mongo_uri:
+            orda.mongo.cx, orda.mongo.db = db.client, db
+        client = InProcessClient(orda.app)
+    else:
+        client = HttpClient(args.target)
+
+    rng = random.Random(args.seed)
+    if args.no_seed:
+        ids = {'customer_id': [d['customer_id'] for d in db.customers.find({}, {'customer_id': 1})],
+               'item_id': [d['item_id'] for d in db.items.find({}, {'item_id': 1})],
+               'order_id': [d['order_id'] for d in db.orders.find({}, {'order_id': 1})]}
+    else:
+        started = time.perf_counter()
+        ids = seed(db, args.customers, args.items, args.orders, rng)
+        print(f'Seeded {args.orders} orders in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    if args.replay:
+        position = [0]
+        lock = threading.Lock()
+
+        def plan(rng):
+            with lock:
+                method, path, body = entries[position[0] % len(entries)]
+                position[0] += 1
+            if body is None:
+                scenario = SCENARIOS.get(route_label(method, path))
+                body = build_body(scenario[3], ids, rng) if scenario else None
+            return method, path, body
+    else:
+        labels = list(SCENARIOS)
+        weights = [SCENARIOS[label][0] for label in labels]
+
+        def plan(rng):
+            _, method, template, body = SCENARIOS[rng.choices(labels, weights)[0]]
+            path = template.format(**{key: rng.choice(values) for key, values in ids.items()})
+            return method, path, build_body(body, ids, rng)
+
+    samples, elapsed = run(client, plan, args.concurrency, args.duration, args.requests)
+    routes = summarize(samples, elapsed)
+
+    print(f"{'route':45} {'req':>7} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, r in routes.items():
+        print(f"{label:45} {r['requests']:7} {r['errors']:5} {r['throughput']:9} "
+              f"{r['p50_ms']:9} {r['p95_ms']:9} {r['p99_ms']:9}")
+    total = sum(r['requests'] for r in routes.values())
+    print(f'{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)')
+
+    result = {
+        'meta': {'target': args.target, 'mongo': 'mongod' if args.mongo_uri else 'mongomock',
+                 'customers': args.customers, 'items': args.items, 'orders': args.orders,
+                 'concurrency': args.concurrency, 'replay': args.replay, 'seed': args.seed,
+                 'python': platform.python_version(), 'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'routes': routes,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(routes, json.load(f), args.threshold)
+        for message in regressions:
+            print('REGRESSION ' + message, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
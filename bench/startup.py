@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+'''
+Startup benchmark for the gunicorn profile in gunicorn_config.py.
+
+Starts the server with and without preload_app and reports, for each mode,
+the time from launch until the first response, the time of the first
+Swagger spec request, and the memory of the master and of each worker
+(RSS, PSS and private bytes, from /proc; Linux only). The app is imported
+without connecting to Mongo, so no database is needed.
+
+    python bench/startup.py --workers 4
+    python bench/startup.py --workers 4 --save bench/startup.json
+'''
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+from urllib import request as urllib_request
+from urllib.error import URLError
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BACKEND = os.path.join(ROOT, 'backend')
+
+IMPORT_SCRIPT = '''
+import time, json
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.warm_up()
+print(json.dumps({'import_seconds': imported - started, 'swagger_seconds': time.perf_counter() - imported}))
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def memory(pid):
+    '''{'rss', 'pss', 'private'} in MiB from /proc/<pid>/smaps_rollup'''
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': values.get('Rss', 0), 'pss': values.get('Pss', 0),
+            'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)}
+
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def get(url, timeout=5):
+    started = time.perf_counter()
+    with urllib_request.urlopen(url, timeout=timeout) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def environment(**extra):
+    env = dict(os.environ)
+    env.setdefault('MONGO_URI', 'mongodb://127.0.0.1:27017/orda_startup')
+    env.update({'ORDA_LOG_FILE': os.devnull, 'ORDA_ERROR_LOG': os.devnull, 'ORDA_ACCESS_LOG': os.devnull,
+                'ORDA_METRICS_DIR': '', 'ORDA_ENSURE_INDEXES': 'false'}, **extra)
+    return env
+
+
+def measure_import():
+    '''Import and Swagger spec time of a single cold process'''
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=BACKEND, env=environment(),
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_server(preload, workers, requests, timeout=60):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    env = environment(ORDA_PRELOAD='true' if preload else 'false', ORDA_WORKERS=str(workers),
+                      ORDA_BIND=f'127.0.0.1:{port}')
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py')],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited with status %s' % server.returncode)
+            try:
+                get(base + '/metrics', timeout=1)
+                break
+            except (URLError, ConnectionError, OSError):
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError('gunicorn did not answer within %ss' % timeout)
+                time.sleep(0.05)
+        first_response = time.perf_counter() - started
+
+        # Every worker builds the spec on its first request unless it was preloaded
+        swagger = [get(base + '/swagger.json') for _ in range(requests)]
+        while len(children(server.pid)) < workers:
+            time.sleep(0.05)
+        pids = children(server.pid)
+        worker_memory = [memory(pid) for pid in pids]
+        return {
+            'first_response_seconds': first_response,
+            'first_swagger_seconds': swagger[0],
+            'slowest_swagger_seconds': max(swagger),
+            'master': memory(server.pid),
+            'workers': worker_memory,
+            'worker_private_mib': sum(m['private'] for m in worker_memory) / len(worker_memory),
+            'total_pss_mib': memory(server.pid)['pss'] + sum(m['pss'] for m in worker_memory),
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='OrdaSys server startup benchmark')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20, help='Swagger spec requests after startup')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = {'import': measure_import()}
+    print(f"import {results['import']['import_seconds']:.2f}s, "
+          f"swagger spec {results['import']['swagger_seconds'] * 1000:.0f}ms", file=sys.stderr)
+    for preload in (True, False):
+        mode = 'preload' if preload else 'no-preload'
+        result = results[mode] = measure_server(preload, args.workers, args.requests)
+        print(f"{mode:<11} first response {result['first_response_seconds']:.2f}s  "
+              f"swagger first {result['first_swagger_seconds'] * 1000:.0f}ms "
+              f"slowest {result['slowest_swagger_seconds'] * 1000:.0f}ms  "
+              f"private/worker {result['worker_private_mib']:.1f}MiB  total PSS {result['total_pss_mib']:.1f}MiB",
+              file=sys.stderr)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,75 @@
-# Set the number of worker processes
-workers = 4
+import gc
+import os
+import glob
+
+# CPUs this process may run on (respects cpusets, e.g. in containers)
+try:
+    cpus = len(os.sched_getaffinity(0))
+except AttributeError:  # not on Linux
+    cpus = os.cpu_count() or 1
+
+# Worker processes and threads per worker, sized from the CPU count unless set
+workers = int(os.environ.get('ORDA_WORKERS', 2 * cpus + 1))
+threads = int(os.environ.get('ORDA_THREADS', max(8, 4 * cpus)))
 
 # Bind the server to this host and port
-bind = '127.0.0.1:5000'
+bind = os.environ.get('ORDA_BIND', '127.0.0.1:5000')
+
+# Import the app once in the master and fork workers from it: startup work
+# (models, Swagger spec) is done once and its memory is shared copy-on-write.
+# post_fork below gives each worker its own Mongo client and log thread.
+preload_app = os.environ.get('ORDA_PRELOAD', 'true').lower() == 'true'
+
+# Seconds a silent worker lives before it is restarted, to finish requests
+# on shutdown, and to hold idle keep-alive connections
+timeout = int(os.environ.get('ORDA_WORKER_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('ORDA_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('ORDA_KEEPALIVE', 5))
+
+# Run from backend/ when started from a checkout (the container copies backend/ as /app)
+_backend = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend')
+if os.path.isdir(_backend):
+    chdir = _backend
 
-# Set the path to your Flask application
-app = 'app:app'
+# Set the path to your Flask application; ORDA_SERVER=asgi serves the async
+# entry point (backend/asgi.py) on uvicorn workers instead
+if os.environ.get('ORDA_SERVER', 'wsgi') == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+
+# Each open /api/v1/orders/events stream holds a request thread (under asgi,
+# one of the sync pool's); at most half of them go to streams so the API
+# always has threads left
+_request_threads = int(os.environ.get('ORDA_ASGI_SYNC_THREADS', 32)) if worker_class != 'gthread' else threads
+os.environ.setdefault('ORDA_EVENTS_MAX_STREAMS', str(max(_request_threads // 2, 1)))
 
 # Logging configuration (optional)
-errorlog = 'error.log'
-accesslog = 'access.log'
+errorlog = os.environ.get('ORDA_ERROR_LOG', 'error.log')
+accesslog = os.environ.get('ORDA_ACCESS_LOG', 'access.log')
+
+# Workers share their metrics through this directory so /metrics covers all of them
+metrics_dir = os.environ.setdefault('ORDA_METRICS_DIR', '/tmp/orda-metrics')
+
+def on_starting(server):
+    # Drop snapshots left behind by a previous run
+    if not metrics_dir:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+def when_ready(server):
+    if preload_app:
+        from app import warm_up
+        warm_up()
+        # Keep the preloaded objects out of the collector's reach so that a
+        # collection in a worker does not copy their pages
+        gc.freeze()
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import init_worker
+        init_worker()
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+'''
+Synthetic data for OrdaSys: customers, items and orders at any scale, for
+capacity planning and benchmarks.
+
+    python seed/generate.py --orders 2000000 --target mongodb://localhost:27017/orda
+    python seed/generate.py --orders 2000000 --target ndjson:/tmp/orda-data
+
+Orders reference existing customers and items, copy the item name and price
+into their lines and carry the matching total. Item popularity and customer
+activity are skewed (a few items and customers account for most orders),
+dates are spread over --start..--end and statuses follow --status-mix, with
+orders older than --open-days always in a terminal status.
+
+The data depends only on --seed and the volumes: documents are generated in
+fixed-size chunks, each from its own random stream, so any number of
+--workers produces the same set. Each worker writes its chunks with
+unordered insert_many batches (or to its own NDJSON files) and the run ends
+with the insert throughput per collection.
+
+Reporting rollups and customer order summaries are not written; run
+`flask rebuild-reports` afterwards (or pass --rebuild).
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from bisect import bisect_right
+from datetime import date, timedelta
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+# Documents per chunk; part of the seed, so changing it changes the data
+CHUNK_SIZE = 10000
+
+STATUS_MIX = 'Pending=2,Preparing=2,Ready=2,Shipped=14,Collected=30,Delivered=50'
+TERMINAL_STATUSES = ('Shipped', 'Collected', 'Delivered')
+
+FIRST_NAMES = ['James', 'Mary', 'Thabo', 'Aisha', 'Wei', 'Lerato', 'Carlos', 'Fatima', 'John', 'Sipho',
+               'Emma', 'Noah', 'Olivia', 'Liam', 'Zanele', 'Priya', 'Mohammed', 'Sofia', 'Kenji', 'Amara']
+LAST_NAMES = ['Smith', 'Nkosi', 'Khan', 'Garcia', 'Chen', 'Dlamini', 'Naidoo', 'Brown', 'Mokoena', 'Silva',
+              'Patel', 'Johnson', 'Botha', 'Okafor', 'Müller', 'Tanaka', 'Van der Merwe', 'Ndlovu', 'Lee', 'Cohen']
+STREETS = ['Elm', 'Oak', 'Main', 'Church', 'Long', 'Market', 'Station', 'Park', 'Bree', 'Victoria']
+CITIES = ['Cape Town', 'Johannesburg', 'Durban', 'Pretoria', 'Gqeberha', 'Bloemfontein', 'Polokwane']
+ADJECTIVES = ['Classic', 'Spicy', 'Large', 'Small', 'Vegan', 'Smoked', 'Grilled', 'Fresh', 'Double', 'Crispy']
+PRODUCTS = ['Burger', 'Wrap', 'Coffee', 'Salad', 'Pizza', 'Bunny Chow', 'Smoothie', 'Toastie', 'Muffin',
+            'Bowl', 'Boerewors Roll', 'Iced Tea', 'Samoosa', 'Cheesecake', 'Flat White']
+
+
+def entity_id(seed, kind, n):
+    '''Stable id of the n-th customer/item/order, so orders can reference rows generated elsewhere'''
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'orda:{seed}:{kind}:{n}'))
+
+
+def chunk_rng(seed, kind, chunk):
+    return random.Random(f'{seed}:{kind}:{chunk}')
+
+
+def parse_mix(text):
+    '''"Pending=2,Delivered=50" -> {'Pending': 2.0, 'Delivered': 50.0}'''
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError('The status mix needs at least one positive weight')
+    return mix
+
+
+def zipf_weights(count, skew):
+    '''Cumulative weights of 1/rank**skew, for random.choices(cum_weights=...)'''
+    return list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
+
+
+def password_hash(password, seed, iterations=260000):
+    '''
+    One werkzeug-compatible hash shared by every generated customer: a
+    per-customer hash would dominate the run. The salt comes from the seed
+    so the output stays deterministic.
+    '''
+    salt = hashlib.sha256(f'orda:{seed}:salt'.encode()).hexdigest()[:16]
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations).hex()
+    return f'pbkdf2:sha256:{iterations}${salt}${digest}'
+
+
+class Plan(object):
+    '''Everything a worker needs to generate any chunk on its own'''
+
+    def __init__(self, args):
+        self.seed = args.seed
+        self.customers = args.customers
+        self.items = args.items
+        self.orders = args.orders
+        self.start = date.fromisoformat(args.start)
+        self.end = date.fromisoformat(args.end)
+        if self.end < self.start:
+            raise ValueError('--end is before --start')
+        self.open_after = self.end - timedelta(days=args.open_days)
+        self.max_lines = args.max_lines
+        self.item_skew = args.item_skew
+        self.customer_skew = args.customer_skew
+        mix = parse_mix(args.status_mix)
+        self.statuses, self.status_weights = list(mix), list(mix.values())
+        terminal = {name: weight for name, weight in mix.items() if name in TERMINAL_STATUSES}
+        self.closed_statuses, self.closed_weights = (list(terminal), list(terminal.values())) if terminal \
+            else (self.statuses, self.status_weights)
+        self.password = password_hash(args.password, args.seed)
+
+    def chunks(self, kind):
+        total = getattr(self, kind)
+        return [(kind, chunk, chunk * CHUNK_SIZE, min(CHUNK_SIZE, total - chunk * CHUNK_SIZE))
+                for chunk in range((total + CHUNK_SIZE - 1) // CHUNK_SIZE)]
+
+    def customer(self, rng, n):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        return {
+            'customer_id': entity_id(self.seed, 'customer', n),
+            'name': f'{first} {last}',
+            'email': f"{first}.{last.replace(' ', '')}{n}@example.com".lower(),
+            'password': self.password,
+            'address': f'{rng.randint(1, 999)} {rng.choice(STREETS)} St, {rng.choice(CITIES)}',
+        }
+
+    def item(self, rng, n):
+        return {
+            'item_id': entity_id(self.seed, 'item', n),
+            'name': f'{rng.choice(ADJECTIVES)} {rng.choice(PRODUCTS)} {n}',
+            # Mostly cheap, with a long tail of expensive items
+            'price': round(min(rng.lognormvariate(3.3, 0.6), 2000), 2),
+            'stock': rng.randint(0, 5000),
+        }
+
+    def catalog(self):
+        '''Every item's (id, name, price), in popularity order'''
+        items = [self.item(rng, n) for _, chunk, first, count in self.chunks('items')
+                 for rng in [chunk_rng(self.seed, 'items', chunk)] for n in range(first, first + count)]
+        random.Random(f'{self.seed}:popularity').shuffle(items)
+        return [(item['item_id'], item['name'], item['price']) for item in items]
+
+    def order(self, rng, n, catalog, item_weights, customers, customer_weights):
+        picked = rng.choices(catalog, cum_weights=item_weights, k=rng.randint(1, self.max_lines))
+        lines = {}
+        for item_id, name, price in picked:
+            if item_id not in lines:
+                lines[item_id] = {'item_id': item_id, 'name': name, 'quantity': 0, 'price': price}
+            lines[item_id]['quantity'] += rng.choices((1, 2, 3, 4, 5), (60, 25, 8, 4, 3))[0]
+        lines = list(lines.values())
+
+        day = self.start + timedelta(days=rng.randint(0, (self.end - self.start).days))
+        if day < self.open_after:
+            status = rng.choices(self.closed_statuses, self.closed_weights)[0]
+        else:
+            status = rng.choices(self.statuses, self.status_weights)[0]
+        customer = customers[bisect_right(customer_weights, rng.random() * customer_weights[-1])]
+        return {
+            'order_id': entity_id(self.seed, 'order', n),
+            'customer_id': entity_id(self.seed, 'customer', customer),
+            'items': lines,
+            'total': round(sum(line['price'] * line['quantity'] for line in lines), 2),
+            'date': day.isoformat(),
+            'status': status,
+        }
+
+
+class Sink(object):
+    '''Where generated chunks go: a database or a directory of NDJSON files'''
+
+    def __init__(self, target, batch_size):
+        self.target = target
+        self.batch_size = batch_size
+        self.directory = target[len('ndjson:'):] if target.startswith('ndjson:') else None
+        self.db = None
+
+    def __getstate__(self):
+        # Workers get the settings only and open their own client in _init_worker;
+        # a connected client can't be pickled (or shared across processes)
+        return {**self.__dict__, 'db': None}
+
+    def connect(self):
+        if self.directory is None and self.db is None:
+            if self.target == 'mongomock':
+                import mongomock
+                self.db = mongomock.MongoClient().orda
+            else:
+                from pymongo import MongoClient
+                self.db = MongoClient(self.target).get_default_database()
+        return self
+
+    def drop(self):
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.endswith('.ndjson'):
+                    os.remove(os.path.join(self.directory, name))
+        else:
+            for name in ('customers', 'items', 'orders', 'orders_archive'):
+                self.db[name].drop()
+
+    def write(self, kind, chunk, documents):
+        if self.directory is not None:
+            with open(os.path.join(self.directory, f'{kind}-{chunk:05d}.ndjson'), 'w', encoding='utf-8') as out:
+                out.writelines(json.dumps(document, separators=(',', ':')) + '\n' for document in documents)
+            return
+        for start in range(0, len(documents), self.batch_size):
+            self.db[kind].insert_many(documents[start:start + self.batch_size], ordered=False)
+
+
+# Per-process state of the worker pool
+_plan = _sink = _orders = None
+
+
+def _init_worker(plan, sink):
+    global _plan, _sink, _orders
+    _plan, _sink, _orders = plan, sink.connect(), None
+
+
+def generate_chunk(task):
+    '''Generate and write one chunk; returns (kind, documents, seconds spent writing)'''
+    global _orders
+    kind, chunk, first, count = task
+    rng = chunk_rng(_plan.seed, kind, chunk)
+    if kind == 'customers':
+        documents = [_plan.customer(rng, n) for n in range(first, first + count)]
+    elif kind == 'items':
+        documents = [_plan.item(rng, n) for n in range(first, first + count)]
+    else:
+        if _orders is None:
+            customers = list(range(_plan.customers))
+            random.Random(f'{_plan.seed}:activity').shuffle(customers)
+            _orders = (_plan.catalog(), zipf_weights(_plan.items, _plan.item_skew),
+                       customers, zipf_weights(_plan.customers, _plan.customer_skew))
+        documents = [_plan.order(rng, n, *_orders) for n in range(first, first + count)]
+    started = time.perf_counter()
+    _sink.write(kind, chunk, documents)
+    return kind, count, time.perf_counter() - started
+
+
+def run(plan, sink, workers, drop=True, indexes=False, out=sys.stderr):
+    '''
+    Generate every collection in turn; returns {kind: (documents, wall seconds)}.
+    With `indexes`, the API indexes are created once the old data is dropped
+    (dropping a collection drops its indexes too) and before the inserts.
+    The drop and the indexes use this process's client; each pool worker
+    connects on its own.
+    '''
+    sink.connect()
+    if drop:
+        sink.drop()
+    elif sink.directory is not None:
+        os.makedirs(sink.directory, exist_ok=True)
+    if indexes and sink.directory is None:
+        from indexes import ensure_indexes
+        ensure_indexes(sink.db)
+    results = {}
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(workers, _init_worker, (plan, sink))
+    else:
+        _init_worker(plan, sink)
+    try:
+        for kind in ('customers', 'items', 'orders'):
+            started = time.perf_counter()
+            tasks = plan.chunks(kind)
+            done = 0
+            for _, count, _ in (pool.imap_unordered(generate_chunk, tasks) if pool else map(generate_chunk, tasks)):
+                done += count
+            elapsed = time.perf_counter() - started
+            results[kind] = (done, elapsed)
+            print(f'{kind:<10} {done:>10} docs {elapsed:8.1f}s {done / elapsed if elapsed else 0:>12,.0f} docs/s',
+                  file=out)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate OrdaSys sample data')
+    parser.add_argument('--target', default='mongomock',
+                        help="'mongomock' (in memory, for timing the generator), a mongodb:// URI or ndjson:DIR")
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--start', default='2023-01-01', help='First order date')
+    parser.add_argument('--end', default=date.today().isoformat(), help='Last order date')
+    parser.add_argument('--open-days', type=int, default=7,
+                        help='Orders older than this many days before --end are in a terminal status')
+    parser.add_argument('--status-mix', default=STATUS_MIX, help='Relative weight per status')
+    parser.add_argument('--item-skew', type=float, default=1.1, help='Zipf exponent of item popularity')
+    parser.add_argument('--customer-skew', type=float, default=0.8, help='Zipf exponent of customer activity')
+    parser.add_argument('--max-lines', type=int, default=5, help='Most distinct item picks per order')
+    parser.add_argument('--password', default='password', help='Password of every generated customer')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=1000, help='Documents per insert_many')
+    parser.add_argument('--keep', action='store_true', help='Add to the existing data instead of replacing it')
+    parser.add_argument('--indexes', action='store_true', help='Create the API indexes before inserting')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild reporting rollups and order summaries afterwards (mongod only)')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if min(args.customers, args.items) < 1 and args.orders:
+        parser.error('orders need at least one customer and one item')
+    try:
+        plan = Plan(args)
+    except ValueError as exc:
+        parser.error(str(exc))
+    sink = Sink(args.target, args.batch_size)
+    workers = args.workers
+    if args.target == 'mongomock':
+        # Each process would have its own in-memory database
+        workers = 1
+
+    sys.path.insert(0, BACKEND)
+    started = time.perf_counter()
+    results = run(plan, sink, workers, drop=not args.keep, indexes=args.indexes)
+    total = sum(count for count, _ in results.values())
+    elapsed = time.perf_counter() - started
+    print(f'{"total":<10} {total:>10} docs {elapsed:8.1f}s {total / elapsed if elapsed else 0:>12,.0f} docs/s '
+          f'({workers} workers)', file=sys.stderr)
+
+    if args.rebuild and sink.directory is None and args.target != 'mongomock':
+        from reports import rebuild_rollups
+        from history import rebuild_summaries
+        rebuild_rollups(sink.connect().db)
+        rebuild_summaries(sink.db)
+        print('Rebuilt reports and order summaries', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()